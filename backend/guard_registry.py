@@ -0,0 +1,67 @@
+"""
+Guard registry for building prediction responses
+Struct-of-arrays view of guard metadata aligned to guard label indices
+"""
+
+from typing import Dict, Optional
+
+import numpy as np
+
+UNKNOWN = b'Unknown'
+
+
+class GuardRegistry:
+    """
+    Guard fingerprint, nickname, address and country as fixed-width string
+    columns where row i describes guard label i
+
+    Columns are aligned once at startup, so turning ranked label indices into
+    response fields is a vectorized gather rather than a per-item dict lookup.
+    Guards without metadata get the same placeholders the API always used.
+    """
+
+    def __init__(self, fingerprints, meta: Optional[np.ndarray] = None):
+        self.fingerprint = np.asarray(fingerprints).astype('S40')
+        n = len(self.fingerprint)
+
+        labels = np.arange(n)
+        self.nickname = np.char.add(b'GuardNode', np.char.zfill(labels.astype('S'), 3))
+        self.address = np.full(n, UNKNOWN, dtype='S7')
+        self.country = np.full(n, UNKNOWN, dtype='S7')
+
+        if meta is not None and len(meta):
+            # meta is sorted by fingerprint, so alignment is a single searchsorted
+            pos = np.clip(np.searchsorted(meta['fingerprint'], self.fingerprint), 0, len(meta) - 1)
+            found = meta['fingerprint'][pos] == self.fingerprint
+            self.nickname = np.where(found, meta['nickname'][pos], self.nickname)
+            self.address = np.where(found, meta['address'][pos], self.address)
+            self.country = np.where(found, meta['country'][pos], self.country)
+            self.enriched = int(found.sum())
+        else:
+            self.enriched = 0
+
+        # Keep columns as fixed-width unicode so gathers need no per-item decode
+        self.fingerprint, self.nickname, self.address, self.country = (
+            np.char.decode(column, 'utf-8') for column in (self.fingerprint, self.nickname, self.address, self.country)
+        )
+
+    def __len__(self) -> int:
+        return len(self.fingerprint)
+
+    @property
+    def nbytes(self) -> int:
+        return self.fingerprint.nbytes + self.nickname.nbytes + self.address.nbytes + self.country.nbytes
+
+    def gather(self, indices: np.ndarray) -> Dict[str, list]:
+        """
+        Metadata for an array of guard label indices
+
+        Returns nested Python lists of str with the same shape as indices,
+        one per field.
+        """
+        return {
+            'guard_fingerprint': self.fingerprint[indices].tolist(),
+            'guard_nickname': self.nickname[indices].tolist(),
+            'guard_address': self.address[indices].tolist(),
+            'guard_country': self.country[indices].tolist(),
+        }
@@ -3,19 +3,32 @@ TOR Guard Node Prediction System - FastAPI Backend
 Integrates XGBoost model with real-time prediction and explainability
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from enum import Enum
+from collections import deque
+from contextlib import contextmanager
+import asyncio
+import os
 import random
-import joblib
-import pandas as pd
+import secrets
 import numpy as np
-import csv
 from pathlib import Path
 import time
-import json
+import sys
+
+# Shared ranking/feature modules live alongside the training scripts
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'scripts'))
+
+from dataset_io import find_engineered
+from guard_metadata import load_guard_metadata, load_or_build_guard_metadata
+from feature_pipeline import BYTES_PER_MB
+from model_bundle import ModelBundle, current_version, list_bundles, load_bundle
+from prediction_engine import PredictionEngine, TwoStageEngine
+from guard_registry import GuardRegistry
+from prediction_cache import PredictionCache
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -33,16 +46,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global model storage
-MODEL_PATH = Path("../models/xgboost_guard_predictor.json")
-ENCODERS_PATH = Path("../models/encoders.pkl")
-FEATURE_COLS_PATH = Path("../models/feature_columns.pkl")
+# Artifact locations, independent of the working directory the server starts in
+MODEL_DIR = Path(__file__).resolve().parents[1] / 'models'
+GUARD_META_PATH = MODEL_DIR / 'guard_metadata.npy'
+DATA_DIR = Path(__file__).resolve().parents[1] / 'data'
+METADATA_CSV_PATH = find_engineered(DATA_DIR) or DATA_DIR / 'circuit_data_engineered.parquet'
+
+prediction_cache = PredictionCache()
+
+MODEL_VERSION = "1.0.0-xgboost"
+
+# /api/admin/* is disabled unless a token is configured
+ADMIN_TOKEN = os.environ.get('TGNP_ADMIN_TOKEN')
 
-model = None
-encoders = None
-feature_columns = None
-guard_fingerprints = None  # For inverse transform
-guard_meta = {}
+MAX_BATCH_SIZE = 4096
+# Ranked guards computed (and cached) per row; requests ask for at most this many
+MAX_TOP_K = 100
+
+# Micro-batching window for /api/predict: flush after this many ms or items
+COALESCE_WINDOW_MS = float(os.environ.get('TGNP_COALESCE_WINDOW_MS', 2.0))
+COALESCE_MAX_BATCH = int(os.environ.get('TGNP_COALESCE_MAX_BATCH', 64))
 
 
 class PredictionRequest(BaseModel):
@@ -53,6 +76,7 @@ class PredictionRequest(BaseModel):
     setup_time: float = Field(default=0.0, description="Circuit setup time in seconds")
     middle_fingerprint: Optional[str] = Field(default=None, description="Middle node fingerprint if known")
     middle_country: Optional[str] = Field(default=None, description="Middle node country")
+    explain_contributions: bool = Field(default=False, description="Include per-feature contributions for the top-ranked guard")
 
 
 class GuardPrediction(BaseModel):
@@ -81,6 +105,32 @@ class PredictionResponse(BaseModel):
     explainability: Optional[Dict[str, Any]] = None
 
 
+class BatchPredictionRequest(BaseModel):
+    """Request schema for scoring many exit events in one call"""
+    requests: List[PredictionRequest] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE, description="Exit events to score")
+    top_k: int = Field(default=10, ge=1, le=MAX_TOP_K, description="Number of ranked guards returned per item (at most the shortlist size of a two-stage model)")
+
+
+class BatchPredictionItem(BaseModel):
+    """Ranked guards for a single item of a batch"""
+    index: int
+    predictions: List[GuardPrediction]
+
+
+class BatchPredictionResponse(BaseModel):
+    """Response schema for batch prediction with per-batch throughput"""
+    results: List[BatchPredictionItem]
+    batch_size: int
+    prediction_time_ms: float
+    throughput_per_sec: float
+    model_version: str
+
+
+class ReloadRequest(BaseModel):
+    """Admin request to swap in a model bundle"""
+    version: Optional[str] = Field(default=None, description="Bundle version to load (default: models/bundles/CURRENT); CURRENT itself is left unchanged")
+
+
 class NodeType(str, Enum):
     guard = "guard"
     middle = "middle"
@@ -113,229 +163,380 @@ class TopologyResponse(BaseModel):
     note: str
 
 
-@app.on_event("startup")
-async def load_model():
-    """Load model and encoders on startup"""
-    global model, encoders, feature_columns, guard_fingerprints
+class RequestCoalescer:
+    """
+    Micro-batching queue for single-item predictions
+
+    Feature rows submitted within window_ms of the first queued row (or until
+    max_batch rows are waiting) are stacked into one matrix, scored with a
+    single engine call and the ranked guard rows are fanned back out to the
+    awaiting handlers. Latency and throughput counters feed /api/stats.
+    """
     
-    try:
-        # Load XGBoost model
-        import xgboost as xgb
-        model = xgb.XGBClassifier()
-        model.load_model(str(MODEL_PATH))
+    def __init__(self, engine: PredictionEngine, window_ms: float = COALESCE_WINDOW_MS,
+                 max_batch: int = COALESCE_MAX_BATCH, latency_samples: int = 10000):
+        self.engine = engine
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        # Created in start(): on Python 3.9 asyncio primitives bind to a loop
+        # when constructed, and states are built in a worker thread
+        self._queue: Optional[asyncio.Queue] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._inflight = set()
         
-        # Load encoders
-        with open(ENCODERS_PATH, 'rb') as f:
-            encoders = joblib.load(f)
+        self._latencies = deque(maxlen=latency_samples)
+        self._started_at = time.perf_counter()
+        self.requests_total = 0
+        self.batches_total = 0
+        self.errors_total = 0
+    
+    def start(self):
+        self._started_at = time.perf_counter()
+        self._queue = asyncio.Queue()
+        self._runner = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+    
+    async def submit(self, row: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Queue one feature row and wait for its top MAX_TOP_K guards: (indices, scores), best first"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future, time.perf_counter()))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                try:
+                    if remaining <= 0:
+                        batch.append(self._queue.get_nowait())
+                    else:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+            # Score in the background so the next window starts collecting immediately
+            task = asyncio.create_task(self._score(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+    
+    async def _score(self, batch):
+        try:
+            indices, scores = await self.engine.rank(np.vstack([row for row, _, _ in batch]), MAX_TOP_K)
+        except Exception as e:
+            self.errors_total += len(batch)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
         
-        # Load feature columns
-        with open(FEATURE_COLS_PATH, 'rb') as f:
-            feature_columns = joblib.load(f)
+        now = time.perf_counter()
+        self.batches_total += 1
+        self.requests_total += len(batch)
+        for i, (_, future, enqueued_at) in enumerate(batch):
+            self._latencies.append(now - enqueued_at)
+            if not future.done():
+                future.set_result((indices[i], scores[i]))
+    
+    def stats(self) -> Dict[str, Any]:
+        latencies = np.fromiter(self._latencies, dtype=np.float64)
+        elapsed = time.perf_counter() - self._started_at
+        p50, p99 = (np.percentile(latencies, [50, 99]) * 1000) if latencies.size else (0.0, 0.0)
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "requests_total": self.requests_total,
+            "batches_total": self.batches_total,
+            "errors_total": self.errors_total,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "mean_batch_size": round(self.requests_total / self.batches_total, 2) if self.batches_total else 0.0,
+            "latency_p50_ms": round(float(p50), 3),
+            "latency_p99_ms": round(float(p99), 3),
+            "throughput_per_sec": round(self.requests_total / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+
+class ServingState:
+    """
+    One loaded model bundle and everything derived from it: inference pool,
+    coalescer, feature pipeline, guard registry and ranked importances
+
+    Handlers take the current state once per request and use only that, so a
+    reload never mixes two models within one request. A replaced state is
+    retired only after its last in-flight request has finished.
+    """
+    
+    def __init__(self, bundle: ModelBundle, engine: PredictionEngine, guard_registry: GuardRegistry):
+        self.bundle = bundle
+        self.engine = engine
+        self.guard_registry = guard_registry
+        self.feature_pipeline = bundle.pipeline
+        self.feature_columns = bundle.feature_columns
+        self.guard_fingerprints = bundle.pipeline.encoders['guard_fingerprint'].classes_
+        self.model_version = f"{MODEL_VERSION}+{bundle.version}"
         
-        # Extract guard fingerprints from label encoder
-        guard_fingerprints = encoders['guard_fingerprint'].classes_
+        # Global importances never change for a loaded model, rank them once
+        self.top_feature_importance = rank_global_importance(engine, self.feature_columns, top_n=5)
         
-        print(f"✓ Model loaded successfully")
-        print(f"✓ {len(guard_fingerprints)} guard nodes available")
-        print(f"✓ {len(feature_columns)} features configured")
-        # Load guard/middle/exit metadata from engineered CSV (supports headered or raw positional)
+        self.coalescer = RequestCoalescer(engine)
+        self.active = 0
+        self._idle: Optional[asyncio.Event] = None
+    
+    def start(self):
+        """Create the loop-bound parts; must run on the event loop thread"""
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.coalescer.start()
+    
+    @contextmanager
+    def use(self):
+        """Mark a request in flight on this state"""
+        self.active += 1
+        self._idle.clear()
         try:
-            csv_path = Path(__file__).resolve().parents[1] / 'data' / 'circuit_data_engineered.csv'
-            if not csv_path.exists():
-                print(f"i Metadata CSV not found at {csv_path}; continuing without relay enrichment")
-            else:
-                loaded = 0
-                with open(csv_path, 'r', newline='', encoding='utf-8') as f:
-                    first_line = f.readline()
-                    f.seek(0)
-                    has_header = 'guard_fingerprint' in first_line.lower()
-                    if has_header:
-                        reader = csv.DictReader(f)
-                        for row in reader:
-                            fp = (row.get('guard_fingerprint') or '').strip()
-                            if len(fp) != 40:
-                                continue
-                            guard_meta[fp] = {
-                                'guard_nickname': row.get('guard_nickname') or f"Guard_{fp[:6]}",
-                                'guard_address': row.get('guard_address') or 'Unknown',
-                                'guard_country': row.get('guard_country') or 'Unknown',
-                            }
-                            loaded += 1
-                    else:
-                        reader = csv.reader(f)
-                        for row in reader:
-                            if not row or len(row) < 8:
-                                continue
-                            fp = row[4].strip()
-                            if len(fp) != 40:
-                                continue
-                            nickname = row[5].strip() if len(row) > 5 else ''
-                            ip_addr = row[6].strip() if len(row) > 6 else ''
-                            country = row[7].strip() if len(row) > 7 else ''
-                            guard_meta[fp] = {
-                                'guard_nickname': nickname or f"Guard_{fp[:6]}",
-                                'guard_address': ip_addr or 'Unknown',
-                                'guard_country': country or 'Unknown',
-                            }
-                            loaded += 1
-                print(f"✓ Loaded guard metadata for {loaded} guards from CSV (header: {has_header})")
-        except Exception as e:
-            print(f"⚠ Metadata load failed: {e}")
-        
-    except Exception as e:
-        print(f"✗ Error loading model: {e}")
-        raise
+            yield self
+        finally:
+            self.active -= 1
+            if not self.active:
+                self._idle.set()
+    
+    async def retire(self):
+        """Wait for in-flight requests, then stop the coalescer and inference pool"""
+        if self._idle is not None:
+            await self._idle.wait()
+        await self.coalescer.stop()
+        self.engine.shutdown()
 
 
-def engineer_features(request: PredictionRequest) -> pd.DataFrame:
-    """
-    Replicate feature engineering from training pipeline
-    Creates same 31 features expected by the model
+serving: Optional[ServingState] = None
+# Created on first reload so it binds to the serving loop (Python 3.9 binds at construction)
+reload_lock: Optional[asyncio.Lock] = None
+
+
+def build_serving_state(version: Optional[str] = None) -> ServingState:
     """
+    Load a model bundle (the CURRENT one by default) into a new ServingState
     
-    # Start with basic features - use defaults for guard node (which we're predicting)
-    data = {
-        'guard_bandwidth': 8.5,  # Default typical value
-        'middle_bandwidth': 7.0,
-        'exit_bandwidth': request.bandwidth if request.bandwidth > 0 else 6.5,
-        'circuit_setup_duration': request.setup_time,
-        'total_bytes': request.bandwidth * request.setup_time * 1e6 if request.bandwidth > 0 else 1e7,
-    }
-    
-    # Guard and middle countries (guard is what we're predicting, use placeholder)
-    guard_country = 'US'  # Default placeholder
-    middle_country = request.middle_country if request.middle_country else 'Unknown'
-    exit_country = request.exit_country
-    
-    df = pd.DataFrame([data])
-    
-    # === BANDWIDTH RATIOS ===
-    df['bw_ratio_guard_middle'] = df['guard_bandwidth'] / (df['middle_bandwidth'] + 1e-6)
-    df['bw_ratio_guard_exit'] = df['guard_bandwidth'] / (df['exit_bandwidth'] + 1e-6)
-    df['bw_ratio_middle_exit'] = df['middle_bandwidth'] / (df['exit_bandwidth'] + 1e-6)
-    df['bw_total'] = df['guard_bandwidth'] + df['middle_bandwidth'] + df['exit_bandwidth']
-    df['bw_min'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].min(axis=1)
-    df['bw_max'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].max(axis=1)
-    df['bw_std'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].std(axis=1)
-    
-    # === GEOGRAPHIC FEATURES ===
-    df['same_country_guard_middle'] = int(guard_country == middle_country)
-    df['same_country_guard_exit'] = int(guard_country == exit_country)
-    df['same_country_middle_exit'] = int(middle_country == exit_country)
-    df['all_same_country'] = int((guard_country == middle_country) and (guard_country == exit_country))
-    unique_countries = len(set([guard_country, middle_country, exit_country]))
-    df['country_diversity'] = unique_countries / 3.0
-    
-    # === HISTORICAL FEATURES (using defaults for real-time prediction) ===
-    df['guard_usage_freq'] = 0.5  # Average usage
-    df['middle_usage_freq'] = 0.5
-    df['exit_usage_freq'] = 0.5
-    df['guard_exit_pair_freq'] = 0.1
-    df['guard_avg_bandwidth'] = df['guard_bandwidth']
-    df['guard_middle_pair_freq'] = 0.1
-    df['guard_prefers_exit_country'] = 0.5
-    
-    # === ENCODE CATEGORICAL FEATURES ===
+    Blocking: reloads run it in a worker thread while the old state keeps serving.
+    Nothing here touches the event loop; activate() starts the state on it.
+    """
+    # UBJSON booster(s), memory-mapped encoder vocabularies and lookup tables
+    bundle = load_bundle(MODEL_DIR, version)
+    engine = TwoStageEngine(bundle.ranker) if bundle.ranker is not None else PredictionEngine(bundle.booster)
     try:
-        df['middle_fingerprint_encoded'] = encoders['middle_fingerprint'].transform([request.middle_fingerprint or 'UNKNOWN'])[0]
-    except:
-        df['middle_fingerprint_encoded'] = -1
+        return _serving_state(bundle, engine)
+    except Exception:
+        # A half-built state never serves, so nothing else will shut its pool down
+        engine.shutdown()
+        raise
+
+
+def _serving_state(bundle: ModelBundle, engine: PredictionEngine) -> ServingState:
+    """Guard metadata, registry and ServingState for a loaded bundle and its engine"""
+    pipeline = bundle.pipeline
+    lookups = pipeline.lookups
+    guard_fingerprints = pipeline.encoders['guard_fingerprint'].classes_
     
-    try:
-        df['exit_fingerprint_encoded'] = encoders['exit_fingerprint'].transform([request.exit_fingerprint])[0]
-    except:
-        df['exit_fingerprint_encoded'] = -1
+    print(f"✓ Model bundle {bundle.version} loaded ({engine.workers} inference workers x {engine.nthread} threads)")
+    if bundle.ranker is not None:
+        print(f"✓ Two-stage ranker: {bundle.ranker.n_clusters} guard clusters, shortlist of {bundle.ranker.shortlist_size}")
+    print(f"✓ {len(guard_fingerprints)} guard nodes available")
+    print(f"✓ {len(bundle.feature_columns)} features configured")
+    if lookups is None:
+        print(f"⚠ Historical feature lookups not found in {bundle.path}; using typical values")
+    else:
+        print(f"✓ Historical feature lookups: {len(lookups['exit'][0]) - 1} exits, {len(lookups['middle'][0]) - 1} middles")
     
+    # Guard metadata shipped with the bundle, else the shared artifact
+    # (built from the engineered dataset once if missing or stale)
+    meta = None
     try:
-        df['guard_country_encoded'] = encoders['guard_country'].transform([guard_country])[0]
-    except:
-        df['guard_country_encoded'] = -1
+        if bundle.guard_metadata_path is not None:
+            meta, source = load_guard_metadata(bundle.guard_metadata_path), 'bundle'
+        else:
+            meta, source = load_or_build_guard_metadata(GUARD_META_PATH, METADATA_CSV_PATH)
+        if meta is None:
+            print(f"i Guard metadata not found at {GUARD_META_PATH} or {METADATA_CSV_PATH}; continuing without relay enrichment")
+        else:
+            print(f"✓ Loaded guard metadata for {len(meta)} guards (source: {source})")
+    except Exception as e:
+        print(f"⚠ Metadata load failed: {e}")
     
-    try:
-        df['middle_country_encoded'] = encoders['middle_country'].transform([middle_country])[0]
-    except:
-        df['middle_country_encoded'] = -1
+    # Align metadata columns to guard label indices
+    guard_registry = GuardRegistry(guard_fingerprints, meta)
+    print(f"✓ Guard registry: {guard_registry.enriched}/{len(guard_registry)} guards enriched ({guard_registry.nbytes / 1024:.1f} KB)")
     
+    return ServingState(bundle, engine, guard_registry)
+
+
+def activate(state: ServingState) -> Optional[ServingState]:
+    """Make state the serving one; returns the state it replaced"""
+    global serving
+    state.start()
+    previous, serving = serving, state
+    # Cached results are only valid for the model they came from
+    prediction_cache.invalidate(state.model_version)
+    return previous
+
+
+@app.on_event("startup")
+async def load_model():
+    """Load the current model bundle on startup"""
     try:
-        df['exit_country_encoded'] = encoders['exit_country'].transform([exit_country])[0]
-    except:
-        df['exit_country_encoded'] = -1
+        activate(build_serving_state())
+    except Exception as e:
+        print(f"✗ Error loading model: {e}")
+        raise
+
+
+@app.on_event("shutdown")
+async def shutdown_engine():
+    """Flush the request coalescer and drain the inference thread pool"""
+    if serving is not None:
+        await serving.retire()
+
+
+def request_circuit(request: PredictionRequest) -> Dict[str, Any]:
+    """Capture-style columns of a request; the guard side is imputed by the pipeline"""
+    return {
+        'exit_fingerprint': request.exit_fingerprint,
+        'exit_country': request.exit_country,
+        'middle_fingerprint': request.middle_fingerprint,
+        'middle_country': request.middle_country,
+        'exit_bandwidth': request.bandwidth * BYTES_PER_MB if request.bandwidth > 0 else None,
+        'circuit_setup_duration': request.setup_time,
+    }
+
+
+def engineer_features(state: ServingState, request: PredictionRequest) -> np.ndarray:
+    """
+    Replicate feature engineering from training pipeline
+    Writes the same 31 features expected by the model into a float32 row
+    """
+    return state.feature_pipeline.transform_one(request_circuit(request))
+
+
+def engineer_features_batch(state: ServingState, requests: List[PredictionRequest]) -> np.ndarray:
+    """
+    Batch counterpart of engineer_features
+    Builds every feature row in one NumPy pass, columns ordered as feature_columns
+    """
+    bandwidth = np.array([r.bandwidth for r in requests], dtype=np.float64)
+    return state.feature_pipeline.transform({
+        'exit_fingerprint': [r.exit_fingerprint for r in requests],
+        'exit_country': [r.exit_country for r in requests],
+        'middle_fingerprint': [r.middle_fingerprint for r in requests],
+        'middle_country': [r.middle_country for r in requests],
+        'exit_bandwidth': np.where(bandwidth > 0, bandwidth * BYTES_PER_MB, np.nan),
+        'circuit_setup_duration': [r.setup_time for r in requests],
+    })
+
+
+def build_guard_predictions(guard_registry: GuardRegistry, indices: np.ndarray, scores: np.ndarray) -> List[GuardPrediction]:
+    """Turn one row of ranked guard indices and probabilities into predictions"""
+    return build_guard_predictions_batch(guard_registry, indices[None, :], scores[None, :])[0]
+
+
+def build_guard_predictions_batch(guard_registry: GuardRegistry, indices: np.ndarray,
+                                  scores: np.ndarray) -> List[List[GuardPrediction]]:
+    """Turn (n, k) ranked guard indices and probabilities into per-row predictions"""
     
-    # === INTERACTION FEATURES ===
-    df['bw_guard_x_setup'] = df['guard_bandwidth'] * df['circuit_setup_duration']
-    df['bw_total_x_bytes'] = df['bw_total'] * df['total_bytes']
+    # One vectorized gather per metadata column for the whole batch
+    meta = guard_registry.gather(indices)
+    confidences = scores.tolist()
     
-    # Select only the features used during training
-    X = df[feature_columns]
+    return [
+        [
+            GuardPrediction(
+                guard_fingerprint=fp,
+                guard_nickname=nickname,
+                guard_address=address,
+                guard_country=country,
+                confidence=confidence,
+                rank=rank
+            )
+            for rank, (fp, nickname, address, country, confidence)
+            in enumerate(zip(fps, nicknames, addresses, countries, row_confidences), 1)
+        ]
+        for fps, nicknames, addresses, countries, row_confidences in zip(
+            meta['guard_fingerprint'], meta['guard_nickname'], meta['guard_address'], meta['guard_country'], confidences
+        )
+    ]
+
+
+def get_top_k_predictions(state: ServingState, indices: np.ndarray, scores: np.ndarray, k: int = 10) -> List[GuardPrediction]:
+    """
+    Convert one row of ranked guards (best first) to predictions
     
-    return X
+    Two-stage models rank only their shortlist, so fewer than k may come back.
+    """
+    return build_guard_predictions(state.guard_registry, indices[:k], scores[:k])
 
 
-def get_top_k_predictions(probabilities: np.ndarray, k: int = 10) -> List[GuardPrediction]:
-    """Convert model probabilities to ranked predictions"""
+def rank_global_importance(engine: PredictionEngine, feature_columns: List[str], top_n: int = 5) -> List[Dict[str, Any]]:
+    """
+    Rank the loaded model's global feature importances once
     
-    # Get top-K indices
-    top_k_indices = np.argsort(probabilities[0])[::-1][:k]
+    Keeps the top_n features with non-zero importance, normalized to 0-1
+    """
+    importance = engine.global_importance('weight')
+    order = [i for i in np.argsort(-importance, kind='stable') if importance[i] > 0][:top_n]
+    max_importance = importance[order[0]] if order else 1.0
     
-    predictions = []
-    for rank, idx in enumerate(top_k_indices, 1):
-        guard_fp = guard_fingerprints[idx]
-        confidence = float(probabilities[0][idx])
-        
-        # In production, fetch from database; here we use placeholders
-        meta = guard_meta.get(guard_fp, {})
-        predictions.append(GuardPrediction(
-            guard_fingerprint=guard_fp,
-            guard_nickname=meta.get('guard_nickname') or f"GuardNode{idx:03d}",
-            guard_address=meta.get('guard_address') or "Unknown",
-            guard_country=meta.get('guard_country') or "Unknown",
-            confidence=confidence,
-            rank=rank
-        ))
+    ranked = []
+    for i in order:
+        normalized_imp = float(importance[i] / max_importance)
+        impact = "high" if normalized_imp > 0.7 else "medium" if normalized_imp > 0.4 else "low"
+        ranked.append({'index': int(i), 'feature': feature_columns[i], 'importance': normalized_imp, 'impact': impact})
     
-    return predictions
+    return ranked
 
 
-def get_feature_importance(model, feature_values: pd.DataFrame, top_n: int = 5) -> List[FeatureImportance]:
+def get_feature_importance(state: ServingState, feature_values: np.ndarray) -> List[FeatureImportance]:
     """Extract top feature importance for explainability"""
     
-    # Get feature importance from XGBoost
-    importance_dict = model.get_booster().get_score(importance_type='weight')
-    
-    # Map to feature names
-    feature_importance = []
-    for i, col in enumerate(feature_columns):
-        feat_name = f"f{i}"
-        importance = importance_dict.get(feat_name, 0.0)
-        
-        if importance > 0:
-            value = feature_values[col].iloc[0]
-            feature_importance.append({
-                'feature': col,
-                'importance': importance,
-                'value': value
-            })
-    
-    # Sort by importance and take top N
-    feature_importance.sort(key=lambda x: x['importance'], reverse=True)
-    top_features = feature_importance[:top_n]
-    
-    # Normalize importance to 0-1
-    max_importance = max([f['importance'] for f in top_features]) if top_features else 1.0
-    
-    result = []
-    for feat in top_features:
-        normalized_imp = feat['importance'] / max_importance
-        impact = "high" if normalized_imp > 0.7 else "medium" if normalized_imp > 0.4 else "low"
-        
-        result.append(FeatureImportance(
+    # Importances are fixed per model; only the request's feature values change
+    return [
+        FeatureImportance(
             feature=feat['feature'],
-            importance=normalized_imp,
-            value=feat['value'],
-            impact=impact
-        ))
+            importance=feat['importance'],
+            value=float(feature_values[0, feat['index']]),
+            impact=feat['impact']
+        )
+        for feat in state.top_feature_importance
+    ]
+
+
+async def get_feature_contributions(state: ServingState, X: np.ndarray, class_index: int, top_n: int = 10) -> Dict[str, Any]:
+    """Per-request SHAP contributions towards the top-ranked guard"""
+    
+    contribs = await state.engine.contributions(X, class_index)
+    features, bias = contribs[:-1], contribs[-1]
+    order = np.argsort(-np.abs(features), kind='stable')[:top_n]
     
-    return result
+    return {
+        "guard_fingerprint": str(state.guard_registry.fingerprint[class_index]),
+        "bias": float(bias),
+        "features": [
+            {
+                "feature": state.feature_columns[i],
+                "contribution": float(features[i]),
+                "value": float(X[0, i])
+            }
+            for i in order
+        ]
+    }
 
 
 def generate_topology(limit: int = 40) -> TopologyResponse:
@@ -347,7 +548,7 @@ def generate_topology(limit: int = 40) -> TopologyResponse:
     """
 
     # Fallback if model not loaded yet
-    fingerprints = guard_fingerprints if guard_fingerprints is not None else [f"FAKE{i:04X}" for i in range(200)]
+    fingerprints = serving.guard_fingerprints if serving is not None else [f"FAKE{i:04X}" for i in range(200)]
 
     # Sample unique guard nodes
     sample_size = min(max(10, limit // 3), len(fingerprints))
@@ -421,8 +622,8 @@ async def root():
     return {
         "service": "TGNP API",
         "status": "operational",
-        "model_loaded": model is not None,
-        "guard_count": len(guard_fingerprints) if guard_fingerprints is not None else 0
+        "model_loaded": serving is not None,
+        "guard_count": len(serving.guard_fingerprints) if serving is not None else 0
     }
 
 
@@ -434,23 +635,43 @@ async def predict_guard_nodes(request: PredictionRequest):
     Returns top-K ranked predictions with confidence scores and explainability
     """
     
-    if model is None:
+    state = serving
+    if state is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     start_time = time.time()
     
     try:
-        # Engineer features
-        X = engineer_features(request)
-        
-        # Get predictions
-        probabilities = model.predict_proba(X)
-        
-        # Extract top-10 predictions
-        predictions = get_top_k_predictions(probabilities, k=10)
-        
-        # Get feature importance for explainability
-        top_features = get_feature_importance(model, X, top_n=5)
+        with state.use():
+            # Engineer features
+            X = engineer_features(state, request)
+            
+            # Get predictions: identical feature rows are served from the cache,
+            # misses are coalesced with concurrent requests into one engine call
+            cache_key = prediction_cache.key(X[0])
+            ranked = prediction_cache.get(cache_key)
+            if ranked is None:
+                ranked = await state.coalescer.submit(X[0])
+                # Results of a model swapped out meanwhile would never be hit again
+                if state is serving:
+                    prediction_cache.put(cache_key, *ranked)
+            indices, scores = ranked
+            
+            # Extract top-10 predictions
+            predictions = get_top_k_predictions(state, indices, scores, k=10)
+            
+            # Get feature importance for explainability
+            top_features = get_feature_importance(state, X)
+            explainability = {
+                "top_features": [f.dict() for f in top_features],
+                "total_features": len(state.feature_columns),
+                "model_type": "XGBoost Two-Stage Ranker" if state.bundle.ranker is not None else "XGBoost Multi-Class Classifier"
+            }
+            
+            # Opt-in local explanation for the top-ranked guard
+            if request.explain_contributions:
+                top_class = int(indices[0])
+                explainability["contributions"] = await get_feature_contributions(state, X, top_class)
         
         # Calculate prediction time
         prediction_time_ms = (time.time() - start_time) * 1000
@@ -458,27 +679,129 @@ async def predict_guard_nodes(request: PredictionRequest):
         return PredictionResponse(
             predictions=predictions,
             prediction_time_ms=round(prediction_time_ms, 2),
-            model_version="1.0.0-xgboost",
-            explainability={
-                "top_features": [f.dict() for f in top_features],
-                "total_features": len(feature_columns),
-                "model_type": "XGBoost Multi-Class Classifier"
-            }
+            model_version=state.model_version,
+            explainability=explainability
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
 
 
+@app.post("/api/predict/batch", response_model=BatchPredictionResponse)
+async def predict_guard_nodes_batch(batch: BatchPredictionRequest):
+    """
+    Predict probable guard nodes for many exit events at once
+    
+    Features for the whole batch are built in one pass and ranked with a single
+    engine call; throughput is reported for the batch as a whole
+    """
+    
+    state = serving
+    if state is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    start_time = time.time()
+    
+    try:
+        with state.use():
+            X = engineer_features_batch(state, batch.requests)
+            
+            # Score only the rows that are not already cached
+            cache_keys = [prediction_cache.key(x) for x in X]
+            ranked = [prediction_cache.get(key) for key in cache_keys]
+            misses = [i for i, row in enumerate(ranked) if row is None]
+            if misses:
+                indices, scores = await state.engine.rank(X[misses], MAX_TOP_K)
+                for i, row in zip(misses, zip(indices, scores)):
+                    ranked[i] = row
+                    if state is serving:
+                        prediction_cache.put(cache_keys[i], *row)
+            
+            # Rows are ranked best first; a two-stage model caps k at its shortlist size
+            top_k_indices = np.vstack([indices[:batch.top_k] for indices, _ in ranked])
+            top_k_scores = np.vstack([scores[:batch.top_k] for _, scores in ranked])
+            results = [
+                BatchPredictionItem(index=i, predictions=predictions)
+                for i, predictions in enumerate(build_guard_predictions_batch(state.guard_registry, top_k_indices, top_k_scores))
+            ]
+        
+        elapsed = time.time() - start_time
+        
+        return BatchPredictionResponse(
+            results=results,
+            batch_size=len(results),
+            prediction_time_ms=round(elapsed * 1000, 2),
+            throughput_per_sec=round(len(results) / elapsed, 2) if elapsed > 0 else 0.0,
+            model_version=state.model_version
+        )
+        
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch prediction error: {str(e)}")
+
+
+@app.get("/api/stats")
+async def serving_stats():
+    """Serving counters for tuning the micro-batching window and result cache"""
+    return {
+        "coalescer": serving.coalescer.stats() if serving is not None else None,
+        "prediction_cache": prediction_cache.stats()
+    }
+
+
 @app.get("/api/model/info")
 async def model_info():
     """Get model metadata and statistics"""
+    state = serving
     return {
         "model_type": "XGBoost",
-        "num_classes": len(guard_fingerprints) if guard_fingerprints else 0,
-        "num_features": len(feature_columns) if feature_columns else 0,
-        "feature_list": feature_columns if feature_columns else [],
-        "version": "1.0.0"
+        "num_classes": len(state.guard_fingerprints) if state is not None else 0,
+        "num_features": len(state.feature_columns) if state is not None else 0,
+        "feature_list": state.feature_columns if state is not None else [],
+        "version": "1.0.0",
+        "bundle_version": state.bundle.version if state is not None else None,
+        "bundle_model_type": state.bundle.model_type if state is not None else None,
+        "metrics": state.bundle.metrics if state is not None else {}
+    }
+
+
+@app.post("/api/admin/reload")
+async def reload_model(request: Optional[ReloadRequest] = None, x_admin_token: Optional[str] = Header(default=None)):
+    """
+    Swap in a model bundle without restarting the server
+    
+    The new bundle is loaded in a worker thread while the current model keeps
+    serving, then replaces it in one step. Requests already running finish on
+    the old model before its inference pool is shut down.
+    """
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail="Admin endpoints disabled; set TGNP_ADMIN_TOKEN")
+    if x_admin_token is None or not secrets.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+    
+    version = request.version if request is not None else None
+    start_time = time.time()
+    
+    global reload_lock
+    if reload_lock is None:
+        reload_lock = asyncio.Lock()
+    async with reload_lock:
+        try:
+            state = await asyncio.get_running_loop().run_in_executor(None, build_serving_state, version)
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Reload error: {str(e)}")
+        previous = activate(state)
+    
+    if previous is not None:
+        await previous.retire()
+    
+    return {
+        "bundle_version": state.bundle.version,
+        "previous_version": previous.bundle.version if previous is not None else None,
+        "current_pointer": current_version(MODEL_DIR),
+        "available_bundles": list_bundles(MODEL_DIR),
+        "reload_time_ms": round((time.time() - start_time) * 1000, 2)
     }
 
 
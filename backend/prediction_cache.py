@@ -0,0 +1,109 @@
+"""
+Prediction result cache for the FastAPI backend
+LRU/TTL cache of ranked guard rows keyed on the engineered feature vector
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = int(os.environ.get('TGNP_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+DEFAULT_TTL_SECONDS = float(os.environ.get('TGNP_CACHE_TTL_SECONDS', 300))
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache with per-entry TTL
+
+    Keys hash the float32 feature row together with the model version, so a
+    reloaded model never sees results from its predecessor; invalidate() also
+    drops every entry eagerly to release memory. Each entry is one row's
+    ranked guard indices and scores, best first; memory is bounded by their
+    total size. All access happens on the event loop, so no locking is
+    needed.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self.max_bytes = max(0, max_bytes)
+        self.ttl = ttl_seconds
+        self.model_version = ''
+        self._entries: 'OrderedDict[bytes, tuple]' = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def key(self, row: np.ndarray) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model_version.encode())
+        digest.update(np.ascontiguousarray(row, dtype=np.float32).tobytes())
+        return digest.digest()
+
+    def get(self, key: bytes) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: bytes, indices: np.ndarray, scores: np.ndarray):
+        nbytes = indices.nbytes + scores.nbytes
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+
+        value = (indices.copy(), scores.copy())
+        for array in value:
+            array.setflags(write=False)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._bytes += nbytes
+
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, model_version: str):
+        """Drop all entries and start keying on a new model version"""
+        self._entries.clear()
+        self._bytes = 0
+        self.model_version = model_version
+        self.invalidations += 1
+
+    def _remove(self, key: bytes):
+        _, (indices, scores) = self._entries.pop(key)
+        self._bytes -= indices.nbytes + scores.nbytes
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "model_version": self.model_version,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
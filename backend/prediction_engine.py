@@ -0,0 +1,242 @@
+"""
+Prediction engine for the FastAPI backend
+Runs raw XGBoost Booster inference on a bounded thread pool so request
+handlers never block the event loop
+"""
+
+import asyncio
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import xgboost as xgb
+
+from model_bundle import iteration_range
+from ranking import top_k
+from two_stage import TwoStageRanker
+
+# Thread pool size and per-booster thread count, tunable from the environment
+DEFAULT_WORKERS = int(os.environ.get('TGNP_INFERENCE_WORKERS', min(4, os.cpu_count() or 1)))
+DEFAULT_NTHREAD = int(os.environ.get('TGNP_INFERENCE_NTHREAD', 1))
+
+
+class PredictionEngine:
+    """
+    Thread-safe wrapper around an XGBoost Booster
+
+    Each worker thread checks a private Booster copy out of a pool for the
+    duration of a call, so concurrent requests scale across cores instead of
+    serializing on one model object. Inference goes through inplace_predict on
+    NumPy input, which skips DMatrix construction and the sklearn wrapper.
+    """
+
+    def __init__(self, booster: xgb.Booster, workers: int = DEFAULT_WORKERS, nthread: int = DEFAULT_NTHREAD):
+        self.booster = booster
+        # Score with the trees training was evaluated on (early-stopping best iteration)
+        self.iteration_range = self._iteration_range(booster)
+        self.workers = max(1, workers)
+        self.nthread = max(1, nthread)
+
+        self._pool = queue.Queue()
+        for i in range(self.workers):
+            replica = booster if i == 0 else booster.copy()
+            replica.set_param({'nthread': self.nthread})
+            self._pool.put(replica)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='tgnp-infer')
+        self._importance = {}
+        self._class_boosters = {}
+        self._class_lock = threading.Lock()
+
+    def _iteration_range(self, booster):
+        return iteration_range(booster)
+
+    @classmethod
+    def from_file(cls, model_path: Path, **kwargs) -> 'PredictionEngine':
+        booster = xgb.Booster()
+        booster.load_model(str(model_path))
+        return cls(booster, **kwargs)
+
+    @contextmanager
+    def _checkout(self):
+        replica = self._pool.get()
+        try:
+            yield replica
+        finally:
+            self._pool.put(replica)
+
+    def predict_proba_sync(self, X: np.ndarray) -> np.ndarray:
+        """Class probabilities for every row of X, (n_rows, n_classes)"""
+        with self._checkout() as booster:
+            proba = booster.inplace_predict(X, iteration_range=self.iteration_range)
+        return proba.reshape(X.shape[0], -1)
+
+    async def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Run predict_proba_sync on the inference pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.predict_proba_sync, X)
+
+    def rank_sync(self, X: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k guards per row of X, best first: (indices, scores), both (n_rows, k)"""
+        return top_k(self.predict_proba_sync(X), k)
+
+    async def rank(self, X: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Run rank_sync on the inference pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.rank_sync, X, k)
+
+    @property
+    def feature_names(self) -> List[str]:
+        names = self.booster.feature_names
+        return list(names) if names else [f"f{i}" for i in range(self.booster.num_features())]
+
+    def global_importance(self, importance_type: str = 'weight') -> np.ndarray:
+        """
+        Model-wide feature importance aligned to feature_names
+
+        get_score walks every tree, so the result is computed once per loaded
+        model and reused for all requests.
+        """
+        if importance_type not in self._importance:
+            scores = self.booster.get_score(importance_type=importance_type)
+            importance = np.array([
+                scores.get(name, scores.get(f"f{i}", 0.0)) for i, name in enumerate(self.feature_names)
+            ], dtype=np.float64)
+            importance.setflags(write=False)
+            self._importance[importance_type] = importance
+        return self._importance[importance_type]
+
+    def class_booster(self, class_index: int) -> xgb.Booster:
+        """
+        Single-output booster holding only the trees of one class
+
+        pred_contribs on the multi-class booster runs TreeSHAP over the trees
+        of every class, so its cost grows with the number of guards. A softprob
+        margin is a plain sum of the class's trees plus its base score, so the
+        same trees under an identity-link objective give identical
+        contributions. Built on first use for a class and kept for the model.
+        """
+        with self._class_lock:
+            if class_index not in self._class_boosters:
+                booster = xgb.Booster(model_file=bytearray(self._class_model(class_index)))
+                booster.set_param({'nthread': self.nthread})
+                self._class_boosters[class_index] = booster
+            return self._class_boosters[class_index]
+
+    def _class_model(self, class_index: int) -> bytes:
+        model = json.loads(self.booster.save_raw('json'))
+        learner = model['learner']
+        trees = learner['gradient_booster']['model']
+        param = learner['learner_model_param']
+        n_classes = max(int(param['num_class']), 1)
+
+        # Trees of class_index within the scored iterations (every iteration
+        # adds n_classes * num_parallel_tree trees, tagged by tree_info)
+        end = self.iteration_range[1] or len(trees['iteration_indptr']) - 1
+        selected = [tree for tree, group in zip(trees['trees'][:trees['iteration_indptr'][end]], trees['tree_info'])
+                    if group == class_index]
+        for i, tree in enumerate(selected):
+            tree['id'] = i
+        per_iteration = int(trees['gbtree_model_param']['num_parallel_tree'])
+        trees['trees'] = selected
+        trees['tree_info'] = [0] * len(selected)
+        trees['iteration_indptr'] = list(range(0, len(selected) + 1, per_iteration))
+        trees['gbtree_model_param']['num_trees'] = str(len(selected))
+
+        # XGBoost >= 3 stores one base margin per class, earlier versions one for all
+        base_score = param['base_score'].strip('[]').split(',')
+        param['base_score'] = base_score[class_index if len(base_score) == n_classes else 0]
+        param['num_class'] = '0'
+        learner['objective'] = {'name': 'reg:squarederror', 'reg_loss_param': {'scale_pos_weight': '1'}}
+        # The trees are already cut at the best iteration
+        learner['attributes'].pop('best_iteration', None)
+        learner['attributes'].pop('best_score', None)
+        return json.dumps(model).encode()
+
+    def contributions_sync(self, X: np.ndarray, class_index: int) -> np.ndarray:
+        """
+        Per-feature SHAP contributions of the first row of X towards one class
+
+        Returns an array of n_features + 1 values, the last being the bias.
+        """
+        dmatrix = xgb.DMatrix(X[:1], feature_names=self.booster.feature_names)
+        return self.class_booster(class_index).predict(dmatrix, pred_contribs=True)[0]
+
+    async def contributions(self, X: np.ndarray, class_index: int) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.contributions_sync, X, class_index)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class TwoStageEngine(PredictionEngine):
+    """
+    PredictionEngine for a TwoStageRanker
+
+    The pool holds ranker copies (both boosters copied). Per request only the
+    cluster classifier and the shortlisted candidates are scored, and rank()
+    returns at most shortlist_size guards: the rest were never scored.
+    """
+
+    def _iteration_range(self, ranker):
+        # Each stage applies its own best iteration
+        return None
+
+    @classmethod
+    def from_file(cls, model_dir: Path, **kwargs) -> 'TwoStageEngine':
+        return cls(TwoStageRanker.load(model_dir), **kwargs)
+
+    def predict_proba_sync(self, X: np.ndarray) -> np.ndarray:
+        """Dense scores with 0 outside the shortlist, for offline evaluation only"""
+        with self._checkout() as ranker:
+            return ranker.predict_proba(X)
+
+    def rank_sync(self, X: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k shortlisted guards per row of X, best first; k is capped at the shortlist size"""
+        with self._checkout() as ranker:
+            return ranker.rank(X, k)
+
+    @property
+    def feature_names(self) -> List[str]:
+        return list(self.booster.feature_columns)
+
+    def global_importance(self, importance_type: str = 'weight') -> np.ndarray:
+        """
+        Importance of the request features summed over both stages
+
+        Candidate features (cand_*) are left out: they describe a guard, not
+        the request, so there is no request value to report next to them.
+        """
+        if importance_type not in self._importance:
+            ranker = self.booster
+            importance = np.zeros(len(self.feature_names), dtype=np.float64)
+            for stage in (ranker.stage1, ranker.stage2):
+                scores = stage.get_score(importance_type=importance_type)
+                importance += [scores.get(name, 0.0) for name in self.feature_names]
+            importance.setflags(write=False)
+            self._importance[importance_type] = importance
+        return self._importance[importance_type]
+
+    def contributions_sync(self, X: np.ndarray, class_index: int) -> np.ndarray:
+        """
+        Stage-two SHAP contributions of the first row of X scored against one guard
+
+        Returns n_features + 1 values like the multi-class engine; the
+        contributions of the candidate features are folded into the bias.
+        """
+        with self._checkout() as ranker:
+            row = np.ascontiguousarray(X[:1], dtype=np.float32)
+            candidate = ranker.candidate_features(row, np.array([[class_index]], dtype=np.int32),
+                                                  ranker.cluster_proba(row))
+            dmatrix = xgb.DMatrix(candidate, feature_names=ranker.candidate_columns)
+            contribs = ranker.stage2.predict(dmatrix, pred_contribs=True, strict_shape=True,
+                                             iteration_range=ranker.stage2_trees)[0, 0]
+        n_features = X.shape[1]
+        return np.append(contribs[:n_features], contribs[n_features:].sum())
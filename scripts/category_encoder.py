@@ -0,0 +1,152 @@
+"""
+Category Encoder for TOR Guard Prediction
+Drop-in replacement for sklearn's LabelEncoder with O(1) dict lookups for
+single values and batches, and an explicit code for values never seen during
+training. Vocabularies are stored as
+fixed-width byte arrays that load by memory map.
+"""
+
+import json
+import pickle
+from itertools import repeat
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+UNKNOWN_CODE = -1
+
+ENCODER_DIR_NAME = 'encoders'
+MANIFEST_NAME = 'manifest.json'
+LEGACY_PICKLE_NAME = 'encoders.pkl'
+
+
+class CategoryEncoder:
+    """
+    Sorted vocabulary with hash-based encoding
+
+    Codes are positions in the sorted classes_, exactly as LabelEncoder
+    assigns them, so models trained on LabelEncoder codes stay valid.
+    Values outside the vocabulary encode to UNKNOWN_CODE instead of raising.
+
+    The vocabulary may be a fixed-width bytes array (e.g. memory-mapped
+    S40 fingerprints); it is decoded and indexed on first use, so loading an
+    encoder costs the same whatever the vocabulary size.
+    """
+
+    def __init__(self, classes):
+        self._raw = classes if isinstance(classes, np.ndarray) and classes.dtype.kind == 'S' \
+            else np.asarray(classes, dtype=object)
+        self._classes = None
+        self._codes = None
+
+    @classmethod
+    def fit(cls, values):
+        """Encoder over the distinct non-null values, sorted"""
+        return cls(np.sort(pd.unique(pd.Series(values).dropna().astype(str))))
+
+    @classmethod
+    def from_label_encoder(cls, encoder):
+        """Wrap a fitted sklearn LabelEncoder (or anything with classes_)"""
+        if isinstance(encoder, cls):
+            return encoder
+        return cls(encoder.classes_)
+
+    @property
+    def classes_(self):
+        if self._classes is None:
+            raw = self._raw
+            self._classes = np.char.decode(raw, 'utf-8').astype(object) if raw.dtype.kind == 'S' else raw
+        return self._classes
+
+    @property
+    def classes_bytes(self):
+        """Vocabulary as a fixed-width UTF-8 bytes array"""
+        if self._raw.dtype.kind == 'S':
+            return self._raw
+        return np.char.encode(self._raw.astype(str), 'utf-8')
+
+    def _build_index(self):
+        self._codes = {value: code for code, value in enumerate(self.classes_.tolist())}
+
+    def __len__(self):
+        return len(self._raw)
+
+    def encode(self, value):
+        """Code of a single value (UNKNOWN_CODE if unseen)"""
+        if self._codes is None:
+            self._build_index()
+        return self._codes.get(value, UNKNOWN_CODE)
+
+    def transform(self, values):
+        """
+        Codes of a batch of values as int32 (UNKNOWN_CODE where unseen)
+
+        Plain dict lookups: several times faster than pd.Categorical, which
+        rebuilds a hash table of the categories on every call.
+        """
+        if self._codes is None:
+            self._build_index()
+        values = values.tolist() if hasattr(values, 'tolist') else list(values)
+        return np.fromiter(map(self._codes.get, values, repeat(UNKNOWN_CODE)),
+                           dtype=np.int32, count=len(values))
+
+    def inverse_transform(self, codes):
+        return self.classes_[np.asarray(codes)]
+
+    def __getstate__(self):
+        return {'classes_': self.classes_}
+
+    def __setstate__(self, state):
+        self.__init__(state['classes_'])
+
+
+def as_category_encoders(encoders):
+    """Convert a dict of fitted encoders (e.g. a legacy LabelEncoder pickle)"""
+    return {col: CategoryEncoder.from_label_encoder(encoder) for col, encoder in encoders.items()}
+
+
+def save_encoders(encoders, model_dir):
+    """
+    Write each vocabulary to models/encoders/<column>.npy as fixed-width
+    bytes, plus a manifest of columns, files and sizes
+    """
+    encoder_dir = Path(model_dir) / ENCODER_DIR_NAME
+    encoder_dir.mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    for col, encoder in as_category_encoders(encoders).items():
+        classes = encoder.classes_bytes
+        if classes.dtype.itemsize == 0:
+            classes = classes.astype('S1')
+        filename = f'{col}.npy'
+        np.save(encoder_dir / filename, classes, allow_pickle=False)
+        manifest[col] = {'file': filename, 'n_classes': len(classes), 'dtype': classes.dtype.str}
+    with open(encoder_dir / MANIFEST_NAME, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return encoder_dir
+
+
+def load_encoders(model_dir):
+    """
+    Memory-map the encoder vocabularies written by save_encoders()
+
+    Falls back to a legacy models/encoders.pkl (LabelEncoders or
+    CategoryEncoders) when no manifest exists.
+
+    Returns:
+        (dict of CategoryEncoder, source path)
+    """
+    model_dir = Path(model_dir)
+    manifest_path = model_dir / ENCODER_DIR_NAME / MANIFEST_NAME
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        encoders = {
+            col: CategoryEncoder(np.load(manifest_path.parent / entry['file'], mmap_mode='r', allow_pickle=False))
+            for col, entry in manifest.items()
+        }
+        return encoders, manifest_path.parent
+
+    legacy_path = model_dir / LEGACY_PICKLE_NAME
+    with open(legacy_path, 'rb') as f:
+        return as_category_encoders(pickle.load(f)), legacy_path
@@ -0,0 +1,216 @@
+"""
+Engineered Dataset I/O
+Columnar (Parquet/Feather) storage of the engineered circuit dataset with
+downcast dtypes, plus projected and streaming reads for training, inference
+and the API
+"""
+
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ENGINEERED_STEM = 'circuit_data_engineered'
+# Preferred first when looking for an existing engineered dataset
+FORMAT_SUFFIXES = ['.parquet', '.feather', '.csv']
+
+# Columns stored as int32; everything else numeric becomes float32
+INT32_COLUMNS = {
+    'request_id', 'circuit_id', 'guard_label',
+    'same_country_guard_middle', 'same_country_guard_exit', 'same_country_middle_exit',
+    'all_same_country', 'country_diversity',
+    'guard_usage_freq', 'middle_usage_freq', 'exit_usage_freq',
+    'guard_exit_pair_freq', 'guard_middle_pair_freq', 'guard_prefers_exit_country',
+}
+CATEGORY_SUFFIXES = ('_fingerprint', '_nickname', '_address', '_country')
+CATEGORY_COLUMNS = {'status', 'purpose'}
+
+# Rows per batch when streaming a dataset from disk
+DEFAULT_BATCH_ROWS = 65536
+
+
+def find_engineered(data_dir='data'):
+    """Path of the engineered dataset in the first available format, or None"""
+    for suffix in FORMAT_SUFFIXES:
+        path = Path(data_dir) / f"{ENGINEERED_STEM}{suffix}"
+        if path.exists():
+            return path
+    return None
+
+
+def downcast_engineered(df):
+    """
+    Compact dtypes for storage: int32 codes/counts, float32 features and
+    categorical fingerprints, nicknames, addresses and countries
+    """
+    out = {}
+    for col in df.columns:
+        values = df[col]
+        if col not in INT32_COLUMNS and (col.endswith(CATEGORY_SUFFIXES) or col in CATEGORY_COLUMNS):
+            out[col] = values.astype('category')
+        elif pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            if (col in INT32_COLUMNS or col.endswith('_encoded')) and not values.isna().any():
+                out[col] = values.astype(np.int32)
+            else:
+                out[col] = values.astype(np.float32)
+        else:
+            out[col] = values
+    return pd.DataFrame(out)
+
+
+def engineered_shards(path):
+    """
+    Files making up an engineered dataset: the file itself, or the part
+    files of a shard directory in name order
+    """
+    path = Path(path)
+    if not path.is_dir():
+        return [path]
+    shards = sorted(p for p in path.iterdir() if p.suffix in FORMAT_SUFFIXES)
+    if not shards:
+        raise FileNotFoundError(f"No engineered shards ({', '.join(FORMAT_SUFFIXES)}) in {path}")
+    return shards
+
+
+def engineered_columns(path):
+    """Column names of an engineered dataset without reading its data"""
+    path = engineered_shards(path)[0]
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names
+    if path.suffix == '.feather':
+        import pyarrow as pa
+        with pa.memory_map(str(path)) as source:
+            return pa.ipc.open_file(source).schema.names
+    return list(pd.read_csv(path, nrows=0).columns)
+
+
+def read_engineered(path, columns=None, categorical=True):
+    """
+    Read an engineered dataset, loading only the requested columns
+
+    Args:
+        path: .parquet, .feather or .csv dataset
+        columns: Columns to load (default: all)
+        categorical: Keep string columns as categoricals; False converts
+            them to plain object columns so they compare like CSV strings
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        df = pd.read_parquet(path, columns=columns)
+    elif path.suffix == '.feather':
+        df = pd.read_feather(path, columns=columns)
+    else:
+        return pd.read_csv(path, usecols=columns)
+    if not categorical:
+        df = df.astype({col: object for col in df.select_dtypes('category').columns})
+    return df
+
+
+def iter_engineered(path, columns=None, batch_rows=DEFAULT_BATCH_ROWS):
+    """
+    Stream an engineered dataset (file or shard directory) as DataFrames of
+    at most batch_rows rows, loading only the requested columns
+
+    Parquet is read row group by row group and CSV in chunks; a Feather file
+    is read one record batch at a time.
+    """
+    for shard in engineered_shards(path):
+        if shard.suffix == '.parquet':
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(shard).iter_batches(batch_size=batch_rows, columns=columns):
+                yield batch.to_pandas()
+        elif shard.suffix == '.feather':
+            import pyarrow as pa
+            with pa.memory_map(str(shard)) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i)
+                    if columns is not None:
+                        batch = batch.select(columns)
+                    for part in pa.Table.from_batches([batch]).to_batches(max_chunksize=batch_rows):
+                        yield part.to_pandas()
+        else:
+            yield from pd.read_csv(shard, usecols=columns, chunksize=batch_rows)
+
+
+class EngineeredWriter:
+    """
+    Write engineered chunks to CSV, Parquet or Feather (chosen by suffix)
+
+    Parquet chunks are appended as row groups under the schema of the first
+    chunk; categorical columns use int32 dictionary indices so every chunk
+    fits that schema regardless of its own category count. Feather is an
+    Arrow IPC file and cannot replace dictionaries between batches, so it
+    only accepts a single chunk.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if self.path.suffix not in FORMAT_SUFFIXES:
+            raise ValueError(f"Unsupported engineered dataset format: {self.path.suffix}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._writer = None
+        self._schema = None
+        self._chunks = 0
+
+    def write(self, chunk):
+        if self.path.suffix == '.csv':
+            chunk.to_csv(self.path, mode='w' if self._chunks == 0 else 'a', header=(self._chunks == 0), index=False)
+        elif self.path.suffix == '.feather':
+            if self._chunks:
+                raise ValueError("Feather output cannot be written in chunks; use .parquet or .csv")
+            downcast_engineered(chunk).reset_index(drop=True).to_feather(self.path)
+        else:
+            self._write_parquet(downcast_engineered(chunk))
+        self._chunks += 1
+
+    def _write_parquet(self, chunk):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if self._writer is None:
+            self._schema = pa.schema(
+                [pa.field(f.name, pa.dictionary(pa.int32(), f.type.value_type))
+                 if pa.types.is_dictionary(f.type) else f for f in table.schema],
+                metadata=table.schema.metadata,
+            )
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        self._writer.write_table(table.cast(self._schema))
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def concat_engineered(part_paths, output_path):
+    """Concatenate engineered part files (same format) into output_path, in order"""
+    output_path = Path(output_path)
+    if output_path.suffix == '.csv':
+        with open(output_path, 'wb') as out:
+            for i, part_path in enumerate(part_paths):
+                with open(part_path, 'rb') as part:
+                    if i > 0:
+                        part.readline()
+                    shutil.copyfileobj(part, out)
+        return
+
+    if output_path.suffix == '.feather':
+        frames = [read_engineered(p) for p in part_paths]
+        downcast_engineered(pd.concat(frames, ignore_index=True)).to_feather(output_path)
+        return
+
+    import pyarrow.parquet as pq
+    with EngineeredWriter(output_path) as writer:
+        for part_path in part_paths:
+            for batch in pq.ParquetFile(part_path).iter_batches():
+                writer.write(batch.to_pandas())
@@ -0,0 +1,78 @@
+"""
+Ranking Evaluation for Guard Node Prediction
+Top-K accuracy, MRR@K and rank histograms derived from a single rank vector
+"""
+
+import numpy as np
+
+from ranking import true_label_ranks
+
+DEFAULT_K_VALUES = [1, 3, 5, 10, 20, 50, 100]
+
+# Histogram buckets as (label, first rank, last rank)
+RANK_BUCKETS = [
+    ('1', 1, 1),
+    ('2', 2, 2),
+    ('3', 3, 3),
+    ('4-5', 4, 5),
+    ('6-10', 6, 10),
+    ('11-20', 11, 20),
+    ('21-50', 21, 50),
+    ('51-100', 51, 100),
+    ('>100', 101, np.inf),
+]
+
+
+def compute_ranks(y_true, y_pred_proba):
+    """1-based rank of the true label for every row, computed in one vectorized pass"""
+    return true_label_ranks(y_pred_proba, y_true)
+
+
+def topk_accuracy(ranks, k_values=DEFAULT_K_VALUES):
+    """Top-K accuracy for every K from the rank vector"""
+    ranks = np.asarray(ranks)
+    return {f'Top-{k}': float(np.mean(ranks <= k)) for k in k_values}
+
+
+def mean_reciprocal_rank(ranks, k=None):
+    """MRR (or MRR@K when k is given: ranks beyond K contribute 0)"""
+    ranks = np.asarray(ranks, dtype=np.float64)
+    reciprocal = 1.0 / ranks
+    if k is not None:
+        reciprocal = np.where(ranks <= k, reciprocal, 0.0)
+    return float(np.mean(reciprocal))
+
+
+def rank_histogram(ranks):
+    """Count of true labels falling in each rank bucket"""
+    ranks = np.asarray(ranks)
+    edges = np.array([first for _, first, _ in RANK_BUCKETS[1:]])
+    counts = np.bincount(np.searchsorted(edges, ranks, side='right'), minlength=len(RANK_BUCKETS))
+    return {label: int(count) for (label, _, _), count in zip(RANK_BUCKETS, counts)}
+
+
+def evaluate_ranking(y_true, y_pred_proba, k_values=DEFAULT_K_VALUES):
+    """
+    Full ranking report for a probability matrix
+
+    Args:
+        y_true: Integer labels of shape (n_samples,)
+        y_pred_proba: Array of shape (n_samples, n_classes)
+        k_values: Cutoffs for Top-K accuracy and MRR@K
+
+    Returns:
+        Dictionary with topk_accuracy, mrr, mrr_at_k, rank_histogram and mean_rank
+    """
+    return evaluate_ranks(compute_ranks(y_true, y_pred_proba), k_values)
+
+
+def evaluate_ranks(ranks, k_values=DEFAULT_K_VALUES):
+    """Ranking report from precomputed true-label ranks (e.g. gathered batch by batch)"""
+    ranks = np.asarray(ranks)
+    return {
+        'topk_accuracy': topk_accuracy(ranks, k_values),
+        'mrr': mean_reciprocal_rank(ranks),
+        'mrr_at_k': {f'MRR@{k}': mean_reciprocal_rank(ranks, k) for k in k_values},
+        'rank_histogram': rank_histogram(ranks),
+        'mean_rank': float(np.mean(ranks)),
+    }
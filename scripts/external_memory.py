@@ -0,0 +1,127 @@
+"""
+External-Memory Training Data for TOR Guard Prediction
+xgboost.DataIter over engineered Parquet/CSV shards, so training streams
+batches from disk into a QuantileDMatrix or an external-memory DMatrix
+instead of holding the whole dataset in pandas
+"""
+
+import numpy as np
+import xgboost as xgb
+from sklearn.model_selection import train_test_split
+
+from dataset_io import DEFAULT_BATCH_ROWS, iter_engineered
+
+LABEL_COLUMN = 'guard_label'
+
+SPLIT_TRAIN, SPLIT_VAL, SPLIT_TEST = 0, 1, 2
+SPLIT_NAMES = {SPLIT_TRAIN: 'train', SPLIT_VAL: 'val', SPLIT_TEST: 'test'}
+
+
+def read_labels(data_path, batch_rows=DEFAULT_BATCH_ROWS):
+    """Guard labels of every row, streamed from disk (4 bytes per circuit)"""
+    return np.concatenate([
+        batch[LABEL_COLUMN].to_numpy(dtype=np.int32)
+        for batch in iter_engineered(data_path, columns=[LABEL_COLUMN], batch_rows=batch_rows)
+    ])
+
+
+def split_indices(labels, random_state=42):
+    """
+    Row indices of the 70/15/15 stratified train/val/test split
+
+    Indices come back in train_test_split's shuffled order, so gathering
+    rows with them reproduces splitting the DataFrame itself.
+    """
+    labels = np.asarray(labels)
+    index = np.arange(len(labels))
+    temp_index, test_index = train_test_split(
+        index, test_size=0.15, random_state=random_state, stratify=labels
+    )
+    train_index, val_index = train_test_split(
+        temp_index, test_size=0.176, random_state=random_state, stratify=labels[temp_index]  # 0.176 * 0.85 ≈ 0.15
+    )
+    return train_index, val_index, test_index
+
+
+def split_assignments(labels, random_state=42):
+    """
+    SPLIT_TRAIN/VAL/TEST code per row for the 70/15/15 stratified split
+
+    Same split as the in-memory training path, so each circuit lands in the
+    same split either way.
+    """
+    train_index, val_index, test_index = split_indices(labels, random_state)
+    split = np.empty(len(labels), dtype=np.int8)
+    split[train_index] = SPLIT_TRAIN
+    split[val_index] = SPLIT_VAL
+    split[test_index] = SPLIT_TEST
+    return split
+
+
+def iter_split(data_path, feature_cols, split, which, batch_rows=DEFAULT_BATCH_ROWS):
+    """
+    Yield (X float32, y int32) batches of the rows assigned to one split
+
+    Missing feature values are filled with 0, as in the in-memory path.
+    """
+    offset = 0
+    for batch in iter_engineered(data_path, columns=feature_cols + [LABEL_COLUMN], batch_rows=batch_rows):
+        mask = split[offset:offset + len(batch)] == which
+        offset += len(batch)
+        if not mask.any():
+            continue
+        X = batch[feature_cols].to_numpy(dtype=np.float32)[mask]
+        X[np.isnan(X)] = 0.0
+        yield X, batch[LABEL_COLUMN].to_numpy(dtype=np.int32)[mask]
+
+
+class ShardIter(xgb.DataIter):
+    """
+    DataIter feeding one split of an on-disk dataset to XGBoost
+
+    XGBoost calls next() until it returns False and reset() before every
+    further pass; only one batch is held in memory at a time. With a
+    cache_prefix the DMatrix built from it pages to disk (external memory);
+    without one a QuantileDMatrix keeps only the quantized histogram bins.
+    """
+
+    def __init__(self, data_path, feature_cols, split, which, batch_rows=DEFAULT_BATCH_ROWS, cache_prefix=None):
+        self.data_path = data_path
+        self.feature_cols = list(feature_cols)
+        self.split = split
+        self.which = which
+        self.batch_rows = batch_rows
+        self._batches = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._batches is None:
+            self._batches = iter_split(self.data_path, self.feature_cols, self.split, self.which, self.batch_rows)
+        batch = next(self._batches, None)
+        if batch is None:
+            return False
+        X, y = batch
+        input_data(data=X, label=y, feature_names=self.feature_cols)
+        return True
+
+    def reset(self):
+        self._batches = None
+
+
+def build_dmatrix(data_path, feature_cols, split, which, mode='quantile', batch_rows=DEFAULT_BATCH_ROWS,
+                  cache_dir=None, ref=None, max_bin=256):
+    """
+    DMatrix over one split, streamed from disk
+
+    Args:
+        mode: 'quantile' for a QuantileDMatrix (quantized bins in memory,
+            ref gives validation data the training bins) or 'external' for
+            an external-memory DMatrix paged through cache_dir
+    """
+    if mode == 'quantile':
+        return xgb.QuantileDMatrix(ShardIter(data_path, feature_cols, split, which, batch_rows),
+                                   ref=ref, max_bin=max_bin)
+    if mode == 'external':
+        cache_prefix = str(cache_dir / SPLIT_NAMES[which]) if cache_dir is not None else SPLIT_NAMES[which]
+        return xgb.DMatrix(ShardIter(data_path, feature_cols, split, which, batch_rows, cache_prefix=cache_prefix))
+    raise ValueError(f"Unknown DMatrix mode: {mode}")
@@ -0,0 +1,117 @@
+"""
+Historical Feature Lookup Tables
+Per-exit and per-middle means of the historical features, indexed by label
+encoder code, so the API can serve the same feature values the model saw in
+training with one row gather per request
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+# Per-exit table: statistics of the circuits that used each exit relay.
+# The guard_* columns are expectations over the (unknown) guard given the exit.
+EXIT_COLUMNS = ['exit_usage_freq', 'exit_bandwidth', 'total_bytes', 'guard_bandwidth',
+                'guard_usage_freq', 'guard_exit_pair_freq', 'guard_avg_bandwidth',
+                'guard_prefers_exit_country']
+MIDDLE_COLUMNS = ['middle_usage_freq', 'middle_bandwidth', 'guard_middle_pair_freq']
+
+TABLES = {
+    'exit': ('exit_fingerprint', EXIT_COLUMNS),
+    'middle': ('middle_fingerprint', MIDDLE_COLUMNS),
+}
+
+MANIFEST_NAME = 'feature_lookups.json'
+
+
+class FeatureLookupBuilder:
+    """
+    Accumulates per-code sums and counts over engineered chunks
+
+    Mergeable like FeatureStatistics, so the tables can be gathered chunk by
+    chunk or per file in a process pool.
+    """
+
+    def __init__(self, encoders):
+        self.sizes = {name: len(encoders[index]) for name, (index, _) in TABLES.items()}
+        self.sums = {name: np.zeros((size, len(TABLES[name][1]))) for name, size in self.sizes.items()}
+        self.counts = {name: np.zeros(size, dtype=np.int64) for name, size in self.sizes.items()}
+
+    def update(self, chunk):
+        """Fold in a chunk of engineered circuits"""
+        for name, (index, columns) in TABLES.items():
+            codes = chunk[f'{index}_encoded'].to_numpy()
+            size = self.sizes[name]
+            self.counts[name] += np.bincount(codes, minlength=size)
+            for j, col in enumerate(columns):
+                values = chunk[col].to_numpy(dtype=np.float64)
+                self.sums[name][:, j] += np.bincount(codes, weights=values, minlength=size)
+        return self
+
+    def merge(self, other):
+        for name in TABLES:
+            self.sums[name] += other.sums[name]
+            self.counts[name] += other.counts[name]
+        return self
+
+    def build(self):
+        """
+        Lookup tables of shape (n_classes + 1, n_columns), float32
+
+        Row i holds the means for encoder code i; the extra last row holds the
+        global means, so unseen values (encoded as -1) gather it directly.
+        Codes without circuits also fall back to the global means.
+
+        Returns:
+            {table name: (array, column names)}, as load_feature_lookups()
+        """
+        tables = {}
+        for name in TABLES:
+            sums, counts = self.sums[name], self.counts[name]
+            global_mean = sums.sum(axis=0) / max(1, counts.sum())
+            table = np.empty((len(counts) + 1, sums.shape[1]), dtype=np.float32)
+            seen = counts > 0
+            table[:-1] = global_mean
+            table[:-1][seen] = sums[seen] / counts[seen, None]
+            table[-1] = global_mean
+            tables[name] = (table, TABLES[name][1])
+        return tables
+
+
+def build_feature_lookups(df, encoders):
+    """Lookup tables from a whole engineered DataFrame"""
+    return FeatureLookupBuilder(encoders).update(df).build()
+
+
+def save_feature_lookups(tables, model_dir):
+    """Write <table>_lookup.npy arrays plus a JSON manifest of their columns"""
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    for name, (table, columns) in tables.items():
+        index = TABLES[name][0]
+        filename = f'{name}_lookup.npy'
+        np.save(model_dir / filename, np.ascontiguousarray(table), allow_pickle=False)
+        manifest[name] = {'file': filename, 'index': index, 'n_classes': len(table) - 1, 'columns': columns}
+    with open(model_dir / MANIFEST_NAME, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_feature_lookups(model_dir):
+    """
+    Memory-map the lookup tables
+
+    Returns:
+        {table name: (array, column names)}, or None if not exported
+    """
+    model_dir = Path(model_dir)
+    manifest_path = model_dir / MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return {
+        name: (np.load(model_dir / entry['file'], mmap_mode='r', allow_pickle=False), entry['columns'])
+        for name, entry in manifest.items()
+    }
@@ -0,0 +1,165 @@
+"""
+Mergeable Feature Statistics for TOR Guard Prediction
+Frequency tables and vocabularies behind the historical/encoded features,
+accumulated chunk by chunk so feature engineering can stream datasets that
+do not fit in memory
+"""
+
+import numpy as np
+import pandas as pd
+
+from category_encoder import CategoryEncoder
+from feature_pipeline import bandwidth_features, geographic_features, interaction_features
+
+# Columns label-encoded as model inputs (guard_fingerprint is the target)
+CATEGORICAL_COLUMNS = ['middle_fingerprint', 'exit_fingerprint',
+                       'guard_country', 'middle_country', 'exit_country']
+COUNTED_COLUMNS = ['guard_fingerprint'] + CATEGORICAL_COLUMNS
+PAIRS = [('guard_fingerprint', 'exit_fingerprint'),
+         ('guard_fingerprint', 'middle_fingerprint'),
+         ('guard_fingerprint', 'exit_country')]
+
+
+def _add_counts(total, part):
+    """Sum two count Series aligned on their index"""
+    if total is None or total.empty:
+        return part.copy()
+    if part.empty:
+        return total
+    return total.add(part, fill_value=0).astype(total.dtype)
+
+
+def add_row_features(df):
+    """Bandwidth and geographic features computed from each circuit alone (shared pipeline kernels)"""
+    guard_bw, middle_bw, exit_bw = (df[col].to_numpy(dtype=np.float64)
+                                    for col in ['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth'])
+    countries = (df[col].to_numpy(dtype=object) for col in ['guard_country', 'middle_country', 'exit_country'])
+
+    # A. Bandwidth features (7 features)
+    for name, values in bandwidth_features(guard_bw, middle_bw, exit_bw).items():
+        df[name] = values
+
+    # B. Geographic features (5 features)
+    for name, values in geographic_features(*countries).items():
+        df[name] = values.astype(int)
+    return df
+
+
+class FeatureStatistics:
+    """
+    Relay/pair frequency tables and encoder vocabularies
+
+    update() folds in a chunk of raw circuits and merge() combines statistics
+    gathered separately, so the tables can be built in one streaming pass (or
+    per file, in parallel) and then applied to every chunk with transform().
+    Memory grows with the number of distinct relays and pairs, not circuits.
+    """
+
+    def __init__(self):
+        self.n_rows = 0
+        self.value_counts = {col: pd.Series(dtype='int64') for col in COUNTED_COLUMNS}
+        self.pair_counts = {pair: pd.Series(dtype='int64') for pair in PAIRS}
+        self.guard_bandwidth_sum = pd.Series(dtype='float64')
+        self.guard_bandwidth_count = pd.Series(dtype='int64')
+
+    @classmethod
+    def from_frame(cls, df):
+        return cls().update(df)
+
+    def update(self, chunk):
+        """Accumulate the counts of a chunk of raw circuits"""
+        self.n_rows += len(chunk)
+        for col in COUNTED_COLUMNS:
+            self.value_counts[col] = _add_counts(self.value_counts[col], chunk[col].value_counts())
+        for pair in PAIRS:
+            self.pair_counts[pair] = _add_counts(self.pair_counts[pair], chunk.groupby(list(pair)).size())
+
+        bw = chunk.groupby('guard_fingerprint')['guard_bandwidth'].agg(['sum', 'count'])
+        self.guard_bandwidth_sum = _add_counts(self.guard_bandwidth_sum, bw['sum'].astype('float64'))
+        self.guard_bandwidth_count = _add_counts(self.guard_bandwidth_count, bw['count'].astype('int64'))
+        return self
+
+    def merge(self, other):
+        """Fold another FeatureStatistics (e.g. from another file) into this one"""
+        self.n_rows += other.n_rows
+        for col in COUNTED_COLUMNS:
+            self.value_counts[col] = _add_counts(self.value_counts[col], other.value_counts[col])
+        for pair in PAIRS:
+            self.pair_counts[pair] = _add_counts(self.pair_counts[pair], other.pair_counts[pair])
+        self.guard_bandwidth_sum = _add_counts(self.guard_bandwidth_sum, other.guard_bandwidth_sum)
+        self.guard_bandwidth_count = _add_counts(self.guard_bandwidth_count, other.guard_bandwidth_count)
+        return self
+
+    def guard_avg_bandwidth(self):
+        return self.guard_bandwidth_sum / self.guard_bandwidth_count
+
+    def guard_top_exit_country(self):
+        """
+        Most frequent exit country per guard
+
+        Ties resolve to the alphabetically first country so the result does
+        not depend on row order or chunking.
+        """
+        counts = self.pair_counts[('guard_fingerprint', 'exit_country')]
+        if counts.empty:
+            return pd.Series(dtype=object)
+        top = counts.sort_index().groupby(level=0).idxmax()
+        return pd.Series([country for _, country in top], index=top.index)
+
+    def fit_encoders(self):
+        """CategoryEncoders over the full vocabularies, including the guard target encoder"""
+        return {col: CategoryEncoder.fit(self.value_counts[col].index)
+                for col in CATEGORICAL_COLUMNS + ['guard_fingerprint']}
+
+    def pair_frequency(self, df, pair):
+        """Count of each row's pair in the accumulated table, 0 if unseen"""
+        counts = self.pair_counts[pair]
+        keys = pd.MultiIndex.from_arrays([df[pair[0]], df[pair[1]]])
+        return counts.reindex(keys).fillna(0).astype('int64').to_numpy()
+
+    def transform(self, df, encoders, verbose=False):
+        """
+        Add all engineered features to a chunk of raw circuits
+
+        Args:
+            df: Raw circuit rows (modified in place)
+            encoders: Output of fit_encoders()
+            verbose: Print stage progress
+
+        Returns:
+            The chunk with engineered feature and guard_label columns
+        """
+        if verbose:
+            print("\n[1/5] Creating bandwidth features...")
+            print("[2/5] Creating geographic features...")
+        add_row_features(df)
+
+        # C. Historical/Aggregate features (8 features)
+        if verbose:
+            print("[3/5] Creating historical aggregate features...")
+        df['guard_usage_freq'] = df['guard_fingerprint'].map(self.value_counts['guard_fingerprint'])
+        df['middle_usage_freq'] = df['middle_fingerprint'].map(self.value_counts['middle_fingerprint'])
+        df['exit_usage_freq'] = df['exit_fingerprint'].map(self.value_counts['exit_fingerprint'])
+        df['guard_exit_pair_freq'] = self.pair_frequency(df, ('guard_fingerprint', 'exit_fingerprint'))
+        df['guard_avg_bandwidth'] = df['guard_fingerprint'].map(self.guard_avg_bandwidth())
+        df['guard_middle_pair_freq'] = self.pair_frequency(df, ('guard_fingerprint', 'middle_fingerprint'))
+        df['guard_prefers_exit_country'] = (
+            df['exit_country'] == df['guard_fingerprint'].map(self.guard_top_exit_country()).fillna('')
+        ).astype(int)
+
+        # D. Label Encoding (5 features + target)
+        if verbose:
+            print("[4/5] Encoding categorical features...")
+        for col in CATEGORICAL_COLUMNS:
+            df[f'{col}_encoded'] = encoders[col].transform(df[col])
+        df['guard_label'] = encoders['guard_fingerprint'].transform(df['guard_fingerprint'])
+
+        # E. Interaction features (2 features)
+        if verbose:
+            print("[5/5] Creating interaction features...")
+        interactions = interaction_features(df['guard_bandwidth'].to_numpy(dtype=np.float64), df['bw_total'].to_numpy(),
+                                            df['circuit_setup_duration'].to_numpy(dtype=np.float64),
+                                            df['total_bytes'].to_numpy(dtype=np.float64))
+        for name, values in interactions.items():
+            df[name] = values
+        return df
@@ -0,0 +1,273 @@
+"""
+Incremental Feature Store for TOR Guard Prediction
+SQLite store of the frequency tables behind the historical features, updated
+one capture at a time and materialized into FeatureStatistics for any snapshot
+"""
+
+import sqlite3
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from feature_statistics import COUNTED_COLUMNS, PAIRS, FeatureStatistics
+
+DEFAULT_STORE_PATH = Path('data/feature_store.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    capture_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    n_rows INTEGER NOT NULL,
+    ingested_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vocab (
+    column_name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    code INTEGER NOT NULL,
+    PRIMARY KEY (column_name, value)
+);
+CREATE TABLE IF NOT EXISTS value_counts (
+    capture_id INTEGER NOT NULL,
+    column_name TEXT NOT NULL,
+    code INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pair_counts (
+    capture_id INTEGER NOT NULL,
+    pair TEXT NOT NULL,
+    left_code INTEGER NOT NULL,
+    right_code INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS guard_bandwidth (
+    capture_id INTEGER NOT NULL,
+    code INTEGER NOT NULL,
+    bandwidth_sum REAL NOT NULL,
+    bandwidth_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS value_counts_capture ON value_counts (capture_id);
+CREATE INDEX IF NOT EXISTS pair_counts_capture ON pair_counts (capture_id);
+CREATE INDEX IF NOT EXISTS guard_bandwidth_capture ON guard_bandwidth (capture_id);
+"""
+
+
+def _pair_name(pair):
+    return f"{pair[0]}|{pair[1]}"
+
+
+class FeatureStore:
+    """
+    Per-capture frequency deltas keyed by encoded relay/country codes
+
+    Each ingested capture contributes one batch of delta counts, so adding a
+    capture reads only its own circuits. Relays and countries are encoded once
+    into store codes (append-only, never reassigned) and the count tables hold
+    integers only. A snapshot is a capture id: materialize(snapshot) sums the
+    deltas of every capture up to and including it.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def captures(self):
+        """Ingested captures in snapshot order"""
+        return pd.read_sql_query(
+            "SELECT capture_id, name, n_rows, ingested_at FROM captures ORDER BY capture_id", self.conn
+        )
+
+    def latest_snapshot(self):
+        row = self.conn.execute("SELECT MAX(capture_id) FROM captures").fetchone()
+        return row[0]
+
+    def has_capture(self, name):
+        return self.conn.execute("SELECT 1 FROM captures WHERE name = ?", (str(name),)).fetchone() is not None
+
+    def _encode(self, column, values):
+        """Store codes for an index of values, assigning new codes to unseen ones"""
+        known = dict(self.conn.execute(
+            "SELECT value, code FROM vocab WHERE column_name = ?", (column,)
+        ).fetchall())
+        new_values = [v for v in pd.unique(values.astype(str)) if v not in known]
+        if new_values:
+            start = len(known)
+            rows = [(column, v, start + i) for i, v in enumerate(new_values)]
+            self.conn.executemany("INSERT INTO vocab (column_name, value, code) VALUES (?, ?, ?)", rows)
+            known.update((v, code) for _, v, code in rows)
+        return values.astype(str).map(known).to_numpy()
+
+    def ingest_statistics(self, name, stats):
+        """
+        Record the counts of one capture as a new snapshot
+
+        Returns:
+            The new capture id, or None if a capture with this name exists
+        """
+        name = str(name)
+        if self.has_capture(name):
+            return None
+
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO captures (name, n_rows, ingested_at) VALUES (?, ?, ?)",
+                (name, int(stats.n_rows), time.time()),
+            )
+            capture_id = cur.lastrowid
+
+            for col in COUNTED_COLUMNS:
+                counts = stats.value_counts[col]
+                codes = self._encode(col, counts.index)
+                self.conn.executemany(
+                    "INSERT INTO value_counts VALUES (?, ?, ?, ?)",
+                    zip([capture_id] * len(counts), [col] * len(counts), codes.tolist(), counts.tolist()),
+                )
+
+            for pair in PAIRS:
+                counts = stats.pair_counts[pair]
+                if counts.empty:
+                    continue
+                left = self._encode(pair[0], counts.index.get_level_values(0))
+                right = self._encode(pair[1], counts.index.get_level_values(1))
+                self.conn.executemany(
+                    "INSERT INTO pair_counts VALUES (?, ?, ?, ?, ?)",
+                    zip([capture_id] * len(counts), [_pair_name(pair)] * len(counts),
+                        left.tolist(), right.tolist(), counts.tolist()),
+                )
+
+            codes = self._encode('guard_fingerprint', stats.guard_bandwidth_sum.index)
+            counts = stats.guard_bandwidth_count.reindex(stats.guard_bandwidth_sum.index)
+            self.conn.executemany(
+                "INSERT INTO guard_bandwidth VALUES (?, ?, ?, ?)",
+                zip([capture_id] * len(codes), codes.tolist(),
+                    stats.guard_bandwidth_sum.tolist(), counts.tolist()),
+            )
+        return capture_id
+
+    def ingest(self, data_path, chunksize=0, name=None):
+        """
+        Add one raw capture CSV, reading only that capture
+
+        The capture is identified by its file name unless name is given;
+        ingesting the same capture twice is a no-op.
+        """
+        data_path = Path(data_path)
+        name = name or data_path.name
+        if self.has_capture(name):
+            return None
+
+        stats = FeatureStatistics()
+        chunks = pd.read_csv(data_path, chunksize=chunksize) if chunksize > 0 else [pd.read_csv(data_path)]
+        for chunk in chunks:
+            stats.update(chunk)
+        return self.ingest_statistics(name, stats)
+
+    def _vocab(self, column):
+        rows = self.conn.execute(
+            "SELECT code, value FROM vocab WHERE column_name = ? ORDER BY code", (column,)
+        ).fetchall()
+        return pd.Series([v for _, v in rows], index=[c for c, _ in rows], dtype=object)
+
+    def materialize(self, snapshot=None):
+        """
+        FeatureStatistics over every capture up to and including snapshot
+
+        Args:
+            snapshot: Capture id (default: latest)
+
+        Returns:
+            FeatureStatistics, usable with fit_encoders() and transform()
+        """
+        if snapshot is None:
+            snapshot = self.latest_snapshot()
+        stats = FeatureStatistics()
+        if snapshot is None:
+            return stats
+
+        stats.n_rows = self.conn.execute(
+            "SELECT COALESCE(SUM(n_rows), 0) FROM captures WHERE capture_id <= ?", (snapshot,)
+        ).fetchone()[0]
+        vocab = {col: self._vocab(col) for col in COUNTED_COLUMNS}
+
+        for col in COUNTED_COLUMNS:
+            rows = self.conn.execute(
+                "SELECT code, SUM(count) FROM value_counts WHERE column_name = ? AND capture_id <= ? "
+                "GROUP BY code ORDER BY code", (col, snapshot),
+            ).fetchall()
+            codes = [c for c, _ in rows]
+            stats.value_counts[col] = pd.Series(
+                [n for _, n in rows], index=pd.Index(vocab[col][codes].to_numpy(), name=col), dtype='int64'
+            )
+
+        for pair in PAIRS:
+            rows = self.conn.execute(
+                "SELECT left_code, right_code, SUM(count) FROM pair_counts WHERE pair = ? AND capture_id <= ? "
+                "GROUP BY left_code, right_code", (_pair_name(pair), snapshot),
+            ).fetchall()
+            index = pd.MultiIndex.from_arrays(
+                [vocab[pair[0]][[r[0] for r in rows]].to_numpy(), vocab[pair[1]][[r[1] for r in rows]].to_numpy()],
+                names=list(pair),
+            )
+            stats.pair_counts[pair] = pd.Series([r[2] for r in rows], index=index, dtype='int64').sort_index()
+
+        rows = self.conn.execute(
+            "SELECT code, SUM(bandwidth_sum), SUM(bandwidth_count) FROM guard_bandwidth WHERE capture_id <= ? "
+            "GROUP BY code ORDER BY code", (snapshot,),
+        ).fetchall()
+        index = pd.Index(vocab['guard_fingerprint'][[r[0] for r in rows]].to_numpy(), name='guard_fingerprint')
+        stats.guard_bandwidth_sum = pd.Series([r[1] for r in rows], index=index, dtype='float64')
+        stats.guard_bandwidth_count = pd.Series([r[2] for r in rows], index=index, dtype='int64')
+        return stats
+
+
+def main():
+    """Ingest captures into the feature store and list its snapshots"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Incrementally update the historical feature store with new captures'
+    )
+    parser.add_argument('inputs', nargs='*', help='Raw circuit CSV captures to ingest')
+    parser.add_argument(
+        '-s', '--store',
+        default=str(DEFAULT_STORE_PATH),
+        help=f'SQLite store path (default: {DEFAULT_STORE_PATH})'
+    )
+    parser.add_argument(
+        '-c', '--chunksize',
+        type=int,
+        default=0,
+        help='Read captures in chunks of this many circuits (default: 0, load each whole)'
+    )
+    args = parser.parse_args()
+
+    with FeatureStore(args.store) as store:
+        for data_path in args.inputs:
+            start = time.perf_counter()
+            capture_id = store.ingest(data_path, args.chunksize)
+            if capture_id is None:
+                print(f"i Already ingested: {data_path}")
+            else:
+                print(f"✓ Ingested {data_path} as snapshot {capture_id} ({time.perf_counter() - start:.2f}s)")
+
+        captures = store.captures()
+        print(f"\nFeature store: {args.store}")
+        print(f"  Snapshots: {len(captures)}")
+        print(f"  Circuits: {int(captures['n_rows'].sum()):,}")
+        for row in captures.itertuples():
+            print(f"  {row.capture_id:4d}. {row.name} ({row.n_rows:,} circuits)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Guard Metadata Artifact
+One row per guard (fingerprint, nickname, address, country) stored as a
+fixed-width NumPy structured array, sorted by fingerprint so it lines up with
+the guard label encoder and can be memory-mapped at startup
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import read_engineered
+
+GUARD_COLUMNS = ['guard_fingerprint', 'guard_nickname', 'guard_address', 'guard_country']
+
+# Positions of the guard columns in headerless raw captures
+RAW_GUARD_POSITIONS = [4, 5, 6, 7]
+
+
+def build_guard_metadata(df):
+    """
+    Collapse circuit rows into one metadata row per guard
+
+    The last observation of each guard wins. Missing fields get the same
+    placeholders the API has always shown.
+
+    Args:
+        df: DataFrame with the guard_* columns
+
+    Returns:
+        Structured array with fields fingerprint, nickname, address, country
+    """
+    # Columnar datasets store these as categoricals; work on plain strings
+    guards = df[GUARD_COLUMNS].astype(object)
+    guards['guard_fingerprint'] = guards['guard_fingerprint'].astype(str).str.strip()
+    guards = guards[guards['guard_fingerprint'].str.len() == 40]
+    guards = guards.drop_duplicates('guard_fingerprint', keep='last').sort_values('guard_fingerprint')
+
+    fingerprints = guards['guard_fingerprint']
+    nicknames = guards['guard_nickname'].fillna('').astype(str).str.strip()
+    nicknames = nicknames.where(nicknames != '', 'Guard_' + fingerprints.str[:6])
+    addresses = guards['guard_address'].fillna('').astype(str).str.strip().replace('', 'Unknown')
+    countries = guards['guard_country'].fillna('').astype(str).str.strip().replace('', 'Unknown')
+
+    columns = {
+        'fingerprint': fingerprints,
+        'nickname': nicknames,
+        'address': addresses,
+        'country': countries,
+    }
+    encoded = {name: values.str.encode('utf-8').to_numpy(dtype=object) for name, values in columns.items()}
+    dtype = [(name, f'S{max(1, max((len(v) for v in values), default=1))}') for name, values in encoded.items()]
+    dtype[0] = ('fingerprint', 'S40')
+
+    meta = np.empty(len(guards), dtype=dtype)
+    for name, values in encoded.items():
+        meta[name] = values
+    return meta
+
+
+def save_guard_metadata(meta, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, meta, allow_pickle=False)
+
+
+def load_guard_metadata(path):
+    """Memory-map a saved guard metadata array"""
+    return np.load(Path(path), mmap_mode='r', allow_pickle=False)
+
+
+def read_guard_columns(csv_path):
+    """Read only the guard columns of an engineered dataset or a headerless raw capture"""
+    if Path(csv_path).suffix in ('.parquet', '.feather'):
+        return read_engineered(csv_path, columns=GUARD_COLUMNS)
+    with open(csv_path, 'r', newline='', encoding='utf-8') as f:
+        has_header = 'guard_fingerprint' in f.readline().lower()
+    if has_header:
+        return pd.read_csv(csv_path, usecols=GUARD_COLUMNS, dtype=str)
+    raw = pd.read_csv(csv_path, header=None, usecols=RAW_GUARD_POSITIONS, dtype=str)
+    raw.columns = GUARD_COLUMNS
+    return raw
+
+
+def load_or_build_guard_metadata(cache_path, csv_path):
+    """
+    Load the metadata artifact, building it from the circuit CSV if needed
+
+    The cache is (re)built when it is missing or older than the CSV and is
+    reused on every start after that.
+
+    Returns:
+        (metadata array, source) where source is 'cache', 'csv' or None
+    """
+    cache_path, csv_path = Path(cache_path), Path(csv_path)
+    csv_exists = csv_path.exists()
+
+    if cache_path.exists() and (not csv_exists or cache_path.stat().st_mtime >= csv_path.stat().st_mtime):
+        return load_guard_metadata(cache_path), 'cache'
+
+    if not csv_exists:
+        return None, None
+
+    meta = build_guard_metadata(read_guard_columns(csv_path))
+    save_guard_metadata(meta, cache_path)
+    return load_guard_metadata(cache_path), 'csv'
+
@@ -0,0 +1,227 @@
+"""
+Versioned Model Bundles for TOR Guard Prediction
+One directory per trained model holding the UBJSON booster, the fitted
+feature pipeline (encoders, lookup tables, feature order), guard metadata
+and metrics, plus a CURRENT pointer that is switched atomically
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import time
+from pathlib import Path
+
+import xgboost as xgb
+
+from feature_pipeline import FeaturePipeline
+
+BUNDLE_FORMAT = 1
+BUNDLES_DIR_NAME = 'bundles'
+CURRENT_NAME = 'CURRENT'
+MANIFEST_NAME = 'bundle.json'
+BOOSTER_NAME = 'model.ubj'
+MODEL_TYPE_MULTICLASS = 'multiclass'
+MODEL_TYPE_TWO_STAGE = 'two_stage'
+FEATURE_COLUMNS_NAME = 'feature_columns.json'
+METRICS_NAME = 'evaluation_metrics.json'
+GUARD_METADATA_NAME = 'guard_metadata.npy'
+
+# Flat artifacts written before bundles existed
+LEGACY_MODEL_NAME = 'xgboost_guard_predictor.json'
+LEGACY_FEATURE_COLUMNS_NAME = 'feature_columns.pkl'
+
+
+class ModelBundle:
+    """
+    Everything needed to serve one trained model
+
+    The booster is read from UBJSON, which parses several times faster than
+    the JSON model; encoder vocabularies and lookup tables are memory-mapped
+    by FeaturePipeline.load(). Two-stage bundles carry a TwoStageRanker in
+    ranker instead of a booster.
+    """
+
+    def __init__(self, path, version, booster, pipeline, feature_columns, metrics=None, guard_metadata_path=None,
+                 ranker=None):
+        self.path = Path(path)
+        self.version = version
+        self.booster = booster
+        self.ranker = ranker
+        self.model_type = MODEL_TYPE_TWO_STAGE if ranker is not None else MODEL_TYPE_MULTICLASS
+        self.pipeline = pipeline
+        self.feature_columns = feature_columns
+        self.metrics = metrics or {}
+        self.guard_metadata_path = guard_metadata_path
+
+    @classmethod
+    def load(cls, bundle_dir):
+        bundle_dir = Path(bundle_dir)
+        with open(bundle_dir / MANIFEST_NAME) as f:
+            manifest = json.load(f)
+        if manifest.get('format') != BUNDLE_FORMAT:
+            raise ValueError(f"Unsupported bundle format {manifest.get('format')} in {bundle_dir}")
+
+        booster, ranker = None, None
+        if manifest.get('model_type', MODEL_TYPE_MULTICLASS) == MODEL_TYPE_TWO_STAGE:
+            from two_stage import TwoStageRanker  # two_stage imports this module
+            ranker = TwoStageRanker.load(bundle_dir)
+        else:
+            booster = xgb.Booster()
+            booster.load_model(str(bundle_dir / manifest['booster']))
+        with open(bundle_dir / FEATURE_COLUMNS_NAME) as f:
+            feature_columns = json.load(f)
+        metrics_path = bundle_dir / METRICS_NAME
+        metrics = json.loads(metrics_path.read_text()) if metrics_path.exists() else {}
+        guard_metadata_path = bundle_dir / GUARD_METADATA_NAME
+
+        return cls(
+            bundle_dir, manifest['version'], booster,
+            FeaturePipeline.load(bundle_dir, feature_columns=feature_columns),
+            feature_columns, metrics,
+            guard_metadata_path if guard_metadata_path.exists() else None,
+            ranker,
+        )
+
+    @classmethod
+    def load_legacy(cls, model_dir):
+        """Flat models/ layout: JSON booster, pickled feature columns, pipeline files"""
+        model_dir = Path(model_dir)
+        model_path = model_dir / LEGACY_MODEL_NAME
+        booster = xgb.Booster()
+        booster.load_model(str(model_path))
+        with open(model_dir / LEGACY_FEATURE_COLUMNS_NAME, 'rb') as f:
+            feature_columns = pickle.load(f)
+        metrics_path = model_dir / METRICS_NAME
+        metrics = json.loads(metrics_path.read_text()) if metrics_path.exists() else {}
+        guard_metadata_path = model_dir / GUARD_METADATA_NAME
+
+        # Same file identity the prediction cache keyed on before bundles
+        stat = model_path.stat()
+        return cls(
+            model_dir, f"legacy+{stat.st_size:x}.{stat.st_mtime_ns:x}", booster,
+            FeaturePipeline.load(model_dir, feature_columns=feature_columns),
+            feature_columns, metrics,
+            guard_metadata_path if guard_metadata_path.exists() else None,
+        )
+
+
+def iteration_range(booster):
+    """
+    Trees to predict with: up to the early-stopping best iteration when the
+    booster recorded one (as XGBClassifier.predict_proba does), else all
+    """
+    best_iteration = booster.attr('best_iteration')
+    return (0, int(best_iteration) + 1) if best_iteration is not None else (0, 0)
+
+
+def bundles_dir(model_dir):
+    return Path(model_dir) / BUNDLES_DIR_NAME
+
+
+def list_bundles(model_dir):
+    """Versions of all complete bundles, oldest first"""
+    root = bundles_dir(model_dir)
+    if not root.exists():
+        return []
+    # Hidden .<version>.tmp directories are bundles still being written
+    return sorted(p.name for p in root.iterdir() if not p.name.startswith('.') and (p / MANIFEST_NAME).exists())
+
+
+def current_version(model_dir):
+    pointer = bundles_dir(model_dir) / CURRENT_NAME
+    return pointer.read_text().strip() if pointer.exists() else None
+
+
+def set_current(model_dir, version):
+    """Point CURRENT at a bundle; the rename makes the switch atomic for readers"""
+    root = bundles_dir(model_dir)
+    if version not in list_bundles(model_dir):
+        raise FileNotFoundError(f"No bundle {version!r} in {root}")
+    tmp = root / f'.{CURRENT_NAME}.tmp'
+    tmp.write_text(version + '\n')
+    os.replace(tmp, root / CURRENT_NAME)
+
+
+def write_bundle(model_dir, booster, pipeline, feature_columns, metrics=None, guard_metadata_path=None,
+                 make_current=True, ranker=None):
+    """
+    Write a new versioned bundle under models/bundles/<version>/
+
+    The bundle is assembled in a hidden directory and renamed into place, so
+    a reader never sees a partial bundle. The version is the UTC build time
+    plus a hash of the booster bytes. Pass ranker (and booster=None) for a
+    two-stage model.
+
+    Returns:
+        Path of the bundle directory
+    """
+    root = bundles_dir(model_dir)
+    root.mkdir(parents=True, exist_ok=True)
+
+    raws = [model.save_raw(raw_format='ubj') for model in
+            ([booster] if ranker is None else [ranker.stage1, ranker.stage2])]
+    digest = hashlib.sha256()
+    for raw in raws:
+        digest.update(raw)
+    version = f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}-{digest.hexdigest()[:8]}"
+    staging = root / f'.{version}.tmp'
+    if staging.exists():
+        shutil.rmtree(staging)
+    staging.mkdir()
+
+    if ranker is None:
+        (staging / BOOSTER_NAME).write_bytes(raws[0])
+    else:
+        ranker.save(staging)
+    pipeline.save(staging)
+    with open(staging / FEATURE_COLUMNS_NAME, 'w') as f:
+        json.dump(list(feature_columns), f, indent=2)
+    if metrics is not None:
+        with open(staging / METRICS_NAME, 'w') as f:
+            json.dump(metrics, f, indent=2)
+    if guard_metadata_path is not None and Path(guard_metadata_path).exists():
+        shutil.copy2(guard_metadata_path, staging / GUARD_METADATA_NAME)
+
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'version': version,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'model_type': MODEL_TYPE_MULTICLASS if ranker is None else MODEL_TYPE_TWO_STAGE,
+        'booster': BOOSTER_NAME if ranker is None else None,
+        'xgboost_version': xgb.__version__,
+        'n_features': len(feature_columns),
+        'n_classes': len(pipeline.encoders['guard_fingerprint']),
+    }
+    with open(staging / MANIFEST_NAME, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    bundle_dir = root / version
+    if bundle_dir.exists():
+        # Same booster written within the same second: the bundle is already there
+        shutil.rmtree(staging)
+    else:
+        os.replace(staging, bundle_dir)
+    if make_current:
+        set_current(model_dir, version)
+    return bundle_dir
+
+
+def load_bundle(model_dir, version=None):
+    """
+    Load a bundle by version, else the CURRENT one, else the legacy flat files
+
+    The version must name one of list_bundles(); it can come from an admin
+    request, so anything else (e.g. '../..') is rejected before it is joined
+    into a path.
+
+    Returns:
+        ModelBundle
+    """
+    version = version or current_version(model_dir)
+    if version is None:
+        return ModelBundle.load_legacy(model_dir)
+    if version not in list_bundles(model_dir):
+        raise FileNotFoundError(f"No bundle {version!r} in {bundles_dir(model_dir)}")
+    return ModelBundle.load(bundles_dir(model_dir) / version)
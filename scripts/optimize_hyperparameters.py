@@ -0,0 +1,456 @@
+"""
+Hyperparameter Search for the XGBoost Guard Ranking Model
+Random-search trials run in a process pool (each with a fixed thread count),
+median-pruned on validation mlogloss and recorded in a resumable SQLite study
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import xgboost as xgb
+
+from dataset_io import engineered_columns, find_engineered, read_engineered
+from evaluation import evaluate_ranking
+from external_memory import LABEL_COLUMN, split_indices
+from model_bundle import iteration_range
+from pipeline_profile import MB
+from train_xgboost import EXCLUDE_COLS, MODEL_PARAMS, native_params
+
+DEFAULT_STORAGE = Path('models/hyperparameter_study.sqlite')
+DEFAULT_STUDY = 'xgboost-guard'
+BEST_PARAMS_PATH = Path('models/best_hyperparameters.json')
+
+# Validation metric the search maximizes, and the K values logged per trial
+OBJECTIVE = 'MRR@50'
+K_VALUES = [1, 3, 5, 10, 20, 50]
+
+# name: (kind, low, high, log scale)
+SEARCH_SPACE = {
+    'max_depth': ('int', 4, 12, False),
+    'learning_rate': ('float', 0.02, 0.3, True),
+    'subsample': ('float', 0.6, 1.0, False),
+    'colsample_bytree': ('float', 0.5, 1.0, False),
+    'min_child_weight': ('int', 1, 10, False),
+    'gamma': ('float', 0.0, 1.0, False),
+    'reg_alpha': ('float', 1e-3, 1.0, True),
+    'reg_lambda': ('float', 0.1, 10.0, True),
+}
+
+# Median pruning: report validation mlogloss every PRUNE_INTERVAL rounds, and
+# once N_STARTUP_TRIALS trials have completed stop a trial after
+# PRUNE_WARMUP_ROUNDS whose loss is worse than the completed trials' median
+PRUNE_INTERVAL = 10
+PRUNE_WARMUP_ROUNDS = 20
+N_STARTUP_TRIALS = 5
+
+RUNNING, COMPLETE, PRUNED, FAILED = 'running', 'complete', 'pruned', 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS studies (
+    study_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    dataset TEXT NOT NULL,
+    seed INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trials (
+    trial_id INTEGER PRIMARY KEY,
+    study_id INTEGER NOT NULL,
+    number INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    params TEXT NOT NULL,
+    value REAL,
+    metrics TEXT,
+    best_iteration INTEGER,
+    n_jobs INTEGER,
+    wall_time REAL,
+    started_at REAL,
+    finished_at REAL,
+    UNIQUE (study_id, number)
+);
+CREATE TABLE IF NOT EXISTS intermediate_values (
+    trial_id INTEGER NOT NULL,
+    step INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (trial_id, step)
+);
+"""
+
+
+def connect(path):
+    """SQLite connection that tolerates several worker processes writing"""
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class StudyStorage:
+    """
+    One search study in a local SQLite file
+
+    Trials are numbered per study and their parameters are stored before
+    they run, so an interrupted search resumes where it stopped: trials left
+    running by a killed process are re-run with the same parameters.
+    """
+
+    def __init__(self, path=DEFAULT_STORAGE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = connect(self.path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def study(self, name, dataset, seed):
+        """
+        Study id and seed, creating the study on first use
+
+        A resumed study keeps its original seed so its trials stay reproducible.
+        """
+        row = self.conn.execute("SELECT study_id, dataset, seed FROM studies WHERE name = ?", (name,)).fetchone()
+        if row is not None:
+            study_id, study_dataset, study_seed = row
+            if study_dataset != str(dataset):
+                print(f"⚠ Study '{name}' was created on {study_dataset}, now running on {dataset}")
+            return study_id, study_seed
+        with self.conn:
+            cur = self.conn.execute("INSERT INTO studies (name, dataset, seed, created_at) VALUES (?, ?, ?, ?)",
+                                    (name, str(dataset), seed, time.time()))
+        return cur.lastrowid, seed
+
+    def counts(self, study_id):
+        return dict(self.conn.execute(
+            "SELECT state, COUNT(*) FROM trials WHERE study_id = ? GROUP BY state", (study_id,)
+        ).fetchall())
+
+    def interrupted(self, study_id):
+        """Trials a previous run left in the running state, as (trial_id, number, params)"""
+        rows = self.conn.execute(
+            "SELECT trial_id, number, params FROM trials WHERE study_id = ? AND state = ? ORDER BY number",
+            (study_id, RUNNING),
+        ).fetchall()
+        with self.conn:
+            self.conn.executemany("DELETE FROM intermediate_values WHERE trial_id = ?", [(r[0],) for r in rows])
+        return [(trial_id, number, json.loads(params)) for trial_id, number, params in rows]
+
+    def next_number(self, study_id):
+        return self.conn.execute(
+            "SELECT COALESCE(MAX(number) + 1, 0) FROM trials WHERE study_id = ?", (study_id,)
+        ).fetchone()[0]
+
+    def create_trial(self, study_id, number, params):
+        with self.conn:
+            cur = self.conn.execute(
+                "INSERT INTO trials (study_id, number, state, params, started_at) VALUES (?, ?, ?, ?, ?)",
+                (study_id, number, RUNNING, json.dumps(params), time.time()),
+            )
+        return cur.lastrowid
+
+    def finish_trial(self, trial_id, result):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE trials SET state = ?, value = ?, metrics = ?, best_iteration = ?, n_jobs = ?, "
+                "wall_time = ?, finished_at = ? WHERE trial_id = ?",
+                (result['state'], result['value'], json.dumps(result['metrics']), result['best_iteration'],
+                 result['n_jobs'], result['wall_time'], time.time(), trial_id),
+            )
+
+    def best_trial(self, study_id):
+        row = self.conn.execute(
+            "SELECT number, params, value, metrics, best_iteration, wall_time FROM trials "
+            "WHERE study_id = ? AND state = ? "
+            "ORDER BY value DESC, json_extract(metrics, '$.mlogloss'), number LIMIT 1",
+            (study_id, COMPLETE),
+        ).fetchone()
+        if row is None:
+            return None
+        number, params, value, metrics, best_iteration, wall_time = row
+        return {'number': number, 'params': json.loads(params), 'value': value, 'metrics': json.loads(metrics),
+                'best_iteration': best_iteration, 'wall_time': wall_time}
+
+
+def sample_params(seed, number):
+    """
+    Parameters of trial `number`, drawn uniformly (log-uniformly where marked)
+
+    Seeded by (study seed, trial number), so a trial draws the same values
+    whichever worker runs it or whether the study was resumed.
+    """
+    rng = np.random.default_rng([seed, number])
+    params = {}
+    for name, (kind, low, high, log) in SEARCH_SPACE.items():
+        if kind == 'int':
+            params[name] = int(rng.integers(low, high + 1))
+        elif log:
+            params[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        else:
+            params[name] = float(rng.uniform(low, high))
+    return params
+
+
+class MedianPruningCallback(xgb.callback.TrainingCallback):
+    """
+    Report validation mlogloss to the study and stop trials worse than the median
+
+    Compares against the completed trials of the same study at the same
+    boosting round; returning True from after_iteration ends training.
+    """
+
+    def __init__(self, conn, study_id, trial_id, metric='mlogloss'):
+        super().__init__()
+        self.conn = conn
+        self.study_id = study_id
+        self.trial_id = trial_id
+        self.metric = metric
+        self.pruned_at = None
+
+    def after_iteration(self, model, epoch, evals_log):
+        step = epoch + 1
+        if step % PRUNE_INTERVAL:
+            return False
+        value = float(evals_log['validation'][self.metric][-1])
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO intermediate_values VALUES (?, ?, ?)",
+                              (self.trial_id, step, value))
+        if step < PRUNE_WARMUP_ROUNDS:
+            return False
+
+        completed = [v for (v,) in self.conn.execute(
+            "SELECT iv.value FROM intermediate_values iv JOIN trials t ON t.trial_id = iv.trial_id "
+            "WHERE t.study_id = ? AND t.state = ? AND iv.step = ?",
+            (self.study_id, COMPLETE, step),
+        )]
+        if len(completed) >= N_STARTUP_TRIALS and value > np.median(completed):
+            self.pruned_at = step
+            return True
+        return False
+
+
+# Train/val arrays the parent writes once and every worker memory-maps
+SPLIT_ARRAYS = ('X_train', 'y_train', 'X_val', 'y_val')
+
+# Worker process state: the split data and DMatrix objects, built once per worker
+_worker = {}
+
+
+def write_split(data_path, feature_cols, split_dir):
+    """
+    Load the dataset once, split it and save the train/val arrays as .npy
+
+    Workers memory-map these files instead of each reading the dataset, so
+    the float32 rows are held once in the page cache however many workers
+    run; only the quantized matrices are per worker.
+
+    Returns:
+        (n_classes, n_train, n_val)
+    """
+    df = read_engineered(data_path, columns=feature_cols + [LABEL_COLUMN])
+    X = df[feature_cols].to_numpy(dtype=np.float32)
+    X[np.isnan(X)] = 0.0
+    y = df[LABEL_COLUMN].to_numpy()
+    del df
+
+    # Same split as train_xgboost.py; the test rows are never looked at here
+    train_index, val_index, _ = split_indices(y)
+    split_dir = Path(split_dir)
+    for split, index in (('train', train_index), ('val', val_index)):
+        np.save(split_dir / f'X_{split}.npy', X[index], allow_pickle=False)
+        np.save(split_dir / f'y_{split}.npy', y[index], allow_pickle=False)
+    return int(y.max()) + 1, len(train_index), len(val_index)
+
+
+def worker_memory_bytes(n_train, n_val, n_features, n_classes):
+    """
+    Rough private memory of one worker: its quantized matrices (one byte per
+    value with max_bin <= 256), float32 gradient/hessian pairs per training
+    row and class, and the cached float32 margins of both matrices
+    """
+    return (n_train + n_val) * (n_features + 4 * n_classes) + n_train * 8 * n_classes
+
+
+def init_worker(split_dir, feature_cols, n_classes, storage_path, n_jobs):
+    """Memory-map the shared split and quantize train/val once for all trials this process runs"""
+    arrays = {name: np.load(Path(split_dir) / f'{name}.npy', mmap_mode='r') for name in SPLIT_ARRAYS}
+    dtrain = xgb.QuantileDMatrix(arrays['X_train'], arrays['y_train'], feature_names=feature_cols, nthread=n_jobs)
+    dval = xgb.QuantileDMatrix(arrays['X_val'], arrays['y_val'], feature_names=feature_cols, ref=dtrain,
+                               nthread=n_jobs)
+    _worker.update(
+        dtrain=dtrain, dval=dval, X_val=arrays['X_val'], y_val=arrays['y_val'], n_classes=n_classes,
+        n_jobs=n_jobs, conn=connect(storage_path),
+    )
+
+
+def run_trial(study_id, trial_id, params):
+    """
+    Train and score one parameter set in a worker process
+
+    Returns:
+        Result dict for StudyStorage.finish_trial
+    """
+    w = _worker
+    start_time = time.time()
+    model_params = {**MODEL_PARAMS, **params, 'n_jobs': w['n_jobs']}
+    booster_params, num_boost_round, early_stopping_rounds = native_params(model_params, w['n_classes'])
+    pruning = MedianPruningCallback(w['conn'], study_id, trial_id)
+
+    booster = xgb.train(
+        booster_params, w['dtrain'], num_boost_round=num_boost_round, evals=[(w['dval'], 'validation')],
+        early_stopping_rounds=early_stopping_rounds, callbacks=[pruning], verbose_eval=False,
+    )
+    result = {'n_jobs': w['n_jobs'], 'best_iteration': int(booster.best_iteration)}
+
+    if pruning.pruned_at is not None:
+        result.update(state=PRUNED, value=None, metrics={'pruned_at': pruning.pruned_at,
+                                                          'mlogloss': float(booster.best_score)})
+    else:
+        proba = booster.inplace_predict(w['X_val'], iteration_range=iteration_range(booster))
+        ranking = evaluate_ranking(w['y_val'], proba, k_values=K_VALUES)
+        metrics = {**ranking['topk_accuracy'], **ranking['mrr_at_k'], 'mlogloss': float(booster.best_score)}
+        result.update(state=COMPLETE, value=metrics[OBJECTIVE], metrics=metrics)
+    result['wall_time'] = time.time() - start_time
+    return result
+
+
+def print_trial(number, params, result):
+    metrics = result['metrics']
+    line = f"  #{number:3d} {result['state']:8s} {result['wall_time'] or 0.0:7.1f}s  "
+    if result['state'] == COMPLETE:
+        line += (f"{OBJECTIVE} {result['value']:.4f}  Top-1 {metrics['Top-1']*100:5.1f}%  "
+                 f"Top-5 {metrics['Top-5']*100:5.1f}%  Top-10 {metrics['Top-10']*100:5.1f}%")
+    elif result['state'] == PRUNED:
+        line += f"pruned at round {metrics['pruned_at']} (mlogloss {metrics['mlogloss']:.4f})"
+    else:
+        line += f"failed: {metrics.get('error')}"
+    print(line)
+    print("        " + ", ".join(f"{k}={v:.4g}" if isinstance(v, float) else f"{k}={v}" for k, v in params.items()))
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Search XGBoost hyperparameters for the guard ranking model")
+    parser.add_argument('-d', '--data', default=None,
+                        help="Engineered dataset file or shard directory (default: data/circuit_data_engineered.*)")
+    parser.add_argument('-n', '--n-trials', type=int, default=30,
+                        help="Total finished trials the study should reach (default: 30)")
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help="XGBoost threads per trial (default: 1)")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Trials run in parallel (default: CPU count // --n-jobs). Workers share one "
+                             "memory-mapped copy of the data, but each holds its own quantized matrices "
+                             "(~1 byte per value) and 8 bytes of gradients per training row and guard; "
+                             "the per-worker estimate is printed at startup")
+    parser.add_argument('--storage', default=str(DEFAULT_STORAGE),
+                        help=f"SQLite study file (default: {DEFAULT_STORAGE})")
+    parser.add_argument('--study', default=DEFAULT_STUDY,
+                        help=f"Study name; rerunning with the same name resumes it (default: {DEFAULT_STUDY})")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="Sampling seed of a new study (default: 42)")
+    args = parser.parse_args()
+
+    n_jobs = max(1, args.n_jobs)
+    workers = max(1, args.workers or cpu_count // n_jobs)
+
+    print("="*80)
+    print(" TOR GUARD PREDICTION - HYPERPARAMETER SEARCH")
+    print("="*80)
+    print()
+
+    data_path = Path(args.data) if args.data else find_engineered("data")
+    if data_path is None or not data_path.exists():
+        print("❌ Error: Engineered dataset not found in data/")
+        print("Please run: python scripts/prepare_features.py first")
+        exit(1)
+    feature_cols = [col for col in engineered_columns(data_path) if col not in EXCLUDE_COLS]
+
+    storage = StudyStorage(args.storage)
+    study_id, seed = storage.study(args.study, data_path, args.seed)
+    counts = storage.counts(study_id)
+    done = counts.get(COMPLETE, 0) + counts.get(PRUNED, 0)
+    pending = storage.interrupted(study_id)
+
+    print(f"Study: {args.study} ({storage.path}, seed {seed})")
+    print(f"  Finished trials: {done} ({counts.get(COMPLETE, 0)} complete, {counts.get(PRUNED, 0)} pruned, "
+          f"{counts.get(FAILED, 0)} failed)")
+    if pending:
+        print(f"  Resuming {len(pending)} interrupted trial(s): {[number for _, number, _ in pending]}")
+    print(f"  Data: {data_path} ({len(feature_cols)} features)")
+    print(f"  Workers: {workers} x {n_jobs} XGBoost thread(s) ({cpu_count} CPUs)")
+    print(f"  Objective: validation {OBJECTIVE}; median pruning on mlogloss every {PRUNE_INTERVAL} rounds "
+          f"after {PRUNE_WARMUP_ROUNDS} (once {N_STARTUP_TRIALS} trials completed)")
+
+    remaining = args.n_trials - done
+    if remaining <= 0:
+        print(f"\n✓ Study already has {done} finished trials")
+    else:
+        print(f"\nRunning {remaining} trial(s)...")
+        start_time = time.time()
+
+        def next_trial():
+            if pending:
+                return pending.pop(0)
+            number = storage.next_number(study_id)
+            params = sample_params(seed, number)
+            return storage.create_trial(study_id, number, params), number, params
+
+        # Next to the study rather than in /tmp, which may be RAM-backed
+        with tempfile.TemporaryDirectory(prefix='.split-', dir=storage.path.parent) as split_dir:
+            n_classes, n_train, n_val = write_split(data_path, feature_cols, split_dir)
+            memory = worker_memory_bytes(n_train, n_val, len(feature_cols), n_classes)
+            print(f"  Split: {n_train:,} train / {n_val:,} val rows, {n_classes} guards; "
+                  f"~{memory / MB:,.0f} MB per worker ({workers * memory / MB:,.0f} MB total)\n")
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                     initargs=(split_dir, feature_cols, n_classes, storage.path, n_jobs)) as pool:
+                running = {}
+                submitted = 0
+                while submitted < remaining or running:
+                    while submitted < remaining and len(running) < workers:
+                        trial_id, number, params = next_trial()
+                        running[pool.submit(run_trial, study_id, trial_id, params)] = (trial_id, number, params)
+                        submitted += 1
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        trial_id, number, params = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            result = {'state': FAILED, 'value': None, 'metrics': {'error': str(e)},
+                                      'best_iteration': None, 'n_jobs': n_jobs, 'wall_time': None}
+                        storage.finish_trial(trial_id, result)
+                        print_trial(number, params, result)
+
+        counts = storage.counts(study_id)
+        print(f"\n✓ Search finished in {time.time() - start_time:.1f} seconds "
+              f"({counts.get(COMPLETE, 0)} complete, {counts.get(PRUNED, 0)} pruned, {counts.get(FAILED, 0)} failed)")
+
+    best = storage.best_trial(study_id)
+    storage.close()
+    if best is None:
+        print("⚠ No completed trials yet")
+        return
+
+    print(f"\n🏆 Best trial #{best['number']}: {OBJECTIVE} {best['value']:.4f} "
+          f"(Top-1 {best['metrics']['Top-1']*100:.2f}%, best iteration {best['best_iteration']}, "
+          f"{best['wall_time']:.1f}s)")
+    for name, value in best['params'].items():
+        print(f"  {name:20s}: {value}")
+
+    BEST_PARAMS_PATH.parent.mkdir(exist_ok=True)
+    with open(BEST_PARAMS_PATH, 'w') as f:
+        json.dump({'study': args.study, 'trial': best['number'], 'objective': OBJECTIVE,
+                   'value': best['value'], 'metrics': best['metrics'], 'params': best['params']}, f, indent=2)
+    print(f"\n✓ Best parameters saved: {BEST_PARAMS_PATH}")
+    print(f"  Train with them: python scripts/train_xgboost.py --params {BEST_PARAMS_PATH}")
+
+    print("\n" + "="*80)
+
+
+if __name__ == "__main__":
+    main()
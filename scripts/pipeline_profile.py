@@ -0,0 +1,180 @@
+"""
+Stage Profiler for the TOR Guard Prediction Pipeline
+Context-manager timers with tracemalloc peaks around each stage of feature
+preparation and training, written to models/pipeline_profile.json
+"""
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PROFILE_NAME = 'pipeline_profile.json'
+MB = 1024 ** 2
+
+# tracemalloc hooks every Python-level allocation (pandas string work runs up to
+# ~10x slower under it), so per-stage traced peaks are opt-in; timings and the
+# RSS high-water mark are always recorded
+TRACE_MEMORY = os.environ.get('TGNP_PROFILE_TRACEMALLOC', '0') == '1'
+
+_active = None
+
+
+def max_rss_mb():
+    """Process peak resident set size so far (None where unavailable)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / MB if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+class PipelineProfiler:
+    """
+    Wall time, CPU time and memory peaks per pipeline stage
+
+    Stages nest: an inner stage is recorded as 'outer/inner' and still counts
+    towards the outer one. With trace_memory, traced_peak_mb is the
+    tracemalloc peak above the stage's starting allocation, which covers
+    Python objects and NumPy/pandas buffers but not memory XGBoost allocates
+    natively; max_rss_mb (the process high-water mark when the stage ended)
+    shows those. Timings taken with trace_memory include its overhead.
+    """
+
+    def __init__(self, name, trace_memory=TRACE_MEMORY):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.stages = []
+        self._stack = []
+        self._previous = None
+        self._started_at = time.time()
+        self._start = time.perf_counter()
+        self._owns_tracemalloc = False
+
+    def start(self):
+        """Make this the active profiler (module-level stage() records into it)"""
+        global _active
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        self._previous, _active = _active, self
+        self._started_at = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def stop(self):
+        global _active
+        _active = self._previous
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        self.total_seconds = time.perf_counter() - self._start
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _traced_peak(self):
+        """Absolute tracemalloc peak since the last reset, then reset it"""
+        if not tracemalloc.is_tracing():
+            return 0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        return peak
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Time one stage; extra keyword arguments (e.g. rows=...) are stored with it
+
+        The record can be extended from inside the block through the yielded dict.
+        """
+        if self._stack:
+            # The parent's peak so far must survive the reset for this stage
+            parent = self._stack[-1]
+            parent['peak'] = max(parent['peak'], self._traced_peak())
+        else:
+            self._traced_peak()
+        frame = {
+            'path': '/'.join([f['path'] for f in self._stack[-1:]] + [name]),
+            'start_traced': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0,
+            'peak': 0,
+        }
+        record = {'stage': frame['path'], **info}
+        # Listed in start order, although inner stages finish first
+        self.stages.append(record)
+        self._stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - wall, 4)
+            record['cpu_seconds'] = round(time.process_time() - cpu, 4)
+            self._stack.pop()
+            peak = max(frame['peak'], self._traced_peak())
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+            if tracemalloc.is_tracing():
+                record['traced_peak_mb'] = round(max(0, peak - frame['start_traced']) / MB, 2)
+            record['max_rss_mb'] = max_rss_mb()
+
+    def report(self):
+        total = getattr(self, 'total_seconds', time.perf_counter() - self._start)
+        return {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self._started_at)),
+            'total_seconds': round(total, 4),
+            'argv': sys.argv[1:],
+            'trace_memory': self.trace_memory,
+            'max_rss_mb': max_rss_mb(),
+            'stages': self.stages,
+        }
+
+    def print_summary(self):
+        report = self.report()
+        total = report['total_seconds'] or 1.0
+        print(f"\n⏱  Stage timings ({self.name}, {report['total_seconds']:.2f}s total):")
+        for record in report['stages']:
+            depth = record['stage'].count('/')
+            label = '  ' * depth + record['stage'].rsplit('/', 1)[-1]
+            if 'traced_peak_mb' in record:
+                memory = f"  peak {record['traced_peak_mb']:9.1f} MB"
+            else:
+                memory = f"  rss {record['max_rss_mb']:9.1f} MB" if record['max_rss_mb'] is not None else ''
+            print(f"  {label:32s} {record['seconds']:9.2f}s {record['seconds'] / total * 100:5.1f}%{memory}")
+
+    def save(self, model_dir):
+        """
+        Write this run into model_dir/pipeline_profile.json
+
+        The file holds one section per script (prepare_features,
+        train_xgboost), so the latest run of each step sits side by side.
+        """
+        path = Path(model_dir) / PROFILE_NAME
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profile = {}
+        if path.exists():
+            try:
+                profile = json.loads(path.read_text())
+            except ValueError:
+                profile = {}
+        profile[self.name] = self.report()
+        tmp = path.with_suffix('.json.tmp')
+        tmp.write_text(json.dumps(profile, indent=2))
+        os.replace(tmp, path)
+        return path
+
+
+def stage(name, **info):
+    """Stage of the active profiler, or a no-op when nothing is being profiled"""
+    if _active is None:
+        return nullcontext({})
+    return _active.stage(name, **info)
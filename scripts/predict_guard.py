@@ -4,98 +4,62 @@ Loads trained model and predicts top-K guards for new circuit data
 """
 
 import pandas as pd
-import numpy as np
-import xgboost as xgb
-from pathlib import Path
-import pickle
 import json
 
+from category_encoder import UNKNOWN_CODE
+from dataset_io import find_engineered, read_engineered
+from feature_pipeline import ENCODED_COLUMNS
+from model_bundle import iteration_range, load_bundle
+from ranking import top_k
+from two_stage import TwoStageRanker
+
 def load_model_and_artifacts():
-    """Load trained model, encoders, and feature columns"""
-    
-    model_dir = Path("models")
-    
-    # Load model
-    model = xgb.XGBClassifier()
-    model.load_model(model_dir / "xgboost_guard_predictor.json")
-    
-    # Load encoders
-    with open(model_dir / "encoders.pkl", 'rb') as f:
-        encoders = pickle.load(f)
+    """Load trained booster (or two-stage ranker), feature pipeline, and feature columns"""
     
-    # Load feature columns
-    with open(model_dir / "feature_columns.pkl", 'rb') as f:
-        feature_cols = pickle.load(f)
+    # Current versioned bundle (or the flat models/ files of older trainings)
+    bundle = load_bundle("models")
+    print(f"✓ Model bundle: {bundle.version}")
     
-    return model, encoders, feature_cols
+    return bundle.ranker or bundle.booster, bundle.pipeline, bundle.feature_columns
 
 
-def predict_top_k_guards(circuit_data, model, encoders, feature_cols, k=10):
+def predict_top_k_guards(circuit_data, model, pipeline, k=10):
     """
     Predict top-K most likely guards for circuit data
     
     Args:
         circuit_data: DataFrame with circuit information
-        model: Trained XGBoost model
-        encoders: Dictionary of label encoders
-        feature_cols: List of feature column names
+        model: Trained XGBoost Booster or TwoStageRanker
+        pipeline: Fitted FeaturePipeline (encoders, lookups, feature order)
         k: Number of top predictions to return
     
     Returns:
         DataFrame with top-K guard predictions and probabilities
     """
     
-    # Prepare features (same engineering as training)
-    df = circuit_data.copy()
-    
-    # Feature engineering
-    df['bw_ratio_guard_middle'] = df['guard_bandwidth'] / (df['middle_bandwidth'] + 1)
-    df['bw_ratio_guard_exit'] = df['guard_bandwidth'] / (df['exit_bandwidth'] + 1)
-    df['bw_ratio_middle_exit'] = df['middle_bandwidth'] / (df['exit_bandwidth'] + 1)
-    df['bw_total'] = df['guard_bandwidth'] + df['middle_bandwidth'] + df['exit_bandwidth']
-    df['bw_min'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].min(axis=1)
-    df['bw_max'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].max(axis=1)
-    df['bw_std'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].std(axis=1)
-    
-    # Geographic features
-    df['same_country_guard_middle'] = (df['guard_country'] == df['middle_country']).astype(int)
-    df['same_country_guard_exit'] = (df['guard_country'] == df['exit_country']).astype(int)
-    df['same_country_middle_exit'] = (df['middle_country'] == df['exit_country']).astype(int)
-    df['all_same_country'] = ((df['guard_country'] == df['middle_country']) & 
-                               (df['guard_country'] == df['exit_country'])).astype(int)
-    df['country_diversity'] = df[['guard_country', 'middle_country', 'exit_country']].nunique(axis=1)
-    
-    # Encoding
-    for col in ['middle_fingerprint', 'exit_fingerprint', 'guard_country', 'middle_country', 'exit_country']:
-        le = encoders[col]
-        df[f'{col}_encoded'] = le.transform(df[col])
-    
-    # Interaction features
-    df['bw_guard_x_setup'] = df['guard_bandwidth'] * df['circuit_setup_duration']
-    df['bw_total_x_bytes'] = df['bw_total'] * df['total_bytes']
-    
-    # Select features
-    X = df[feature_cols].fillna(0)
-    
-    # Predict probabilities
-    probabilities = model.predict_proba(X)
-    
-    # Get top-K predictions
-    results = []
-    guard_encoder = encoders['guard_fingerprint']
-    
-    for i in range(len(X)):
-        top_k_indices = np.argsort(probabilities[i])[::-1][:k]
-        top_k_probs = probabilities[i][top_k_indices]
-        top_k_guards = guard_encoder.inverse_transform(top_k_indices)
-        
-        results.append({
-            'circuit_id': circuit_data.iloc[i]['circuit_id'],
-            'top_k_guards': top_k_guards.tolist(),
-            'top_k_probabilities': top_k_probs.tolist()
-        })
-    
-    return pd.DataFrame(results)
+    # Relays/countries unseen during training get UNKNOWN_CODE
+    for col in ENCODED_COLUMNS:
+        if col in circuit_data:
+            n_unknown = int((pipeline.encoders[col].transform(circuit_data[col]) == UNKNOWN_CODE).sum())
+            if n_unknown:
+                print(f"⚠ {n_unknown} circuit(s) with {col} unseen during training")
+    
+    # Same feature kernels as training and the API
+    X = pipeline.transform(circuit_data)
+    
+    # Get top-K predictions for all rows at once (two-stage: at most the shortlist size)
+    if isinstance(model, TwoStageRanker):
+        top_k_indices, top_k_probs = model.rank(X, k)
+    else:
+        probabilities = model.inplace_predict(X, iteration_range=iteration_range(model)).reshape(len(X), -1)
+        top_k_indices, top_k_probs = top_k(probabilities, k)
+    top_k_guards = pipeline.encoders['guard_fingerprint'].classes_[top_k_indices]
+    
+    return pd.DataFrame({
+        'circuit_id': circuit_data['circuit_id'].values,
+        'top_k_guards': top_k_guards.tolist(),
+        'top_k_probabilities': top_k_probs.tolist()
+    })
 
 
 if __name__ == "__main__":
@@ -106,9 +70,9 @@ if __name__ == "__main__":
     
     # Load model
     print("Loading model and artifacts...")
-    model, encoders, feature_cols = load_model_and_artifacts()
+    model, pipeline, feature_cols = load_model_and_artifacts()
     print(f"✓ Model loaded with {len(feature_cols)} features")
-    print(f"✓ {len(encoders)} encoders loaded")
+    print(f"✓ Feature pipeline loaded ({len(pipeline.encoders)} encoders)")
     
     # Load evaluation metrics
     with open("models/evaluation_metrics.json", 'r') as f:
@@ -125,11 +89,14 @@ if __name__ == "__main__":
     print("="*80)
     
     # Load some test data
-    df = pd.read_csv("data/circuit_data_engineered.csv")
+    raw_cols = ['circuit_id', 'guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth',
+                'guard_country', 'middle_country', 'exit_country',
+                'middle_fingerprint', 'exit_fingerprint', 'circuit_setup_duration', 'total_bytes']
+    df = read_engineered(find_engineered("data"), columns=raw_cols, categorical=False)
     sample = df.sample(5, random_state=42)
     
     # Predict
-    predictions = predict_top_k_guards(sample, model, encoders, feature_cols, k=5)
+    predictions = predict_top_k_guards(sample, model, pipeline, k=5)
     
     print("\nTop-5 Guard Predictions:")
     for idx, row in predictions.iterrows():
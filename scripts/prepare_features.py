@@ -4,98 +4,38 @@ Generates ML-ready dataset with ~40 features (WITHOUT temporal features)
 """
 
 import pandas as pd
-import numpy as np
 from pathlib import Path
-from sklearn.preprocessing import LabelEncoder
-import pickle
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import os
 import warnings
 warnings.filterwarnings('ignore')
 
+from dataset_io import EngineeredWriter, concat_engineered
+from feature_statistics import FeatureStatistics
+from feature_store import FeatureStore
+from feature_lookups import FeatureLookupBuilder, build_feature_lookups
+from feature_pipeline import FeaturePipeline
+from guard_metadata import GUARD_COLUMNS, build_guard_metadata, save_guard_metadata
+from pipeline_profile import TRACE_MEMORY, PipelineProfiler, stage
+
 def engineer_features(df):
     """Apply all feature engineering transformations"""
     
     print("Starting feature engineering...")
     print(f"Input shape: {df.shape}")
     
-    # A. Bandwidth features (7 features)
-    print("\n[1/5] Creating bandwidth features...")
-    df['bw_ratio_guard_middle'] = df['guard_bandwidth'] / (df['middle_bandwidth'] + 1)
-    df['bw_ratio_guard_exit'] = df['guard_bandwidth'] / (df['exit_bandwidth'] + 1)
-    df['bw_ratio_middle_exit'] = df['middle_bandwidth'] / (df['exit_bandwidth'] + 1)
-    df['bw_total'] = df['guard_bandwidth'] + df['middle_bandwidth'] + df['exit_bandwidth']
-    df['bw_min'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].min(axis=1)
-    df['bw_max'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].max(axis=1)
-    df['bw_std'] = df[['guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth']].std(axis=1)
-    
-    # B. Geographic features (5 features)
-    print("[2/5] Creating geographic features...")
-    df['same_country_guard_middle'] = (df['guard_country'] == df['middle_country']).astype(int)
-    df['same_country_guard_exit'] = (df['guard_country'] == df['exit_country']).astype(int)
-    df['same_country_middle_exit'] = (df['middle_country'] == df['exit_country']).astype(int)
-    df['all_same_country'] = ((df['guard_country'] == df['middle_country']) & 
-                               (df['guard_country'] == df['exit_country'])).astype(int)
-    df['country_diversity'] = df[['guard_country', 'middle_country', 'exit_country']].nunique(axis=1)
-    
-    # C. Historical/Aggregate features (8 features)
-    print("[3/5] Creating historical aggregate features...")
-    
-    # Usage frequencies
-    guard_freq = df['guard_fingerprint'].value_counts().to_dict()
-    df['guard_usage_freq'] = df['guard_fingerprint'].map(guard_freq)
-    
-    middle_freq = df['middle_fingerprint'].value_counts().to_dict()
-    exit_freq = df['exit_fingerprint'].value_counts().to_dict()
-    df['middle_usage_freq'] = df['middle_fingerprint'].map(middle_freq)
-    df['exit_usage_freq'] = df['exit_fingerprint'].map(exit_freq)
-    
-    # Guard-Exit pair frequency (VERY IMPORTANT for prediction!)
-    pair_freq = df.groupby(['guard_fingerprint', 'exit_fingerprint']).size().to_dict()
-    df['guard_exit_pair_freq'] = df.apply(
-        lambda x: pair_freq.get((x['guard_fingerprint'], x['exit_fingerprint']), 0), axis=1
-    )
-    
-    # Average bandwidth by guard
-    guard_avg_bw = df.groupby('guard_fingerprint')['guard_bandwidth'].mean().to_dict()
-    df['guard_avg_bandwidth'] = df['guard_fingerprint'].map(guard_avg_bw)
+    # Frequency tables and vocabularies over the whole dataset
+    with stage('statistics'):
+        stats = FeatureStatistics.from_frame(df)
+        encoders = stats.fit_encoders()
     
-    # Guard-Middle pair frequency
-    guard_middle_freq = df.groupby(['guard_fingerprint', 'middle_fingerprint']).size().to_dict()
-    df['guard_middle_pair_freq'] = df.apply(
-        lambda x: guard_middle_freq.get((x['guard_fingerprint'], x['middle_fingerprint']), 0), axis=1
-    )
-    
-    # Country preference score
-    guard_country_pref = df.groupby(['guard_fingerprint', 'exit_country']).size()
-    guard_country_pref = guard_country_pref.reset_index(name='count')
-    guard_top_country = guard_country_pref.sort_values('count', ascending=False).groupby('guard_fingerprint')['exit_country'].first().to_dict()
-    df['guard_prefers_exit_country'] = (df.apply(
-        lambda x: x['exit_country'] == guard_top_country.get(x['guard_fingerprint'], ''), axis=1
-    )).astype(int)
-    
-    # D. Label Encoding (5 features)
-    print("[4/5] Encoding categorical features...")
-    encoders = {}
-    
-    # Encode fingerprints and countries
-    for col in ['middle_fingerprint', 'exit_fingerprint', 
-                'guard_country', 'middle_country', 'exit_country']:
-        le = LabelEncoder()
-        df[f'{col}_encoded'] = le.fit_transform(df[col])
-        encoders[col] = le
-    
-    # Target encoding (THIS IS OUR PREDICTION TARGET)
-    le_target = LabelEncoder()
-    df['guard_label'] = le_target.fit_transform(df['guard_fingerprint'])
-    encoders['guard_fingerprint'] = le_target
+    with stage('transform', rows=len(df)):
+        df = stats.transform(df, encoders, verbose=True)
     
     print(f"  Encoded {len(encoders)} categorical variables")
     print(f"  Target classes: {df['guard_label'].nunique()}")
     
-    # E. Interaction features (2 features)
-    print("[5/5] Creating interaction features...")
-    df['bw_guard_x_setup'] = df['guard_bandwidth'] * df['circuit_setup_duration']
-    df['bw_total_x_bytes'] = df['bw_total'] * df['total_bytes']
-    
     print(f"\n✓ Feature engineering complete!")
     print(f"  Output shape: {df.shape}")
     print(f"  New features created: {df.shape[1] - 23}")
@@ -103,39 +43,334 @@ def engineer_features(df):
     return df, encoders
 
 
-if __name__ == "__main__":
+def iter_chunks(data_path, chunksize):
+    """Yield a raw CSV whole (chunksize <= 0) or in chunks of chunksize circuits"""
+    if chunksize > 0:
+        yield from pd.read_csv(data_path, chunksize=chunksize)
+    else:
+        yield pd.read_csv(data_path)
+
+
+def collect_statistics(data_path, chunksize=0):
+    """Pass 1: frequency tables and vocabularies of one raw CSV"""
+    stats = FeatureStatistics()
+    for chunk in iter_chunks(data_path, chunksize):
+        stats.update(chunk)
+    return stats
+
+
+def engineer_file(data_path, output_path, stats, encoders, chunksize=0):
+    """
+    Pass 2: engineer one raw CSV with fitted statistics, writing it chunk by chunk
+    (CSV, Parquet or Feather, chosen by the output suffix)
+    
+    Returns:
+        (latest guard metadata rows, output columns, FeatureLookupBuilder)
+    """
+    guards = None
+    columns = []
+    lookups = FeatureLookupBuilder(encoders)
+    with EngineeredWriter(output_path) as writer:
+        for chunk in iter_chunks(data_path, chunksize):
+            chunk = stats.transform(chunk, encoders)
+            writer.write(chunk)
+            lookups.update(chunk)
+            columns = list(chunk.columns)
+            
+            # Latest observation of every guard, for the metadata artifact
+            latest = chunk[GUARD_COLUMNS] if guards is None else pd.concat([guards, chunk[GUARD_COLUMNS]])
+            guards = latest.drop_duplicates('guard_fingerprint', keep='last')
+    return guards, columns, lookups
+
+
+def engineer_features_streaming(data_path, output_path, chunksize):
+    """
+    Two-pass feature engineering with bounded memory
+    
+    Pass 1 streams the raw CSV to accumulate frequency tables and encoder
+    vocabularies. Pass 2 streams it again, engineers each chunk and appends
+    it to the output dataset. Only one chunk of circuits is in memory at a time.
+    
+    Returns:
+        (encoders, guard metadata rows, lookup tables, number of circuits, output columns)
+    """
+    print(f"Starting streaming feature engineering (chunks of {chunksize:,} circuits)...")
+    
+    print("\n[Pass 1/2] Accumulating frequency tables and vocabularies...")
+    with stage('statistics'):
+        stats = collect_statistics(data_path, chunksize)
+        encoders = stats.fit_encoders()
+    print(f"  {stats.n_rows:,} circuits, {len(stats.value_counts['guard_fingerprint']):,} guards")
+    
+    print("[Pass 2/2] Engineering and writing chunks...")
+    output_path.parent.mkdir(exist_ok=True)
+    with stage('transform', rows=stats.n_rows):
+        guards, columns, lookups = engineer_file(data_path, output_path, stats, encoders, chunksize)
+    
+    print(f"\n✓ Feature engineering complete!")
+    print(f"  Output shape: ({stats.n_rows}, {len(columns)})")
+    
+    return encoders, guards, lookups.build(), stats.n_rows, columns
+
+
+# Fitted statistics shared with pass-2 worker processes (set once per worker)
+_worker_stats = None
+_worker_encoders = None
+
+
+def _init_worker(stats, encoders):
+    global _worker_stats, _worker_encoders
+    _worker_stats, _worker_encoders = stats, encoders
+
+
+def _engineer_part(data_path, part_path, chunksize):
+    return engineer_file(data_path, part_path, _worker_stats, _worker_encoders, chunksize)
+
+
+def resolve_inputs(pattern, output_path=None):
+    """
+    Expand --input into a sorted list of raw capture files
+    
+    Accepts a single file, a directory (all circuit_data_*.csv inside it)
+    or a glob pattern. Engineered outputs are never treated as inputs.
+    """
+    path = Path(pattern)
+    if path.is_dir():
+        candidates = path.glob('circuit_data_*.csv')
+    elif any(ch in pattern for ch in '*?['):
+        candidates = (Path(p) for p in glob.glob(pattern))
+    else:
+        return [path]
+    
+    output = output_path.resolve() if output_path is not None else None
+    return sorted(p for p in candidates
+                  if 'engineered' not in p.name and (output is None or p.resolve() != output))
+
+
+def engineer_features_parallel(data_paths, output_path, chunksize, workers):
+    """
+    Map-reduce feature engineering over many capture files
+    
+    Each file's frequency tables and vocabularies are gathered in a process
+    pool and merged into one FeatureStatistics, so counts and encoders are
+    consistent across the whole collection. The pool then engineers every
+    file into a part file, and the parts are concatenated in input order.
+    
+    Returns:
+        (encoders, guard metadata rows, lookup tables, number of circuits, output columns)
+    """
+    print(f"Starting parallel feature engineering ({len(data_paths)} files, {workers} workers)...")
+    
+    print("\n[Pass 1/2] Accumulating per-file frequency tables...")
+    with stage('statistics', files=len(data_paths)):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            partials = list(pool.map(collect_statistics, data_paths, [chunksize] * len(data_paths)))
+        stats = FeatureStatistics()
+        for partial in partials:
+            stats.merge(partial)
+        encoders = stats.fit_encoders()
+    print(f"  {stats.n_rows:,} circuits, {len(stats.value_counts['guard_fingerprint']):,} guards")
+    
+    print("[Pass 2/2] Engineering files...")
+    with stage('transform', rows=stats.n_rows):
+        guards, columns, lookups = engineer_files(data_paths, output_path, stats, encoders, chunksize, workers)
+    
+    print(f"\n✓ Feature engineering complete!")
+    print(f"  Output shape: ({stats.n_rows}, {len(columns)})")
+    
+    return encoders, guards, lookups.build(), stats.n_rows, columns
+
+
+def engineer_files(data_paths, output_path, stats, encoders, chunksize, workers):
+    """
+    Pass 2 over many files: engineer each into a part file in a process pool
+    and concatenate the parts in input order
+    
+    Returns:
+        (latest guard metadata rows, output columns, FeatureLookupBuilder)
+    """
+    output_path.parent.mkdir(exist_ok=True)
+    if len(data_paths) == 1:
+        return engineer_file(data_paths[0], output_path, stats, encoders, chunksize)
+    
+    part_paths = [output_path.with_name(f"{output_path.stem}.part{i:04d}{output_path.suffix}")
+                  for i in range(len(data_paths))]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(stats, encoders)) as pool:
+        results = list(pool.map(_engineer_part, data_paths, part_paths, [chunksize] * len(data_paths)))
+    
+    # Reduce: concatenate parts and the latest guard rows
+    concat_engineered(part_paths, output_path)
+    for part_path in part_paths:
+        part_path.unlink()
+    
+    guards = pd.concat([g for g, _, _ in results]).drop_duplicates('guard_fingerprint', keep='last')
+    lookups = results[0][2]
+    for _, _, partial in results[1:]:
+        lookups.merge(partial)
+    return guards, results[0][1], lookups
+
+
+def engineer_features_from_store(store_path, data_paths, output_path, chunksize, workers):
+    """
+    Feature engineering with frequency tables kept in the incremental store
+    
+    Pass 1 only reads captures the store has not seen yet, so refreshing the
+    tables after a new capture costs O(new circuits). The store is then
+    materialized at its latest snapshot and every input is engineered with it.
+    
+    Returns:
+        (encoders, guard metadata rows, lookup tables, number of circuits, output columns)
+    """
+    print(f"Starting feature engineering from store {store_path}...")
+    
+    print("\n[Pass 1/2] Updating feature store with new captures...")
+    with stage('statistics', files=len(data_paths)), FeatureStore(store_path) as store:
+        for data_path in data_paths:
+            capture_id = store.ingest(data_path, chunksize)
+            if capture_id is not None:
+                print(f"  + {data_path.name} (snapshot {capture_id})")
+        snapshot = store.latest_snapshot()
+        stats = store.materialize(snapshot)
+        captures = store.captures()
+        encoders = stats.fit_encoders()
+    n_rows = int(captures.loc[captures['name'].isin([p.name for p in data_paths]), 'n_rows'].sum())
+    print(f"  Snapshot {snapshot}: {stats.n_rows:,} circuits, "
+          f"{len(stats.value_counts['guard_fingerprint']):,} guards")
+    
+    print("[Pass 2/2] Engineering files...")
+    with stage('transform', rows=n_rows):
+        guards, columns, lookups = engineer_files(data_paths, output_path, stats, encoders, chunksize, workers)
+    
+    print(f"\n✓ Feature engineering complete!")
+    print(f"  Output shape: ({n_rows}, {len(columns)})")
+    
+    return encoders, guards, lookups.build(), n_rows, columns
+
+
+def main():
+    """Main entry point"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(
+        description='Engineer ML features from raw Tor circuit captures'
+    )
+    
+    parser.add_argument(
+        '-i', '--input',
+        default='data/circuit_data_20251120_221959.csv',
+        help='Raw circuit CSV, directory of circuit_data_*.csv captures or glob '
+             '(default: data/circuit_data_20251120_221959.csv)'
+    )
+    
+    parser.add_argument(
+        '-o', '--output',
+        default='data/circuit_data_engineered.parquet',
+        help='Engineered dataset path; .parquet, .feather or .csv '
+             '(default: data/circuit_data_engineered.parquet)'
+    )
+    
+    parser.add_argument(
+        '-c', '--chunksize',
+        type=int,
+        default=0,
+        help='Stream the input in chunks of this many circuits (default: 0, load everything)'
+    )
+    
+    parser.add_argument(
+        '-s', '--store',
+        default=None,
+        help='Keep frequency tables in this incremental SQLite feature store and '
+             'only count captures it has not seen (e.g. data/feature_store.sqlite)'
+    )
+    
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Worker processes when several input files are given (default: CPU count)'
+    )
+    
+    parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        default=TRACE_MEMORY,
+        help='Record tracemalloc peaks per stage in models/pipeline_profile.json '
+             '(slows pandas string work several-fold; timings are always recorded)'
+    )
+    
+    args = parser.parse_args()
+    
     print("="*80)
     print(" TOR GUARD PREDICTION - FEATURE ENGINEERING")
     print("="*80)
     print()
     
     # Load raw data
-    data_path = Path("data/circuit_data_20251120_221959.csv")
+    output_path = Path(args.output)
+    data_paths = resolve_inputs(args.input, output_path)
     
-    if not data_path.exists():
-        print(f"❌ Error: Dataset not found at {data_path}")
+    if not data_paths or not all(p.exists() for p in data_paths):
+        print(f"❌ Error: Dataset not found at {args.input}")
         print("Please ensure the circuit data file exists.")
         exit(1)
+    data_path = data_paths[0]
     
-    df = pd.read_csv(data_path)
-    print(f"✓ Loaded {len(df):,} circuits with {df.shape[1]} raw features")
+    # Wall time and memory peak of every stage, saved to models/pipeline_profile.json
+    profiler = PipelineProfiler('prepare_features', trace_memory=args.trace_memory).start()
     
-    # Engineer features
-    df_engineered, encoders = engineer_features(df)
+    if args.store:
+        # Historical counts from the store, refreshed with new captures only
+        with stage('engineer', mode='store'):
+            encoders, guards, lookups, n_rows, columns = engineer_features_from_store(
+                Path(args.store), data_paths, output_path, args.chunksize, max(1, args.workers)
+            )
+    elif len(data_paths) > 1:
+        # Per-file statistics in a process pool, merged into one dataset
+        with stage('engineer', mode='parallel'):
+            encoders, guards, lookups, n_rows, columns = engineer_features_parallel(
+                data_paths, output_path, args.chunksize, max(1, args.workers)
+            )
+    elif args.chunksize > 0:
+        # Engineer features chunk by chunk, appending to the output
+        with stage('engineer', mode='streaming'):
+            encoders, guards, lookups, n_rows, columns = engineer_features_streaming(
+                data_path, output_path, args.chunksize
+            )
+    else:
+        with stage('load_csv') as record:
+            df = pd.read_csv(data_path)
+            record['rows'] = len(df)
+        print(f"✓ Loaded {len(df):,} circuits with {df.shape[1]} raw features")
+        
+        # Engineer features
+        with stage('engineer', mode='in-memory'):
+            df_engineered, encoders = engineer_features(df)
+        guards, n_rows, columns = df_engineered, len(df_engineered), list(df_engineered.columns)
+        with stage('build_lookups'):
+            lookups = build_feature_lookups(df_engineered, encoders)
+        
+        # Save processed dataset
+        with stage('write_dataset', rows=n_rows), EngineeredWriter(output_path) as writer:
+            writer.write(df_engineered)
     
-    # Save processed dataset
-    output_path = Path("data/circuit_data_engineered.csv")
-    output_path.parent.mkdir(exist_ok=True)
-    df_engineered.to_csv(output_path, index=False)
     print(f"\n✓ Saved engineered dataset: {output_path}")
+    print(f"  Circuits: {n_rows:,}")
     print(f"  File size: {output_path.stat().st_size / 1024**2:.2f} MB")
     
-    # Save encoders for inference
-    encoder_path = Path("models/encoders.pkl")
-    encoder_path.parent.mkdir(exist_ok=True)
-    with open(encoder_path, 'wb') as f:
-        pickle.dump(encoders, f)
-    print(f"✓ Saved {len(encoders)} encoders: {encoder_path}")
+    # Save the fitted feature pipeline (encoder vocabularies, historical
+    # lookup tables and feature order) shared by batch inference and the API
+    with stage('save_pipeline'):
+        pipeline = FeaturePipeline(encoders, lookups)
+        pipeline.save("models")
+    print(f"✓ Saved feature pipeline: {len(encoders)} encoders, {len(lookups['exit'][0]) - 1:,} exit and "
+          f"{len(lookups['middle'][0]) - 1:,} middle lookup rows, {pipeline.n_features} features")
+    
+    # Save one-row-per-guard metadata for the API
+    with stage('guard_metadata'):
+        guard_meta = build_guard_metadata(guards)
+        guard_meta_path = Path("models/guard_metadata.npy")
+        save_guard_metadata(guard_meta, guard_meta_path)
+    print(f"✓ Saved metadata for {len(guard_meta):,} guards: {guard_meta_path}")
     
     # Print feature summary
     print("\n" + "="*80)
@@ -160,7 +395,16 @@ if __name__ == "__main__":
     
     print(f"\n  Total new features: {total_new}")
     print(f"  Original features: 23")
-    print(f"  Final feature count: {df_engineered.shape[1]}")
+    print(f"  Final feature count: {len(columns)}")
+    
+    profiler.stop()
+    profiler.print_summary()
+    profile_path = profiler.save("models")
+    print(f"✓ Stage profile saved: {profile_path}")
     
     print("\n✓ Feature engineering pipeline complete!")
     print("  Next step: python scripts/train_xgboost.py")
+
+
+if __name__ == "__main__":
+    main()
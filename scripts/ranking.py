@@ -0,0 +1,70 @@
+"""
+Ranking utilities shared by training, batch inference and the API
+Top-K selection and true-label ranks over (n_samples, n_classes) probability matrices
+"""
+
+import numpy as np
+
+
+def top_k(probabilities, k):
+    """
+    Top-K classes per row, highest probability first
+
+    Uses a batched argpartition over the whole matrix (O(n_classes) per row)
+    and only sorts the K survivors, instead of argsorting every class.
+
+    Args:
+        probabilities: Array of shape (n_samples, n_classes)
+        k: Number of classes to keep (clipped to n_classes)
+
+    Returns:
+        (indices, scores), both of shape (n_samples, k)
+    """
+    probabilities = np.asarray(probabilities)
+    if probabilities.ndim == 1:
+        probabilities = probabilities[None, :]
+    n_classes = probabilities.shape[1]
+    k = max(1, min(int(k), n_classes))
+
+    if k < n_classes:
+        candidates = np.argpartition(probabilities, n_classes - k, axis=1)[:, n_classes - k:]
+    else:
+        candidates = np.broadcast_to(np.arange(n_classes), probabilities.shape)
+
+    candidate_scores = np.take_along_axis(probabilities, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    indices = np.take_along_axis(candidates, order, axis=1)
+    scores = np.take_along_axis(candidate_scores, order, axis=1)
+    return indices, scores
+
+
+def true_label_ranks(probabilities, y_true, chunk_size=8192):
+    """
+    1-based rank of the true label in every row
+
+    The rank is the number of classes scoring at least as high as the true
+    class, so no per-row sort is needed. Ties count against the true label:
+    a label scored 0 alongside every guard a two-stage shortlist left out
+    ranks behind all of them, not just behind the shortlist. Rows are
+    processed in chunks to bound the size of the temporary comparison matrix.
+
+    Args:
+        probabilities: Array of shape (n_samples, n_classes)
+        y_true: Integer labels of shape (n_samples,)
+        chunk_size: Rows compared per step
+
+    Returns:
+        Integer array of shape (n_samples,)
+    """
+    probabilities = np.asarray(probabilities)
+    y_true = np.asarray(y_true, dtype=np.int64)
+    ranks = np.empty(len(y_true), dtype=np.int64)
+
+    for start in range(0, len(y_true), chunk_size):
+        stop = start + chunk_size
+        block = probabilities[start:stop]
+        true_scores = block[np.arange(block.shape[0]), y_true[start:stop]]
+        # Includes the true class itself
+        ranks[start:stop] = np.count_nonzero(block >= true_scores[:, None], axis=1)
+
+    return ranks
@@ -1,275 +1,487 @@
 """
 XGBoost Multi-Class Classifier for Guard Node Prediction
-Optimized for Top-K accuracy and MRR metrics
+Optimized for Top-K accuracy and MRR metrics; --model two-stage trains the
+shortlist-then-rank alternative instead (scripts/two_stage.py)
 """
 
+import argparse
 import pandas as pd
 import numpy as np
 import xgboost as xgb
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import accuracy_score, top_k_accuracy_score, classification_report
 from pathlib import Path
 import pickle
 import json
+import shutil
+import tempfile
 import time
 import warnings
 warnings.filterwarnings('ignore')
 
-def calculate_mrr(y_true, y_pred_proba, k=50):
+from dataset_io import DEFAULT_BATCH_ROWS, engineered_columns, find_engineered, read_engineered
+from evaluation import DEFAULT_K_VALUES, compute_ranks, evaluate_ranking, evaluate_ranks
+from external_memory import (SPLIT_TEST, SPLIT_TRAIN, SPLIT_VAL, build_dmatrix, iter_split,
+                             read_labels, split_assignments, split_indices)
+from feature_pipeline import FeaturePipeline
+from model_bundle import iteration_range, write_bundle
+from pipeline_profile import TRACE_MEMORY, PipelineProfiler, stage
+from two_stage import DEFAULT_SHORTLIST_SIZE, shortlist_recall, train_two_stage
+
+# XGBoost parameters optimized for multi-class ranking (num_class is set per dataset)
+MODEL_PARAMS = {
+    'objective': 'multi:softprob',  # Output probabilities for ranking
+    'eval_metric': 'mlogloss',
+    'max_depth': 10,
+    'learning_rate': 0.1,
+    'n_estimators': 300,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'min_child_weight': 3,
+    'gamma': 0.1,
+    'reg_alpha': 0.1,
+    'reg_lambda': 1.0,
+    'tree_method': 'hist',
+    'random_state': 42,
+    'n_jobs': -1,
+    'early_stopping_rounds': 20
+}
+
+# Columns that are identifiers or the target, never model inputs
+EXCLUDE_COLS = [
+    'request_id', 'circuit_id', 'timestamp', 'build_time', 'status', 'purpose',
+    'guard_fingerprint', 'guard_nickname', 'guard_address', 'guard_country',
+    'middle_fingerprint', 'middle_nickname', 'middle_address', 'middle_country',
+    'exit_fingerprint', 'exit_nickname', 'exit_address', 'exit_country',
+    'guard_label'  # This is our target
+]
+
+# Per-guard training columns the two-stage ranker builds its guard table and pair counts from
+GUARD_FRAME_COLS = ['guard_label', 'guard_country', 'guard_bandwidth',
+                    'exit_fingerprint_encoded', 'middle_fingerprint_encoded']
+
+
+def native_params(params, n_classes):
     """
-    Calculate Mean Reciprocal Rank
-    MRR measures ranking quality - higher is better
+    xgb.train equivalent of the XGBClassifier parameters
+
+    Returns:
+        (booster params, num_boost_round, early_stopping_rounds)
     """
-    mrr = 0
-    for i, true_label in enumerate(y_true):
-        # Get top-k predictions (highest probabilities)
-        top_k_indices = np.argsort(y_pred_proba[i])[::-1][:k]
-        
-        # Find rank of true label
-        if true_label in top_k_indices:
-            rank = np.where(top_k_indices == true_label)[0][0] + 1
-            mrr += 1.0 / rank
-    
-    return mrr / len(y_true)
+    native = {k: v for k, v in params.items()
+              if k not in ('n_estimators', 'early_stopping_rounds', 'random_state', 'n_jobs')}
+    native['num_class'] = n_classes
+    native['seed'] = params['random_state']
+    if params['n_jobs'] > 0:
+        native['nthread'] = params['n_jobs']
+    return native, params['n_estimators'], params['early_stopping_rounds']
 
 
-def evaluate_topk(y_true, y_pred_proba, k_values=[1, 3, 5, 10, 20, 50]):
-    """Calculate Top-K accuracies"""
-    results = {}
-    
-    for k in k_values:
-        if k == 1:
-            # Top-1 is standard accuracy
-            y_pred = np.argmax(y_pred_proba, axis=1)
-            acc = accuracy_score(y_true, y_pred)
-        else:
-            acc = top_k_accuracy_score(y_true, y_pred_proba, k=k, labels=np.arange(y_pred_proba.shape[1]))
-        
-        results[f'Top-{k}'] = acc
-    
-    return results
+def label_classes(labels):
+    """
+    Number of softprob outputs for a label vector
 
+    Labels are guard encoder codes. A store-mode dataset only holds the
+    circuits of the captures just engineered, so some codes may have no
+    rows: the class count is the highest code + 1, not the distinct count.
+    """
+    return int(np.max(labels)) + 1
 
-def train_xgboost_model(X_train, y_train, X_val, y_val, n_classes):
-    """Train XGBoost multi-class classifier"""
-    
-    print("\n" + "="*80)
-    print(" TRAINING XGBOOST MODEL")
-    print("="*80)
-    print(f"\nTraining Configuration:")
-    print(f"  Training samples: {len(X_train):,}")
-    print(f"  Validation samples: {len(X_val):,}")
-    print(f"  Number of classes (guards): {n_classes}")
-    print(f"  Number of features: {X_train.shape[1]}")
-    
-    # XGBoost parameters optimized for multi-class ranking
-    params = {
-        'objective': 'multi:softprob',  # Output probabilities for ranking
-        'num_class': n_classes,
-        'eval_metric': 'mlogloss',
-        'max_depth': 10,
-        'learning_rate': 0.1,
-        'n_estimators': 300,
-        'subsample': 0.8,
-        'colsample_bytree': 0.8,
-        'min_child_weight': 3,
-        'gamma': 0.1,
-        'reg_alpha': 0.1,
-        'reg_lambda': 1.0,
-        'tree_method': 'hist',
-        'random_state': 42,
-        'n_jobs': -1,
-        'early_stopping_rounds': 20
-    }
+
+def fit_booster(dtrain, dval, n_classes, eval_train=False):
+    """
+    Boost on prebuilt DMatrix objects with early stopping on dval
+
+    Training loss is only reported when eval_train is set; the validation
+    set always comes last so it drives early stopping.
+    """
+    params, num_boost_round, early_stopping_rounds = native_params(MODEL_PARAMS, n_classes)
     
     print("\nXGBoost Hyperparameters:")
     for key, value in params.items():
         print(f"  {key:20s}: {value}")
     
-    # Initialize model
-    model = xgb.XGBClassifier(**params)
+    evals = ([(dtrain, 'train')] if eval_train else []) + [(dval, 'validation')]
     
     # Train with early stopping
     print("\nTraining in progress...")
     start_time = time.time()
     
-    model.fit(
-        X_train, y_train,
-        eval_set=[(X_train, y_train), (X_val, y_val)],
-        verbose=50
-    )
+    with stage('fit') as record:
+        booster = xgb.train(
+            params, dtrain, num_boost_round=num_boost_round, evals=evals,
+            early_stopping_rounds=early_stopping_rounds, verbose_eval=50
+        )
+        record['rounds'] = booster.num_boosted_rounds()
     
     training_time = time.time() - start_time
     
     print(f"\n✓ Training complete!")
     print(f"  Training time: {training_time:.2f} seconds ({training_time/60:.2f} minutes)")
-    print(f"  Best iteration: {model.best_iteration}")
-    print(f"  Best validation score: {model.best_score:.4f}")
+    print(f"  Best iteration: {booster.best_iteration}")
+    print(f"  Best validation score: {booster.best_score:.4f}")
+    
+    return booster
+
+
+def train_xgboost_model(X_train, y_train, X_val, y_val, n_classes, feature_cols, eval_train=False):
+    """
+    Train XGBoost multi-class classifier
+
+    Each split is quantized once into a QuantileDMatrix; validation reuses
+    the training bin boundaries (ref=dtrain) instead of sketching its own.
+    """
+    
+    print("\n" + "="*80)
+    print(" TRAINING XGBOOST MODEL")
+    print("="*80)
+    print(f"\nTraining Configuration:")
+    print(f"  Training samples: {len(X_train):,}")
+    print(f"  Validation samples: {len(X_val):,}")
+    print(f"  Number of classes (guards): {n_classes}")
+    print(f"  Number of features: {X_train.shape[1]}")
+    
+    start_time = time.time()
+    with stage('build_dmatrix', rows=len(X_train) + len(X_val)):
+        dtrain = xgb.QuantileDMatrix(X_train, y_train, feature_names=feature_cols)
+        dval = xgb.QuantileDMatrix(X_val, y_val, feature_names=feature_cols, ref=dtrain)
+    print(f"\n✓ QuantileDMatrix built in {time.time() - start_time:.2f} seconds")
+    
+    return fit_booster(dtrain, dval, n_classes, eval_train)
+
+
+def train_external_memory(data_path, feature_cols, mode='quantile', batch_rows=DEFAULT_BATCH_ROWS, eval_train=False):
+    """
+    Train from on-disk shards through xgboost.DataIter
+
+    Only the labels (to reproduce the stratified split) and one batch of
+    features are ever held in pandas. Training data goes into a
+    QuantileDMatrix or an external-memory DMatrix, test rows are ranked
+    batch by batch.
+
+    Returns:
+        (booster, ranking report, n_classes, split sizes)
+    """
+    print("\nReading labels for the stratified split...")
+    with stage('split') as record:
+        labels = read_labels(data_path, batch_rows)
+        n_classes = label_classes(labels)
+        split = split_assignments(labels)
+        record['rows'] = len(labels)
+    sizes = {name: int((split == code).sum()) for name, code in
+             (('train', SPLIT_TRAIN), ('val', SPLIT_VAL), ('test', SPLIT_TEST))}
+    del labels
     
-    return model
+    print("\n" + "="*80)
+    print(" TRAINING XGBOOST MODEL (EXTERNAL MEMORY)")
+    print("="*80)
+    print(f"\nTraining Configuration:")
+    print(f"  Data: {data_path} (batches of {batch_rows:,} rows, {mode} DMatrix)")
+    print(f"  Training samples: {sizes['train']:,}")
+    print(f"  Validation samples: {sizes['val']:,}")
+    print(f"  Number of classes (guards): {n_classes}")
+    print(f"  Number of features: {len(feature_cols)}")
+    
+    cache_dir = Path(tempfile.mkdtemp(prefix='xgb-cache-')) if mode == 'external' else None
+    try:
+        start_time = time.time()
+        with stage('build_dmatrix', rows=sizes['train'] + sizes['val']):
+            dtrain = build_dmatrix(data_path, feature_cols, split, SPLIT_TRAIN, mode, batch_rows, cache_dir)
+            dval = build_dmatrix(data_path, feature_cols, split, SPLIT_VAL, mode, batch_rows, cache_dir, ref=dtrain)
+        print(f"\n✓ DMatrix built in {time.time() - start_time:.2f} seconds")
+        
+        booster = fit_booster(dtrain, dval, n_classes, eval_train)
+        del dtrain, dval
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    
+    print("\nRanking test set in batches...")
+    trees = iteration_range(booster)
+    with stage('rank_test', rows=sizes['test']):
+        ranks = np.concatenate([
+            compute_ranks(y, booster.inplace_predict(X, iteration_range=trees).reshape(len(X), -1))
+            for X, y in iter_split(data_path, feature_cols, split, SPLIT_TEST, batch_rows)
+        ])
+    return booster, evaluate_ranks(ranks), n_classes, sizes
+
+
+def gain_importance(booster, feature_cols):
+    """Average-gain importance per feature, normalized to sum to 1 (as XGBClassifier.feature_importances_)"""
+    scores = booster.get_score(importance_type='gain')
+    importance = np.array([scores.get(col, 0.0) for col in feature_cols], dtype=np.float32)
+    total = importance.sum()
+    return importance / total if total > 0 else importance
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Train the XGBoost guard ranking model")
+    parser.add_argument('-d', '--data', default=None,
+                        help="Engineered dataset file or shard directory (default: data/circuit_data_engineered.*)")
+    parser.add_argument('--external-memory', action='store_true',
+                        help="Stream shards from disk through xgboost.DataIter instead of loading them into pandas")
+    parser.add_argument('--dmatrix', choices=['quantile', 'external'], default='quantile',
+                        help="External-memory mode: QuantileDMatrix (bins in RAM) or paged external-memory DMatrix")
+    parser.add_argument('--batch-rows', type=int, default=DEFAULT_BATCH_ROWS,
+                        help=f"Rows per streamed batch (default: {DEFAULT_BATCH_ROWS:,})")
+    parser.add_argument('--eval-train', action='store_true',
+                        help="Also report training-set mlogloss every round")
+    parser.add_argument('--model', choices=['multiclass', 'two-stage'], default='multiclass',
+                        help="multi:softprob over all guards, or guard-cluster shortlist + candidate scorer")
+    parser.add_argument('--shortlist-size', type=int, default=DEFAULT_SHORTLIST_SIZE,
+                        help=f"Two-stage: guards scored by the second stage per circuit (default: {DEFAULT_SHORTLIST_SIZE})")
+    parser.add_argument('--params', default=None,
+                        help="JSON file of hyperparameters overriding the defaults (e.g. models/best_hyperparameters.json)")
+    parser.add_argument('--trace-memory', action='store_true', default=TRACE_MEMORY,
+                        help="Record tracemalloc peaks per stage in models/pipeline_profile.json (slows Python code)")
+    args = parser.parse_args()
+    two_stage = args.model == 'two-stage'
+    
     print("="*80)
     print(" TOR GUARD PREDICTION - XGBOOST TRAINING PIPELINE")
     print("="*80)
     print()
     
     # Load engineered dataset
-    data_path = Path("data/circuit_data_engineered.csv")
+    data_path = Path(args.data) if args.data else find_engineered("data")
     
-    if not data_path.exists():
-        print(f"❌ Error: Engineered dataset not found at {data_path}")
+    if data_path is None or not data_path.exists():
+        print("❌ Error: Engineered dataset not found in data/")
         print("Please run: python scripts/prepare_features.py first")
         exit(1)
     
-    df = pd.read_csv(data_path)
-    print(f"✓ Loaded dataset: {len(df):,} samples, {df.shape[1]} columns")
+    if two_stage and args.external_memory:
+        print("❌ Error: --model two-stage trains in memory; drop --external-memory")
+        exit(1)
     
-    # Define feature columns (exclude identifiers and target)
-    exclude_cols = [
-        'request_id', 'circuit_id', 'timestamp', 'build_time', 'status', 'purpose',
-        'guard_fingerprint', 'guard_nickname', 'guard_address', 'guard_country',
-        'middle_fingerprint', 'middle_nickname', 'middle_address', 'middle_country',
-        'exit_fingerprint', 'exit_nickname', 'exit_address', 'exit_country',
-        'guard_label'  # This is our target
-    ]
+    model_dir = Path("models")
+    model_dir.mkdir(exist_ok=True)
     
-    feature_cols = [col for col in df.columns if col not in exclude_cols]
+    # Wall time and memory peak of every stage, saved to models/pipeline_profile.json
+    profiler = PipelineProfiler('train_xgboost', trace_memory=args.trace_memory).start()
     
-    print(f"\nFeature columns ({len(feature_cols)}):")
+    if args.params:
+        with open(args.params) as f:
+            overrides = json.load(f)
+        # optimize_hyperparameters.py writes {'params': {...}, ...}; a plain dict works too
+        MODEL_PARAMS.update(overrides.get('params', overrides))
+        print(f"✓ Hyperparameters loaded from {args.params}")
+    
+    # Define feature columns (exclude identifiers and target)
+    feature_cols = [col for col in engineered_columns(data_path) if col not in EXCLUDE_COLS]
+    
+    print(f"Feature columns ({len(feature_cols)}):")
     for i, col in enumerate(feature_cols, 1):
         print(f"  {i:2d}. {col}")
     
-    # Prepare data
-    X = df[feature_cols]
-    y = df['guard_label']
-    n_classes = df['guard_label'].nunique()
-    
-    print(f"\nDataset Statistics:")
-    print(f"  Total samples: {len(X):,}")
-    print(f"  Number of guards (classes): {n_classes}")
-    print(f"  Samples per guard (avg): {len(X)/n_classes:.1f}")
-    
-    # Check for missing values
-    if X.isnull().sum().sum() > 0:
-        print("\n⚠ Warning: Missing values detected!")
-        print(X.isnull().sum()[X.isnull().sum() > 0])
-        print("Filling missing values with 0...")
-        X = X.fillna(0)
-    
-    # Train/Val/Test split (70/15/15)
-    print("\nSplitting data...")
-    X_temp, X_test, y_temp, y_test = train_test_split(
-        X, y, test_size=0.15, random_state=42, stratify=y
-    )
-    
-    X_train, X_val, y_train, y_val = train_test_split(
-        X_temp, y_temp, test_size=0.176, random_state=42, stratify=y_temp  # 0.176 * 0.85 ≈ 0.15
-    )
-    
-    print(f"\nData Split:")
-    print(f"  Train: {len(X_train):,} samples ({len(X_train)/len(X)*100:.1f}%)")
-    print(f"  Val:   {len(X_val):,} samples ({len(X_val)/len(X)*100:.1f}%)")
-    print(f"  Test:  {len(X_test):,} samples ({len(X_test)/len(X)*100:.1f}%)")
-    
-    # Train model
-    model = train_xgboost_model(X_train, y_train, X_val, y_val, n_classes)
-    
-    # Evaluate on test set
+    if args.external_memory:
+        k_values = DEFAULT_K_VALUES
+        with stage('train', mode=f'external-memory ({args.dmatrix})'):
+            booster, ranking, n_classes, split_sizes = train_external_memory(
+                data_path, feature_cols, mode=args.dmatrix, batch_rows=args.batch_rows, eval_train=args.eval_train
+            )
+    else:
+        # Only the model inputs and the target are read from disk
+        extra_cols = [col for col in GUARD_FRAME_COLS if col not in feature_cols] if two_stage else ['guard_label']
+        with stage('load_dataset') as record:
+            df = read_engineered(data_path, columns=feature_cols + extra_cols)
+            record['rows'] = len(df)
+        print(f"\n✓ Loaded dataset: {len(df):,} samples, {df.shape[1]} columns ({data_path.name})")
+        
+        # Prepare data: one float32 matrix, split by row index rather than by DataFrame copies
+        with stage('prepare_matrix'):
+            X = df[feature_cols].to_numpy(dtype=np.float32)
+            y = df['guard_label'].to_numpy()
+            n_classes = label_classes(y)
+            n_guards_seen = df['guard_label'].nunique()
+            guard_frame = df[GUARD_FRAME_COLS] if two_stage else None
+            del df
+        
+        print(f"\nDataset Statistics:")
+        print(f"  Total samples: {len(X):,}")
+        print(f"  Number of guards (classes): {n_classes}")
+        print(f"  Guards with samples: {n_guards_seen}")
+        print(f"  Samples per guard (avg): {len(X)/n_guards_seen:.1f}")
+        
+        # Check for missing values
+        with stage('fill_missing'):
+            missing = np.isnan(X)
+            if missing.any():
+                print("\n⚠ Warning: Missing values detected!")
+                print(pd.Series(missing.sum(axis=0), index=feature_cols).loc[lambda counts: counts > 0])
+                print("Filling missing values with 0...")
+                X[missing] = 0.0
+            del missing
+        
+        # Train/Val/Test split (70/15/15)
+        print("\nSplitting data...")
+        with stage('split'):
+            train_index, val_index, test_index = split_indices(y)
+        
+        print(f"\nData Split:")
+        print(f"  Train: {len(train_index):,} samples ({len(train_index)/len(X)*100:.1f}%)")
+        print(f"  Val:   {len(val_index):,} samples ({len(val_index)/len(X)*100:.1f}%)")
+        print(f"  Test:  {len(test_index):,} samples ({len(test_index)/len(X)*100:.1f}%)")
+        split_sizes = {'train': len(train_index), 'val': len(val_index), 'test': len(test_index)}
+        
+        # Train model
+        with stage('train', mode=args.model):
+            if two_stage:
+                pipeline = FeaturePipeline.load(model_dir, feature_columns=feature_cols)
+                ranker = train_two_stage(X[train_index], y[train_index], X[val_index], y[val_index],
+                                         guard_frame.iloc[train_index], pipeline.encoders, feature_cols,
+                                         shortlist_size=args.shortlist_size)
+                booster = ranker.stage2
+            else:
+                booster = train_xgboost_model(X[train_index], y[train_index], X[val_index], y[val_index],
+                                              n_classes, feature_cols, eval_train=args.eval_train)
+        
+        # Evaluate on test set
+        print("\nGenerating predictions...")
+        with stage('predict', rows=len(test_index)):
+            if two_stage:
+                y_pred_proba = ranker.predict_proba(X[test_index])
+            else:
+                y_pred_proba = booster.inplace_predict(X[test_index], iteration_range=iteration_range(booster))
+        
+        # Two-stage scores are 0 outside the shortlist, so K stops at its size
+        k_values = [k for k in DEFAULT_K_VALUES if not two_stage or k <= ranker.shortlist_size]
+        
+        # Rank every test row once; Top-K, MRR@K and the histogram all derive from it
+        with stage('evaluate', rows=len(test_index)):
+            ranking = evaluate_ranking(y[test_index], y_pred_proba, k_values=k_values)
+            if two_stage:
+                recall = shortlist_recall(ranker, X[test_index], y[test_index])
+        if two_stage:
+            print(f"✓ Shortlist recall@{ranker.shortlist_size}: {recall*100:.2f}% of test circuits")
+    
     print("\n" + "="*80)
     print(" MODEL EVALUATION ON TEST SET")
     print("="*80)
     
-    print("\nGenerating predictions...")
-    y_pred_proba = model.predict_proba(X_test)
-    y_pred = np.argmax(y_pred_proba, axis=1)
-    
-    # Top-K accuracies
-    topk_results = evaluate_topk(y_test, y_pred_proba, k_values=[1, 3, 5, 10, 20, 50, 100])
+    topk_results = ranking['topk_accuracy']
     
     print("\n📊 Top-K Accuracy Results:")
     print("-" * 40)
     for metric, score in topk_results.items():
         print(f"  {metric:12s}: {score*100:6.2f}%")
     
-    # MRR
-    print("\nCalculating Mean Reciprocal Rank...")
-    mrr = calculate_mrr(y_test.values, y_pred_proba, k=50)
-    print(f"\n🎯 Mean Reciprocal Rank (MRR@50): {mrr:.4f}")
+    # MRR (at 50, or the largest K a short two-stage shortlist allows)
+    mrr_k = max(k for k in k_values if k <= 50)
+    mrr = ranking['mrr_at_k'][f'MRR@{mrr_k}']
+    print(f"\n🎯 Mean Reciprocal Rank (MRR@{mrr_k}): {mrr:.4f}")
     print(f"   (Higher is better, range: 0-1)")
     
-    # Feature importance
+    print("\n📉 True-label rank histogram:")
+    for bucket, count in ranking['rank_histogram'].items():
+        print(f"  rank {bucket:>6s}: {count:,}")
+    
+    # Feature importance (two-stage: the candidate scorer, including its cand_* features)
     print("\n📈 Top 20 Most Important Features:")
     print("-" * 60)
-    feature_importance = pd.DataFrame({
-        'feature': feature_cols,
-        'importance': model.feature_importances_
-    }).sort_values('importance', ascending=False)
+    importance_cols = ranker.candidate_columns if two_stage else feature_cols
+    with stage('feature_importance'):
+        feature_importance = pd.DataFrame({
+            'feature': importance_cols,
+            'importance': gain_importance(booster, importance_cols)
+        }).sort_values('importance', ascending=False)
     
     for i, row in feature_importance.head(20).iterrows():
         print(f"  {i+1:2d}. {row['feature']:40s}: {row['importance']:.4f}")
     
-    # Save model
-    model_dir = Path("models")
-    model_dir.mkdir(exist_ok=True)
-    
+    # Save model (the flat JSON file is multi-class only; two-stage models live in bundles)
     model_path = model_dir / "xgboost_guard_predictor.json"
-    model.save_model(model_path)
-    print(f"\n✓ Model saved: {model_path}")
-    
-    # Save feature columns for inference
-    feature_cols_path = model_dir / "feature_columns.pkl"
-    with open(feature_cols_path, 'wb') as f:
-        pickle.dump(feature_cols, f)
-    print(f"✓ Feature columns saved: {feature_cols_path}")
-    
-    # Save feature importance
-    feature_importance.to_csv(model_dir / "feature_importance.csv", index=False)
+    with stage('save_artifacts'):
+        if two_stage:
+            print(f"\nℹ Two-stage model: {model_path} left unchanged")
+        else:
+            booster.save_model(model_path)
+            print(f"\n✓ Model saved: {model_path}")
+        
+        # Save feature columns for inference
+        feature_cols_path = model_dir / "feature_columns.pkl"
+        with open(feature_cols_path, 'wb') as f:
+            pickle.dump(feature_cols, f)
+        print(f"✓ Feature columns saved: {feature_cols_path}")
+        
+        # Save feature importance
+        feature_importance.to_csv(model_dir / "feature_importance.csv", index=False)
     print(f"✓ Feature importance saved: {model_dir / 'feature_importance.csv'}")
     
     # Save evaluation metrics
     metrics = {
         'topk_accuracy': {k: float(v) for k, v in topk_results.items()},
         'mrr': float(mrr),
+        'mrr_at_k': ranking['mrr_at_k'],
+        'rank_histogram': ranking['rank_histogram'],
+        'mean_rank': ranking['mean_rank'],
         'n_classes': int(n_classes),
         'n_features': len(feature_cols),
-        'train_samples': len(X_train),
-        'val_samples': len(X_val),
-        'test_samples': len(X_test),
-        'best_iteration': int(model.best_iteration),
+        'train_samples': split_sizes['train'],
+        'val_samples': split_sizes['val'],
+        'test_samples': split_sizes['test'],
+        'best_iteration': int(booster.best_iteration),
+        'training_mode': f'external-memory ({args.dmatrix})' if args.external_memory else 'in-memory',
+        'model_type': args.model,
         'hyperparameters': {
-            'max_depth': 10,
-            'learning_rate': 0.1,
-            'n_estimators': 300,
-            'subsample': 0.8,
-            'colsample_bytree': 0.8
+            'max_depth': MODEL_PARAMS['max_depth'],
+            'learning_rate': MODEL_PARAMS['learning_rate'],
+            'n_estimators': MODEL_PARAMS['n_estimators'],
+            'subsample': MODEL_PARAMS['subsample'],
+            'colsample_bytree': MODEL_PARAMS['colsample_bytree']
         }
     }
     
+    if two_stage:
+        metrics['two_stage'] = {
+            'n_clusters': ranker.n_clusters,
+            'shortlist_size': ranker.shortlist_size,
+            'shortlist_recall': float(recall),
+            'stage1_best_iteration': int(ranker.stage1.best_iteration),
+        }
+    
     metrics_path = model_dir / "evaluation_metrics.json"
-    with open(metrics_path, 'w') as f:
+    with stage('save_metrics'), open(metrics_path, 'w') as f:
         json.dump(metrics, f, indent=2)
     
     print(f"✓ Metrics saved: {metrics_path}")
     
+    # Versioned serving bundle: UBJSON booster + pipeline + metrics, switched in via CURRENT
+    with stage('write_bundle'):
+        pipeline = FeaturePipeline.load(model_dir, feature_columns=feature_cols)
+        bundle_path = write_bundle(model_dir, None if two_stage else booster, pipeline, feature_cols, metrics,
+                                   guard_metadata_path=model_dir / "guard_metadata.npy",
+                                   ranker=ranker if two_stage else None)
+    print(f"✓ Model bundle saved: {bundle_path}")
+    
+    # Stage timings next to the metrics
+    profiler.stop()
+    profile_path = profiler.save(model_dir)
+    print(f"✓ Stage profile saved: {profile_path}")
+    
     # Print summary
     print("\n" + "="*80)
     print(" TRAINING COMPLETE - SUMMARY")
     print("="*80)
-    print(f"\n✓ Model: XGBoost Multi-Class Classifier")
+    if two_stage:
+        print(f"\n✓ Model: XGBoost Two-Stage Ranker ({ranker.n_clusters} clusters, shortlist {ranker.shortlist_size})")
+    else:
+        print(f"\n✓ Model: XGBoost Multi-Class Classifier")
     print(f"✓ Classes: {n_classes} guards")
     print(f"✓ Features: {len(feature_cols)}")
-    print(f"✓ Top-1 Accuracy: {topk_results['Top-1']*100:.2f}%")
-    print(f"✓ Top-5 Accuracy: {topk_results['Top-5']*100:.2f}%")
-    print(f"✓ Top-10 Accuracy: {topk_results['Top-10']*100:.2f}%")
-    print(f"✓ MRR@50: {mrr:.4f}")
+    for k in (1, 5, 10):
+        if f'Top-{k}' in topk_results:
+            print(f"✓ Top-{k} Accuracy: {topk_results[f'Top-{k}']*100:.2f}%")
+    print(f"✓ MRR@{mrr_k}: {mrr:.4f}")
+    
+    profiler.print_summary()
     
     print("\n📁 Saved Files:")
-    print(f"  • {model_path}")
+    if not two_stage:
+        print(f"  • {model_path}")
     print(f"  • {feature_cols_path}")
     print(f"  • {metrics_path}")
     print(f"  • {model_dir / 'feature_importance.csv'}")
+    print(f"  • {profile_path}")
+    print(f"  • {bundle_path}/")
     
     print("\n🚀 Next Steps:")
     print("  1. Review feature importance to understand predictions")
@@ -0,0 +1,424 @@
+"""
+Two-Stage Guard Ranker for TOR Guard Prediction
+A guard-cluster classifier shortlists candidate guards, then a binary
+scorer ranks only the shortlist, so trees evaluated per request grow with
+the number of clusters and the shortlist size instead of the guard count
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from model_bundle import iteration_range
+from pipeline_profile import stage
+
+
+MANIFEST_NAME = 'two_stage.json'
+STAGE1_NAME = 'stage1.ubj'
+STAGE2_NAME = 'stage2.ubj'
+GUARD_TABLE_NAME = 'two_stage_guards.npy'
+CLUSTER_NAME = 'two_stage_clusters.npy'
+PAIR_TABLES = ('exit', 'middle')
+
+DEFAULT_SHORTLIST_SIZE = 50
+DEFAULT_NEGATIVES = 7
+DEFAULT_BANDWIDTH_BUCKETS = 3
+# Queries scored per step when ranking many circuits (bounds the candidate matrix)
+SCORE_BATCH_ROWS = 2048
+
+STAGE1_PARAMS = {
+    'objective': 'multi:softprob',
+    'eval_metric': 'mlogloss',
+    'max_depth': 6,
+    'learning_rate': 0.1,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'min_child_weight': 3,
+    'tree_method': 'hist',
+    'seed': 42,
+}
+STAGE2_PARAMS = {
+    'objective': 'binary:logistic',
+    'eval_metric': 'logloss',
+    'max_depth': 8,
+    'learning_rate': 0.1,
+    'subsample': 0.8,
+    'colsample_bytree': 0.8,
+    'min_child_weight': 3,
+    'tree_method': 'hist',
+    'seed': 42,
+}
+NUM_BOOST_ROUND = 300
+EARLY_STOPPING_ROUNDS = 20
+
+# Per-guard columns of the guard table; the last two are the guard's
+# country in the exit/middle country vocabularies, only used for matching
+GUARD_COLUMNS = ['cand_avg_bandwidth', 'cand_usage', 'cand_country_encoded',
+                 'cand_exit_country_code', 'cand_middle_country_code']
+# Stage-two inputs appended to the query (circuit) features for each candidate
+CANDIDATE_FEATURES = ['cand_cluster_prob', 'cand_prior', 'cand_avg_bandwidth', 'cand_usage',
+                      'cand_country_encoded', 'cand_exit_pair_count', 'cand_middle_pair_count',
+                      'cand_same_country_exit', 'cand_same_country_middle', 'cand_same_country_guard',
+                      'cand_bw_ratio_exit', 'cand_bw_ratio_guard']
+# Query columns the candidate features are derived from (guard-side ones are imputed at serving time)
+QUERY_INPUTS = ['exit_fingerprint_encoded', 'middle_fingerprint_encoded', 'exit_country_encoded',
+                'middle_country_encoded', 'guard_country_encoded', 'exit_bandwidth', 'guard_bandwidth']
+
+
+def guard_clusters(countries, avg_bandwidth, n_buckets=DEFAULT_BANDWIDTH_BUCKETS):
+    """
+    Cluster id per guard: its country crossed with a bandwidth bucket
+
+    Buckets are guard-bandwidth quantiles, so large countries split into
+    several clusters of similar size.
+    """
+    edges = np.quantile(avg_bandwidth, np.linspace(0, 1, n_buckets + 1)[1:-1]) if len(avg_bandwidth) else []
+    buckets = np.searchsorted(edges, avg_bandwidth, side='right')
+    keys = pd.Series(pd.Categorical(countries).codes.astype(np.int64) * n_buckets + buckets)
+    return pd.factorize(keys, sort=True)[0].astype(np.int32)
+
+
+class PairCounts:
+    """Sparse (relay, guard) co-occurrence counts, looked up by binary search"""
+
+    def __init__(self, keys, counts, n_guards):
+        self.keys = keys
+        self.counts = counts
+        self.n_guards = n_guards
+
+    @classmethod
+    def fit(cls, relay_codes, guard_codes, n_guards):
+        valid = relay_codes >= 0
+        keys, counts = np.unique(relay_codes[valid].astype(np.int64) * n_guards + guard_codes[valid],
+                                 return_counts=True)
+        return cls(keys, counts.astype(np.float32), n_guards)
+
+    def lookup(self, relay_codes, guards):
+        """Counts for (n,) relay codes against (n, m) candidate guards; unseen pairs are 0"""
+        query = relay_codes.astype(np.int64)[:, None] * self.n_guards + guards
+        if not len(self.keys):
+            return np.zeros(query.shape, dtype=np.float32)
+        pos = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        return np.where((self.keys[pos] == query) & (relay_codes[:, None] >= 0), self.counts[pos], 0.0)
+
+
+class TwoStageRanker:
+    """
+    Shortlist-then-rank alternative to the n_guards-way softprob model
+
+    Stage one is a softprob classifier over guard clusters (country x
+    bandwidth bucket). A guard's prior is its cluster probability times its
+    share of the cluster's training circuits, and the shortlist_size guards
+    with the highest prior go to stage two: a binary scorer over the query
+    features plus per-candidate guard and pair features. Scores are
+    normalized over the shortlist; guards outside it get 0.
+
+    Query rows are the same FeaturePipeline rows the multi-class model
+    takes, in feature_columns order.
+    """
+
+    def __init__(self, stage1, stage2, clusters, guard_table, pairs, feature_columns,
+                 shortlist_size=DEFAULT_SHORTLIST_SIZE):
+        self.stage1 = stage1
+        self.stage2 = stage2
+        self.clusters = clusters
+        self.guard_table = guard_table
+        self.pairs = pairs
+        self.feature_columns = list(feature_columns)
+        self.n_guards = len(clusters)
+        self.n_clusters = int(clusters.max()) + 1 if len(clusters) else 0
+        self.shortlist_size = min(shortlist_size, self.n_guards)
+
+        usage = guard_table[:, GUARD_COLUMNS.index('cand_usage')].astype(np.float64)
+        cluster_usage = np.bincount(clusters, weights=usage, minlength=self.n_clusters)
+        self.cluster_share = (usage / np.maximum(cluster_usage[clusters], 1.0)).astype(np.float32)
+        self._inputs = [self.feature_columns.index(col) for col in QUERY_INPUTS]
+        self.stage1_trees = iteration_range(stage1)
+        self.stage2_trees = iteration_range(stage2) if stage2 is not None else (0, 0)
+
+    @property
+    def own_count_slots(self):
+        """Stage-two columns holding training-circuit counts"""
+        offset = len(self.feature_columns)
+        return [offset + CANDIDATE_FEATURES.index(col)
+                for col in ('cand_usage', 'cand_exit_pair_count', 'cand_middle_pair_count')]
+
+    @property
+    def candidate_columns(self):
+        return self.feature_columns + CANDIDATE_FEATURES
+
+    def cluster_proba(self, X):
+        return self.stage1.inplace_predict(X, iteration_range=self.stage1_trees).reshape(len(X), -1)
+
+    def shortlist(self, X):
+        """
+        Candidate guards per query, highest prior first
+
+        Returns:
+            (candidates (n, shortlist_size) int32, cluster probabilities (n, n_clusters))
+        """
+        cluster_proba = self.cluster_proba(X)
+        prior = cluster_proba[:, self.clusters] * self.cluster_share
+        s = self.shortlist_size
+        if s < self.n_guards:
+            candidates = np.argpartition(-prior, s - 1, axis=1)[:, :s]
+        else:
+            candidates = np.broadcast_to(np.arange(self.n_guards), prior.shape)
+        order = np.argsort(-np.take_along_axis(prior, candidates, axis=1), axis=1, kind='stable')
+        return np.take_along_axis(candidates, order, axis=1).astype(np.int32), cluster_proba
+
+    def candidate_features(self, X, candidates, cluster_proba):
+        """Stage-two rows: each query row repeated per candidate, plus candidate features"""
+        n, m = candidates.shape
+        exit_code, middle_code, exit_country, middle_country, guard_country, exit_bw, guard_bw = \
+            (X[:, j] for j in self._inputs)
+        guards = self.guard_table[candidates]
+        cand_cluster_prob = np.take_along_axis(cluster_proba, self.clusters[candidates], axis=1)
+        candidate = np.stack([
+            cand_cluster_prob,
+            cand_cluster_prob * self.cluster_share[candidates],
+            guards[..., 0],
+            guards[..., 1],
+            guards[..., 2],
+            self.pairs['exit'].lookup(exit_code.astype(np.int64), candidates),
+            self.pairs['middle'].lookup(middle_code.astype(np.int64), candidates),
+            (guards[..., 3] == exit_country[:, None]) & (guards[..., 3] >= 0),
+            (guards[..., 4] == middle_country[:, None]) & (guards[..., 4] >= 0),
+            (guards[..., 2] == guard_country[:, None]) & (guards[..., 2] >= 0),
+            guards[..., 0] / (exit_bw[:, None] + 1.0),
+            guard_bw[:, None] / (guards[..., 0] + 1.0),
+        ], axis=-1).astype(np.float32)
+        rows = np.empty((n, m, X.shape[1] + candidate.shape[-1]), dtype=np.float32)
+        rows[:, :, :X.shape[1]] = X[:, None, :]
+        rows[:, :, X.shape[1]:] = candidate
+        return rows.reshape(n * m, -1)
+
+    def score_shortlist(self, X):
+        """
+        Shortlisted guards and their normalized scores per query
+
+        Returns:
+            (candidates, scores), both (n, shortlist_size), best first
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        candidates, cluster_proba = self.shortlist(X)
+        rows = self.candidate_features(X, candidates, cluster_proba)
+        scores = self.stage2.inplace_predict(rows, iteration_range=self.stage2_trees).reshape(candidates.shape)
+        scores = scores / np.maximum(scores.sum(axis=1, keepdims=True), 1e-12)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+    def rank(self, X, k):
+        """
+        Top-k shortlisted guards per query, best first
+
+        k is capped at the shortlist size: guards outside the shortlist were
+        never scored, so there is nothing to rank them by.
+
+        Returns:
+            (candidates, scores), both (n, min(k, shortlist size))
+        """
+        k = max(1, min(int(k), self.shortlist_size, self.n_guards))
+        candidates = np.empty((len(X), k), dtype=np.int32)
+        scores = np.empty((len(X), k), dtype=np.float32)
+        for start in range(0, len(X), SCORE_BATCH_ROWS):
+            batch_candidates, batch_scores = self.score_shortlist(X[start:start + SCORE_BATCH_ROWS])
+            candidates[start:start + len(batch_candidates)] = batch_candidates[:, :k]
+            scores[start:start + len(batch_scores)] = batch_scores[:, :k]
+        return candidates, scores
+
+    def predict_proba(self, X):
+        """
+        Dense (n, n_guards) scores: the normalized shortlist scores, 0 elsewhere
+
+        For offline evaluation against the multi-class model (true-label
+        ranks); serving and top-K inference use rank().
+        """
+        proba = np.zeros((len(X), self.n_guards), dtype=np.float32)
+        for start in range(0, len(X), SCORE_BATCH_ROWS):
+            candidates, scores = self.score_shortlist(X[start:start + SCORE_BATCH_ROWS])
+            np.put_along_axis(proba[start:start + len(candidates)], candidates, scores, axis=1)
+        return proba
+
+    def copy(self):
+        """Independent boosters for another inference thread"""
+        return TwoStageRanker(self.stage1.copy(), self.stage2.copy(), self.clusters, self.guard_table,
+                              self.pairs, self.feature_columns, self.shortlist_size)
+
+    def set_param(self, params):
+        self.stage1.set_param(params)
+        self.stage2.set_param(params)
+
+    def save(self, model_dir):
+        """Write both boosters (UBJSON), the guard/cluster tables, pair counts and a manifest"""
+        model_dir = Path(model_dir)
+        model_dir.mkdir(parents=True, exist_ok=True)
+        self.stage1.save_model(str(model_dir / STAGE1_NAME))
+        self.stage2.save_model(str(model_dir / STAGE2_NAME))
+        np.save(model_dir / CLUSTER_NAME, self.clusters, allow_pickle=False)
+        np.save(model_dir / GUARD_TABLE_NAME, self.guard_table, allow_pickle=False)
+        for name in PAIR_TABLES:
+            np.save(model_dir / f'two_stage_{name}_pair_keys.npy', self.pairs[name].keys, allow_pickle=False)
+            np.save(model_dir / f'two_stage_{name}_pair_counts.npy', self.pairs[name].counts, allow_pickle=False)
+        manifest = {
+            'stage1': STAGE1_NAME,
+            'stage2': STAGE2_NAME,
+            'n_guards': self.n_guards,
+            'n_clusters': self.n_clusters,
+            'shortlist_size': self.shortlist_size,
+            'feature_columns': self.feature_columns,
+            'candidate_features': CANDIDATE_FEATURES,
+            'guard_columns': GUARD_COLUMNS,
+        }
+        with open(model_dir / MANIFEST_NAME, 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    @classmethod
+    def load(cls, model_dir):
+        model_dir = Path(model_dir)
+        with open(model_dir / MANIFEST_NAME) as f:
+            manifest = json.load(f)
+        stage1, stage2 = xgb.Booster(), xgb.Booster()
+        stage1.load_model(str(model_dir / manifest['stage1']))
+        stage2.load_model(str(model_dir / manifest['stage2']))
+        pairs = {
+            name: PairCounts(np.load(model_dir / f'two_stage_{name}_pair_keys.npy', mmap_mode='r'),
+                             np.load(model_dir / f'two_stage_{name}_pair_counts.npy', mmap_mode='r'),
+                             manifest['n_guards'])
+            for name in PAIR_TABLES
+        }
+        return cls(stage1, stage2, np.load(model_dir / CLUSTER_NAME), np.load(model_dir / GUARD_TABLE_NAME),
+                   pairs, manifest['feature_columns'], manifest['shortlist_size'])
+
+
+def build_guard_table(frame, encoders, n_guards):
+    """
+    Per-guard table (rows = guard label) from training circuits
+
+    Args:
+        frame: guard_label, guard_country and guard_bandwidth columns
+        encoders: Fitted encoders (guard_country, exit_country, middle_country)
+
+    Returns:
+        (guard table (n_guards, len(GUARD_COLUMNS)) float32, guard countries)
+    """
+    labels = frame['guard_label'].to_numpy()
+    usage = np.bincount(labels, minlength=n_guards).astype(np.float64)
+    bandwidth = np.bincount(labels, weights=frame['guard_bandwidth'].to_numpy(dtype=np.float64), minlength=n_guards)
+    avg_bandwidth = np.where(usage > 0, bandwidth / np.maximum(usage, 1), np.nanmean(frame['guard_bandwidth']))
+
+    countries = np.full(n_guards, 'Unknown', dtype=object)
+    first = frame.drop_duplicates('guard_label')
+    countries[first['guard_label'].to_numpy()] = first['guard_country'].astype(str).to_numpy()
+
+    table = np.stack([
+        avg_bandwidth,
+        usage,
+        encoders['guard_country'].transform(countries),
+        encoders['exit_country'].transform(countries),
+        encoders['middle_country'].transform(countries),
+    ], axis=1).astype(np.float32)
+    return table, countries
+
+
+def _fit(params, dtrain, dval, label):
+    print(f"\nTraining {label}...")
+    booster = xgb.train(params, dtrain, num_boost_round=NUM_BOOST_ROUND, evals=[(dval, 'validation')],
+                        early_stopping_rounds=EARLY_STOPPING_ROUNDS, verbose_eval=50)
+    print(f"✓ {label}: best iteration {booster.best_iteration}, validation {booster.best_score:.4f}")
+    return booster
+
+
+def _training_pairs(ranker, X, labels, n_negatives, leave_one_out=False, seed=42):
+    """
+    Candidate rows for the true guard plus n_negatives wrong shortlist guards
+
+    Half are the highest-prior wrong guards (hard negatives), half are drawn
+    from the rest of the shortlist, so the scorer also sees the low-prior
+    candidates it has to rank at inference time. With leave_one_out (rows
+    the guard table was counted from) the circuit's own count is taken out
+    of its true guard's usage and pair counts, which would otherwise mark
+    every training positive as a seen pair.
+    """
+    rng = np.random.default_rng(seed)
+    n_hard = (n_negatives + 1) // 2
+    rows, targets = [], []
+    for start in range(0, len(X), SCORE_BATCH_ROWS):
+        Xb, yb = X[start:start + SCORE_BATCH_ROWS], labels[start:start + SCORE_BATCH_ROWS]
+        shortlist, cluster_proba = ranker.shortlist(Xb)
+        # Stable sort moves the true guard (if shortlisted) behind the wrong ones, in prior order
+        order = np.argsort(shortlist == yb[:, None], axis=1, kind='stable')
+        wrong = np.take_along_axis(shortlist, order, axis=1)[:, :shortlist.shape[1] - 1]
+        rest = wrong[:, n_hard:]
+        sampled = np.take_along_axis(rest, rng.random(rest.shape).argsort(axis=1)[:, :n_negatives - n_hard], axis=1)
+        candidates = np.concatenate([yb[:, None], wrong[:, :n_hard], sampled], axis=1)
+        features = ranker.candidate_features(Xb, candidates.astype(np.int32), cluster_proba)
+        if leave_one_out:
+            features.reshape(len(Xb), candidates.shape[1], -1)[:, 0, ranker.own_count_slots] -= 1.0
+        rows.append(features)
+        target = np.zeros(candidates.shape, dtype=np.float32)
+        target[:, 0] = 1.0
+        targets.append(target.ravel())
+    return np.concatenate(rows), np.concatenate(targets)
+
+
+def train_two_stage(X_train, y_train, X_val, y_val, guard_frame, encoders, feature_columns,
+                    shortlist_size=DEFAULT_SHORTLIST_SIZE, n_negatives=DEFAULT_NEGATIVES,
+                    bandwidth_buckets=DEFAULT_BANDWIDTH_BUCKETS):
+    """
+    Fit both stages
+
+    Args:
+        X_train, X_val: Query feature rows (feature_columns order)
+        y_train, y_val: Guard labels
+        guard_frame: Training circuits' guard_label, guard_country,
+            guard_bandwidth, exit/middle fingerprint codes
+        encoders: Fitted encoders of the feature pipeline
+
+    Returns:
+        TwoStageRanker
+    """
+    n_guards = len(encoders['guard_fingerprint'])
+    guard_table, countries = build_guard_table(guard_frame, encoders, n_guards)
+    clusters = guard_clusters(countries, guard_table[:, 0], bandwidth_buckets)
+    n_clusters = int(clusters.max()) + 1
+    pairs = {
+        name: PairCounts.fit(guard_frame[f'{name}_fingerprint_encoded'].to_numpy(),
+                             guard_frame['guard_label'].to_numpy(), n_guards)
+        for name in PAIR_TABLES
+    }
+    print(f"\n✓ {n_guards} guards in {n_clusters} clusters (country x {bandwidth_buckets} bandwidth buckets)")
+
+    with stage('stage1'):
+        dtrain = xgb.QuantileDMatrix(X_train, clusters[y_train], feature_names=list(feature_columns))
+        dval = xgb.QuantileDMatrix(X_val, clusters[y_val], feature_names=list(feature_columns), ref=dtrain)
+        stage1 = _fit({**STAGE1_PARAMS, 'num_class': n_clusters}, dtrain, dval, "stage 1 (cluster classifier)")
+        del dtrain, dval
+
+    # Stage two learns from the shortlists stage one actually produces
+    ranker = TwoStageRanker(stage1, None, clusters, guard_table, pairs, feature_columns, shortlist_size)
+    with stage('candidate_rows'):
+        rows_train, target_train = _training_pairs(ranker, X_train, y_train, n_negatives, leave_one_out=True)
+        rows_val, target_val = _training_pairs(ranker, X_val, y_val, n_negatives)
+    print(f"✓ Stage-2 training rows: {len(rows_train):,} ({n_negatives} negatives per circuit)")
+
+    names = ranker.candidate_columns
+    with stage('stage2'):
+        dtrain = xgb.QuantileDMatrix(rows_train, target_train, feature_names=names)
+        dval = xgb.QuantileDMatrix(rows_val, target_val, feature_names=names, ref=dtrain)
+        del rows_train, rows_val
+        stage2 = _fit(STAGE2_PARAMS, dtrain, dval, "stage 2 (candidate scorer)")
+
+    return TwoStageRanker(stage1, stage2, clusters, guard_table, pairs, feature_columns, shortlist_size)
+
+
+def shortlist_recall(ranker, X, labels):
+    """Share of circuits whose true guard makes the stage-one shortlist"""
+    hits = 0
+    for start in range(0, len(X), SCORE_BATCH_ROWS):
+        shortlist, _ = ranker.shortlist(X[start:start + SCORE_BATCH_ROWS])
+        hits += int((shortlist == labels[start:start + SCORE_BATCH_ROWS, None]).any(axis=1).sum())
+    return hits / max(1, len(X))
@@ -0,0 +1,65 @@
+"""
+Shared fixtures: the training scripts and backend modules are imported by
+sibling name, so both directories go on sys.path as they do at runtime
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+for directory in ('scripts', 'backend'):
+    if str(ROOT / directory) not in sys.path:
+        sys.path.insert(0, str(ROOT / directory))
+
+COUNTRIES = ['AT', 'CH', 'DE', 'FR', 'GB', 'NL', 'SE', 'US']
+
+
+def fingerprint(role, i):
+    return f"{role}{i:04d}".ljust(40, '0')
+
+
+def make_circuits(n, n_guards=12, n_middles=15, n_exits=10, seed=0, guard_offset=0):
+    """
+    Raw capture rows in the circuit_data_*.csv layout
+
+    guard_offset shifts the guard ids, so two captures can share some guards
+    and introduce others.
+    """
+    rng = np.random.default_rng(seed)
+    guards = rng.integers(0, n_guards, n) + guard_offset
+    middles = rng.integers(0, n_middles, n)
+    exits = rng.integers(0, n_exits, n)
+    return pd.DataFrame({
+        'request_id': np.arange(n),
+        'circuit_id': 1000 + np.arange(n),
+        'timestamp': '2025-11-19T22:51:37',
+        'status': 'BUILT',
+        'guard_fingerprint': [fingerprint('G', i) for i in guards],
+        'guard_nickname': [f'GuardNode{i}' for i in guards],
+        'guard_address': [f'127.0.0.{i % 250}' for i in guards],
+        'guard_country': [COUNTRIES[i % len(COUNTRIES)] for i in guards],
+        'middle_fingerprint': [fingerprint('M', i) for i in middles],
+        'middle_nickname': [f'MiddleNode{i}' for i in middles],
+        'middle_address': [f'127.0.1.{i % 250}' for i in middles],
+        'middle_country': [COUNTRIES[(i * 3) % len(COUNTRIES)] for i in middles],
+        'exit_fingerprint': [fingerprint('E', i) for i in exits],
+        'exit_nickname': [f'ExitNode{i}' for i in exits],
+        'exit_address': [f'127.0.2.{i % 250}' for i in exits],
+        'exit_country': [COUNTRIES[(i * 5) % len(COUNTRIES)] for i in exits],
+        'build_time': '2025-11-19T22:51:36',
+        'purpose': 'GENERAL',
+        'guard_bandwidth': (guards + 1) * 100_000 + rng.integers(0, 50_000, n),
+        'middle_bandwidth': rng.integers(1_000_000, 9_000_000, n),
+        'exit_bandwidth': rng.integers(1_000_000, 9_000_000, n),
+        'circuit_setup_duration': rng.uniform(0.2, 3.0, n),
+        'total_bytes': rng.integers(100_000, 900_000, n),
+    })
+
+
+@pytest.fixture
+def circuits():
+    return make_circuits
@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from category_encoder import UNKNOWN_CODE, CategoryEncoder, load_encoders, save_encoders
+from feature_lookups import build_feature_lookups
+from feature_pipeline import FEATURE_COLUMNS, FeaturePipeline
+from feature_statistics import FeatureStatistics
+
+REQUEST_COLUMNS = ['exit_fingerprint', 'exit_country', 'middle_fingerprint', 'middle_country',
+                   'guard_country', 'guard_bandwidth', 'middle_bandwidth', 'exit_bandwidth',
+                   'circuit_setup_duration', 'total_bytes']
+
+
+@pytest.fixture
+def fitted(circuits):
+    df = circuits(400, seed=5)
+    stats = FeatureStatistics.from_frame(df)
+    encoders = stats.fit_encoders()
+    engineered = stats.transform(df.copy(), encoders)
+    return FeaturePipeline(encoders, build_feature_lookups(engineered, encoders)), df, engineered
+
+
+def with_gaps(df):
+    """Requests as the API sees them: unseen relays, nulls and NaNs mixed in"""
+    df = df[REQUEST_COLUMNS].head(40).astype(object).copy()
+    df.loc[0, 'exit_fingerprint'] = 'F' * 40
+    df.loc[1, 'middle_fingerprint'] = None
+    df.loc[2, 'circuit_setup_duration'] = np.nan
+    df.loc[3, 'circuit_setup_duration'] = None
+    df.loc[4, 'exit_bandwidth'] = np.nan
+    df.loc[5, 'guard_bandwidth'] = None
+    df.loc[6, 'guard_country'] = None
+    df.loc[7, 'exit_country'] = 'ZZ'
+    df.loc[8, 'total_bytes'] = np.nan
+    return df
+
+
+def test_transform_reproduces_training_features(fitted):
+    pipeline, df, engineered = fitted
+    X = pipeline.transform(df)
+    # Historical features come from per-exit/middle tables, everything else must match exactly
+    computed = [i for i, col in enumerate(FEATURE_COLUMNS)
+                if not col.endswith(('_freq', 'guard_avg_bandwidth', 'guard_prefers_exit_country'))]
+    expected = engineered[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+    np.testing.assert_allclose(X[:, computed], expected[:, computed], rtol=1e-6)
+
+
+def test_transform_one_matches_transform_row_by_row(fitted):
+    pipeline, df, _ = fitted
+    requests = with_gaps(df)
+    batch = pipeline.transform(requests)
+    row = pipeline.new_row()
+    for i, circuit in enumerate(requests.to_dict('records')):
+        np.testing.assert_array_equal(pipeline.transform_one(circuit, out=row)[0], batch[i], err_msg=f"row {i}")
+
+
+def test_nan_setup_time_is_zero_in_both_paths(fitted):
+    pipeline, df, _ = fitted
+    circuit = df[REQUEST_COLUMNS].iloc[0].to_dict()
+    circuit['circuit_setup_duration'] = float('nan')
+    one = pipeline.transform_one(circuit)[0]
+    batch = pipeline.transform(pd.DataFrame([circuit]))[0]
+    assert not np.isnan(one).any()
+    np.testing.assert_array_equal(one, batch)
+    assert one[FEATURE_COLUMNS.index('circuit_setup_duration')] == 0.0
+    assert one[FEATURE_COLUMNS.index('bw_guard_x_setup')] == 0.0
+
+
+def test_unknown_relay_gets_the_global_mean_row(fitted):
+    pipeline, df, engineered = fitted
+    circuit = df[REQUEST_COLUMNS].iloc[0].to_dict()
+    circuit['exit_fingerprint'] = 'F' * 40
+    X = pipeline.transform_one(circuit)[0]
+
+    assert X[FEATURE_COLUMNS.index('exit_fingerprint_encoded')] == UNKNOWN_CODE
+    np.testing.assert_allclose(X[FEATURE_COLUMNS.index('exit_usage_freq')],
+                               engineered['exit_usage_freq'].mean(), rtol=1e-5)
+    np.testing.assert_array_equal(pipeline.exit_table[UNKNOWN_CODE], pipeline.exit_table[-1])
+
+
+def test_feature_column_subset_and_order(fitted):
+    pipeline, df, _ = fitted
+    columns = ['bw_total', 'exit_fingerprint_encoded', 'guard_usage_freq']
+    subset = FeaturePipeline(pipeline.encoders, pipeline.lookups, columns)
+    full = pipeline.transform(df)
+    np.testing.assert_array_equal(subset.transform(df), full[:, [FEATURE_COLUMNS.index(c) for c in columns]])
+    with pytest.raises(ValueError):
+        FeaturePipeline(pipeline.encoders, pipeline.lookups, ['not_a_feature'])
+
+
+def test_pipeline_save_load_round_trip(fitted, tmp_path):
+    pipeline, df, _ = fitted
+    pipeline.save(tmp_path)
+    loaded = FeaturePipeline.load(tmp_path)
+    assert loaded.feature_columns == pipeline.feature_columns
+    np.testing.assert_array_equal(loaded.transform(df), pipeline.transform(df))
+
+
+def test_category_encoder_codes_and_unknowns():
+    encoder = CategoryEncoder.fit(['b', 'a', None, 'c', 'a'])
+    assert list(encoder.classes_) == ['a', 'b', 'c']
+    assert encoder.encode('b') == 1
+    assert encoder.encode('zzz') == UNKNOWN_CODE
+    codes = encoder.transform(np.array(['c', 'x', 'a'], dtype=object))
+    assert codes.dtype == np.int32
+    np.testing.assert_array_equal(codes, [2, UNKNOWN_CODE, 0])
+    np.testing.assert_array_equal(encoder.inverse_transform([0, 2]), ['a', 'c'])
+
+
+def test_category_encoders_memory_map_round_trip(tmp_path):
+    encoders = {'exit_fingerprint': CategoryEncoder.fit(['E' * 40, 'D' * 40]),
+                'exit_country': CategoryEncoder.fit(['US', 'DE'])}
+    save_encoders(encoders, tmp_path)
+    loaded, source = load_encoders(tmp_path)
+    assert source == tmp_path / 'encoders'
+    for col, encoder in encoders.items():
+        assert list(loaded[col].classes_) == list(encoder.classes_)
+        assert loaded[col].encode(encoder.classes_[1]) == 1
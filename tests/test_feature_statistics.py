@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+from feature_statistics import COUNTED_COLUMNS, PAIRS, FeatureStatistics
+
+
+def assert_same_statistics(actual, expected):
+    assert actual.n_rows == expected.n_rows
+    for col in COUNTED_COLUMNS:
+        pd.testing.assert_series_equal(actual.value_counts[col].sort_index(), expected.value_counts[col].sort_index(),
+                                       check_names=False)
+    for pair in PAIRS:
+        pd.testing.assert_series_equal(actual.pair_counts[pair].sort_index(), expected.pair_counts[pair].sort_index(),
+                                       check_names=False)
+    pd.testing.assert_series_equal(actual.guard_avg_bandwidth().sort_index(),
+                                   expected.guard_avg_bandwidth().sort_index(), check_names=False)
+    pd.testing.assert_series_equal(actual.guard_top_exit_country().sort_index(),
+                                   expected.guard_top_exit_country().sort_index())
+
+
+@pytest.mark.parametrize('chunksize', [1, 37, 500])
+def test_chunked_updates_equal_single_pass(circuits, chunksize):
+    df = circuits(300, seed=1)
+    single = FeatureStatistics.from_frame(df)
+    chunked = FeatureStatistics()
+    for start in range(0, len(df), chunksize):
+        chunked.update(df.iloc[start:start + chunksize])
+    assert_same_statistics(chunked, single)
+
+
+def test_merged_files_equal_single_pass(circuits):
+    # Second capture introduces guards the first never saw
+    first, second = circuits(200, seed=1), circuits(150, seed=2, guard_offset=6)
+    single = FeatureStatistics.from_frame(pd.concat([first, second], ignore_index=True))
+    merged = FeatureStatistics.from_frame(first).merge(FeatureStatistics.from_frame(second))
+    assert_same_statistics(merged, single)
+
+
+def test_merge_with_empty_statistics(circuits):
+    df = circuits(100, seed=3)
+    single = FeatureStatistics.from_frame(df)
+    assert_same_statistics(FeatureStatistics().merge(FeatureStatistics.from_frame(df)), single)
+    assert_same_statistics(FeatureStatistics.from_frame(df).merge(FeatureStatistics()), single)
+
+
+def test_merged_transform_matches_single_pass(circuits):
+    first, second = circuits(200, seed=1), circuits(150, seed=2, guard_offset=6)
+    df = pd.concat([first, second], ignore_index=True)
+    single = FeatureStatistics.from_frame(df)
+    merged = FeatureStatistics.from_frame(first).merge(FeatureStatistics.from_frame(second))
+
+    expected = single.transform(df.copy(), single.fit_encoders())
+    actual = merged.transform(df.copy(), merged.fit_encoders())
+    pd.testing.assert_frame_equal(actual, expected)
@@ -0,0 +1,64 @@
+import pandas as pd
+import xgboost as xgb
+
+from dataset_io import read_engineered
+from feature_statistics import FeatureStatistics
+from feature_store import FeatureStore
+from prepare_features import engineer_features_from_store
+from test_feature_statistics import assert_same_statistics
+from train_xgboost import MODEL_PARAMS, label_classes, native_params
+
+
+def write_captures(tmp_path, circuits):
+    first = tmp_path / 'circuit_data_a.csv'
+    second = tmp_path / 'circuit_data_b.csv'
+    circuits(200, n_guards=10, seed=1).to_csv(first, index=False)
+    # Capture B brings guards A never saw and misses some of A's
+    circuits(150, n_guards=10, seed=2, guard_offset=6).to_csv(second, index=False)
+    return first, second
+
+
+def test_snapshots_sum_capture_deltas(tmp_path, circuits):
+    first, second = write_captures(tmp_path, circuits)
+    with FeatureStore(tmp_path / 'store.sqlite') as store:
+        snapshot_a = store.ingest(first)
+        snapshot_b = store.ingest(second)
+        assert store.ingest(first) is None  # same capture twice is a no-op
+
+        assert_same_statistics(store.materialize(snapshot_a), FeatureStatistics.from_frame(pd.read_csv(first)))
+        assert_same_statistics(
+            store.materialize(snapshot_b),
+            FeatureStatistics.from_frame(pd.concat([pd.read_csv(first), pd.read_csv(second)], ignore_index=True)),
+        )
+        assert store.latest_snapshot() == snapshot_b
+        assert store.captures()['n_rows'].tolist() == [200, 150]
+
+
+def test_chunked_ingest_matches_whole(tmp_path, circuits):
+    first, _ = write_captures(tmp_path, circuits)
+    with FeatureStore(tmp_path / 'whole.sqlite') as whole, FeatureStore(tmp_path / 'chunked.sqlite') as chunked:
+        whole.ingest(first)
+        chunked.ingest(first, chunksize=33)
+        assert_same_statistics(chunked.materialize(), whole.materialize())
+
+
+def test_ingest_then_prepare_trains(tmp_path, circuits):
+    first, second = write_captures(tmp_path, circuits)
+    store_path = tmp_path / 'store.sqlite'
+    with FeatureStore(store_path) as store:
+        store.ingest(first)
+
+    output = tmp_path / 'engineered.parquet'
+    encoders, _, _, n_rows, _ = engineer_features_from_store(store_path, [second], output, 0, 1)
+    labels = read_engineered(output, columns=['guard_label'])['guard_label'].to_numpy()
+
+    # Encoder covers both captures, the output only capture B's guards
+    assert n_rows == len(labels) == 150
+    assert len(encoders['guard_fingerprint']) == 16
+    assert len(set(labels)) < label_classes(labels) <= len(encoders['guard_fingerprint'])
+
+    params, _, _ = native_params(MODEL_PARAMS, label_classes(labels))
+    params['nthread'] = 1
+    X = read_engineered(output, columns=['exit_bandwidth', 'middle_bandwidth']).to_numpy(dtype='float32')
+    booster = xgb.train(params, xgb.DMatrix(X, labels), num_boost_round=1)
+    assert booster.predict(xgb.DMatrix(X[:3])).shape == (3, label_classes(labels))
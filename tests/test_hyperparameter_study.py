@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+import optimize_hyperparameters
+from external_memory import LABEL_COLUMN, split_indices
+from optimize_hyperparameters import (COMPLETE, N_STARTUP_TRIALS, PRUNE_INTERVAL, PRUNE_WARMUP_ROUNDS, PRUNED,
+                                      RUNNING, SEARCH_SPACE, MedianPruningCallback, StudyStorage, init_worker,
+                                      run_trial, sample_params, write_split)
+
+
+def result(state, value=None, **metrics):
+    return {'state': state, 'value': value, 'metrics': metrics, 'best_iteration': 10, 'n_jobs': 1,
+            'wall_time': 1.0}
+
+
+def test_sampled_params_are_reproducible_and_in_range():
+    assert sample_params(42, 3) == sample_params(42, 3)
+    assert sample_params(42, 3) != sample_params(42, 4)
+    for number in range(50):
+        params = sample_params(7, number)
+        assert set(params) == set(SEARCH_SPACE)
+        for name, (kind, low, high, _) in SEARCH_SPACE.items():
+            assert low <= params[name] <= high
+            assert isinstance(params[name], int if kind == 'int' else float)
+
+
+def test_study_keeps_its_seed_when_resumed(tmp_path):
+    storage = StudyStorage(tmp_path / 'study.sqlite')
+    study_id, _ = storage.study('s', 'data.parquet', 42)
+    assert storage.study('s', 'data.parquet', 99) == (study_id, 42)
+    storage.close()
+
+
+def test_interrupted_trials_resume_with_their_params(tmp_path):
+    path = tmp_path / 'study.sqlite'
+    storage = StudyStorage(path)
+    study_id, seed = storage.study('s', 'data.parquet', 42)
+    done = storage.create_trial(study_id, 0, sample_params(seed, 0))
+    storage.finish_trial(done, result(COMPLETE, 0.5, mlogloss=1.0))
+    killed = storage.create_trial(study_id, 1, sample_params(seed, 1))
+    storage.conn.execute("INSERT INTO intermediate_values VALUES (?, ?, ?)", (killed, 10, 2.0))
+    storage.conn.commit()
+    storage.close()
+
+    # A new process opens the same file
+    storage = StudyStorage(path)
+    assert storage.counts(study_id) == {COMPLETE: 1, RUNNING: 1}
+    assert storage.interrupted(study_id) == [(killed, 1, sample_params(seed, 1))]
+    assert storage.conn.execute("SELECT COUNT(*) FROM intermediate_values").fetchone()[0] == 0
+    assert storage.next_number(study_id) == 2
+    storage.close()
+
+
+def test_best_trial_ignores_pruned_and_breaks_ties_on_loss(tmp_path):
+    storage = StudyStorage(tmp_path / 'study.sqlite')
+    study_id, _ = storage.study('s', 'data.parquet', 0)
+    for number, (state, value, loss) in enumerate([(COMPLETE, 0.4, 1.0), (COMPLETE, 0.6, 1.2),
+                                                  (COMPLETE, 0.6, 0.9), (PRUNED, None, 0.1)]):
+        trial_id = storage.create_trial(study_id, number, {'max_depth': number})
+        storage.finish_trial(trial_id, result(state, value, mlogloss=loss))
+    best = storage.best_trial(study_id)
+    assert best['number'] == 2
+    assert best['params'] == {'max_depth': 2}
+    storage.close()
+
+
+def run_callback(storage, study_id, trial_id, losses):
+    """Feed one mlogloss per round; returns the round training would stop at, or None"""
+    callback = MedianPruningCallback(storage.conn, study_id, trial_id)
+    log = {'validation': {'mlogloss': []}}
+    for epoch, loss in enumerate(losses):
+        log['validation']['mlogloss'].append(loss)
+        if callback.after_iteration(None, epoch, log):
+            return epoch + 1
+    return None
+
+
+def test_median_pruning_waits_for_startup_trials_and_warmup(tmp_path):
+    storage = StudyStorage(tmp_path / 'study.sqlite')
+    study_id, _ = storage.study('s', 'data.parquet', 0)
+    rounds = PRUNE_WARMUP_ROUNDS + 2 * PRUNE_INTERVAL
+    good = np.linspace(2.0, 1.0, rounds)
+    bad = good + 0.5
+
+    # Before N_STARTUP_TRIALS completed trials nothing is pruned
+    for number in range(N_STARTUP_TRIALS):
+        trial_id = storage.create_trial(study_id, number, {})
+        assert run_callback(storage, study_id, trial_id, bad if number == 0 else good) is None
+        storage.finish_trial(trial_id, result(COMPLETE, 0.5, mlogloss=1.0))
+
+    # Now a trial worse than the median stops at the first check after warmup
+    trial_id = storage.create_trial(study_id, N_STARTUP_TRIALS, {})
+    assert run_callback(storage, study_id, trial_id, bad) == PRUNE_WARMUP_ROUNDS
+    trial_id = storage.create_trial(study_id, N_STARTUP_TRIALS + 1, {})
+    assert run_callback(storage, study_id, trial_id, good - 0.1) is None
+    storage.close()
+
+
+def test_workers_share_one_memory_mapped_split(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    features = ['a', 'b', 'c']
+    df = pd.DataFrame(rng.normal(size=(400, 3)).astype(np.float32), columns=features)
+    df.loc[::7, 'b'] = np.nan
+    df[LABEL_COLUMN] = np.arange(400) % 4
+    df.to_csv(tmp_path / 'engineered.csv', index=False)
+
+    split_dir = tmp_path / 'split'
+    split_dir.mkdir()
+    train_index, val_index, _ = split_indices(df[LABEL_COLUMN].to_numpy())
+    assert write_split(tmp_path / 'engineered.csv', features, split_dir) == (4, len(train_index), len(val_index))
+    np.testing.assert_array_equal(np.load(split_dir / 'X_val.npy'), df[features].fillna(0.0).to_numpy()[val_index])
+    np.testing.assert_array_equal(np.load(split_dir / 'y_train.npy'), df[LABEL_COLUMN].to_numpy()[train_index])
+
+    storage = StudyStorage(tmp_path / 'study.sqlite')
+    study_id, _ = storage.study('s', 'engineered.csv', 0)
+    trial_id = storage.create_trial(study_id, 0, {})
+    monkeypatch.setattr(optimize_hyperparameters, '_worker', {})
+    init_worker(split_dir, features, 4, storage.path, 1)
+    assert isinstance(optimize_hyperparameters._worker['X_val'], np.memmap)
+    assert optimize_hyperparameters._worker['dtrain'].num_row() == len(train_index)
+
+    result = run_trial(study_id, trial_id, {'n_estimators': 3, 'max_depth': 2})
+    assert result['state'] == COMPLETE
+    assert 0 < result['value'] <= 1
+    optimize_hyperparameters._worker['conn'].close()
+    storage.close()
@@ -0,0 +1,198 @@
+import asyncio
+import shutil
+import threading
+
+import numpy as np
+import pytest
+import xgboost as xgb
+
+from feature_lookups import build_feature_lookups
+from feature_pipeline import FEATURE_COLUMNS, FeaturePipeline
+from feature_statistics import FeatureStatistics
+from model_bundle import (BUNDLES_DIR_NAME, CURRENT_NAME, current_version, list_bundles, load_bundle,
+                          set_current, write_bundle)
+
+
+@pytest.fixture(scope='module')
+def model_parts():
+    from conftest import make_circuits
+
+    df = make_circuits(300, n_guards=6, seed=7)
+    stats = FeatureStatistics.from_frame(df)
+    encoders = stats.fit_encoders()
+    df = stats.transform(df, encoders)
+    pipeline = FeaturePipeline(encoders, build_feature_lookups(df, encoders))
+    X = pipeline.transform(df)
+    dtrain = xgb.DMatrix(X, df['guard_label'].to_numpy(), feature_names=FEATURE_COLUMNS)
+    params = {'objective': 'multi:softprob', 'num_class': 6, 'max_depth': 2, 'nthread': 1}
+    boosters = [xgb.train({**params, 'seed': seed}, dtrain, num_boost_round=2) for seed in (1, 2)]
+    return boosters, pipeline, X
+
+
+def test_write_and_load_round_trip(tmp_path, model_parts):
+    (booster, _), pipeline, X = model_parts
+    bundle_dir = write_bundle(tmp_path, booster, pipeline, FEATURE_COLUMNS, metrics={'mrr': 0.5})
+
+    assert current_version(tmp_path) == bundle_dir.name
+    assert list_bundles(tmp_path) == [bundle_dir.name]
+    bundle = load_bundle(tmp_path)
+    assert bundle.version == bundle_dir.name
+    assert bundle.metrics == {'mrr': 0.5}
+    np.testing.assert_allclose(bundle.booster.inplace_predict(X), booster.inplace_predict(X), rtol=1e-6)
+    np.testing.assert_array_equal(bundle.pipeline.transform({'exit_fingerprint': ['x'] * 3}),
+                                  pipeline.transform({'exit_fingerprint': ['x'] * 3}))
+
+
+def test_class_contributions_match_full_treeshap(model_parts):
+    from prediction_engine import PredictionEngine
+
+    (booster, _), _, X = model_parts
+    booster = booster.copy()
+    booster.set_attr(best_iteration='0')
+    engine = PredictionEngine(booster, workers=1)
+    full = booster.predict(xgb.DMatrix(X[:1], feature_names=FEATURE_COLUMNS), pred_contribs=True,
+                           strict_shape=True, iteration_range=engine.iteration_range)
+    try:
+        for class_index in range(full.shape[1]):
+            np.testing.assert_allclose(engine.contributions_sync(X, class_index), full[0, class_index],
+                                       rtol=1e-5, atol=1e-6)
+        assert engine.class_booster(1).num_boosted_rounds() == 1
+    finally:
+        engine.shutdown()
+
+
+def test_current_pointer_switch_is_atomic(tmp_path, model_parts):
+    (first, second), pipeline, _ = model_parts
+    versions = [write_bundle(tmp_path, booster, pipeline, FEATURE_COLUMNS, make_current=False).name
+                for booster in (first, second)]
+    set_current(tmp_path, versions[0])
+
+    # A reader polling CURRENT during repeated switches only ever sees a complete version
+    seen, stop = set(), threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            seen.add(current_version(tmp_path))
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    for i in range(300):
+        set_current(tmp_path, versions[i % 2])
+    stop.set()
+    thread.join()
+
+    assert seen <= set(versions)
+    assert current_version(tmp_path) == versions[1]
+    assert not list((tmp_path / BUNDLES_DIR_NAME).glob(f'.{CURRENT_NAME}.tmp'))
+
+
+def test_staging_directories_are_not_bundles(tmp_path, model_parts):
+    (booster, _), pipeline, _ = model_parts
+    version = write_bundle(tmp_path, booster, pipeline, FEATURE_COLUMNS).name
+    staging = tmp_path / BUNDLES_DIR_NAME / '.20990101-000000-deadbeef.tmp'
+    (tmp_path / BUNDLES_DIR_NAME / version).rename(staging)
+    assert list_bundles(tmp_path) == []
+    with pytest.raises(FileNotFoundError):
+        load_bundle(tmp_path, staging.name)
+
+
+@pytest.mark.parametrize('version', ['../outside', '../..', '..', '/etc', 'nope', CURRENT_NAME])
+def test_unknown_versions_are_rejected(tmp_path, model_parts, version):
+    (booster, _), pipeline, _ = model_parts
+    bundle_dir = write_bundle(tmp_path, booster, pipeline, FEATURE_COLUMNS)
+    # A complete bundle outside models/bundles/ must not be reachable either
+    shutil.copytree(bundle_dir, tmp_path / 'outside')
+    with pytest.raises(FileNotFoundError):
+        load_bundle(tmp_path, version)
+    with pytest.raises(FileNotFoundError):
+        set_current(tmp_path, version)
+
+
+# Serving side: backend/main.py swaps whole ServingStates built from bundles
+
+@pytest.fixture
+def server(tmp_path, model_parts, monkeypatch):
+    import main
+
+    (first, second), pipeline, _ = model_parts
+    versions = [write_bundle(tmp_path, booster, pipeline, FEATURE_COLUMNS).name for booster in (first, second)]
+    monkeypatch.setattr(main, 'MODEL_DIR', tmp_path)
+    monkeypatch.setattr(main, 'GUARD_META_PATH', tmp_path / 'guard_metadata.npy')
+    monkeypatch.setattr(main, 'METADATA_CSV_PATH', tmp_path / 'missing.parquet')
+    monkeypatch.setattr(main, 'ADMIN_TOKEN', 'token')
+    monkeypatch.setattr(main, 'serving', None)
+    monkeypatch.setattr(main, 'reload_lock', None)
+    return main, versions
+
+
+def test_reload_swaps_state_after_in_flight_requests(server):
+    main, versions = server
+    from main import ReloadRequest
+
+    async def scenario():
+        main.activate(main.build_serving_state(versions[0]))
+        old = main.serving
+        with old.use():
+            # A request holding the old state keeps it alive through the reload
+            reload = asyncio.create_task(main.reload_model(ReloadRequest(version=versions[1]), x_admin_token='token'))
+            while main.serving is old:
+                await asyncio.sleep(0.01)
+            assert main.serving.bundle.version == versions[1]
+            assert not old.engine._executor._shutdown
+            assert not reload.done()
+        result = await reload
+        assert old.engine._executor._shutdown
+        await main.serving.retire()
+        return result
+
+    result = asyncio.run(scenario())
+    assert result['bundle_version'] == versions[1]
+    assert result['previous_version'] == versions[0]
+
+
+def test_state_binds_to_the_loop_only_when_started(server):
+    main, versions = server
+    # Reloads build states in a worker thread; on Python 3.9 asyncio primitives
+    # created there raise "There is no current event loop"
+    state = main.build_serving_state(versions[0])
+    assert state._idle is None and state.coalescer._queue is None
+
+    async def scenario():
+        main.activate(state)
+        assert state._idle.is_set()
+        await state.retire()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize('version', ['../outside', '../..', 'nope'])
+def test_reload_rejects_unknown_versions(server, version):
+    main, versions = server
+    from fastapi import HTTPException
+    from main import ReloadRequest
+
+    shutil.copytree(main.MODEL_DIR / BUNDLES_DIR_NAME / versions[0], main.MODEL_DIR / 'outside')
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(main.reload_model(ReloadRequest(version=version), x_admin_token='token'))
+    assert error.value.status_code == 404
+    assert main.serving is None
+
+
+def test_failed_build_shuts_its_engine_down(server, monkeypatch):
+    main, versions = server
+    engines = []
+
+    class RecordingEngine(main.PredictionEngine):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            engines.append(self)
+
+    def broken_registry(*args, **kwargs):
+        raise RuntimeError("registry failed")
+
+    monkeypatch.setattr(main, 'PredictionEngine', RecordingEngine)
+    monkeypatch.setattr(main, 'GuardRegistry', broken_registry)
+    with pytest.raises(RuntimeError):
+        main.build_serving_state(versions[0])
+    assert len(engines) == 1
+    assert engines[0]._executor._shutdown
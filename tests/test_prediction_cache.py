@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+import prediction_cache
+from prediction_cache import PredictionCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prediction_cache.time, 'monotonic', clock)
+    return clock
+
+
+def row(i):
+    return np.full(4, i, dtype=np.float32)
+
+
+def ranked(i, k=5):
+    return np.full(k, i, dtype=np.int32), np.full(k, i, dtype=np.float32)  # 40 bytes
+
+
+def test_hit_returns_a_read_only_copy(clock):
+    cache = PredictionCache(max_bytes=1000, ttl_seconds=60)
+    indices, scores = ranked(1)
+    cache.put(cache.key(row(1)), indices, scores)
+    indices[:], scores[:] = 9, 9
+
+    for cached, expected in zip(cache.get(cache.key(row(1))), ranked(1)):
+        np.testing.assert_array_equal(cached, expected)
+        assert not cached.flags.writeable
+    assert cache.get(cache.key(row(2))) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = PredictionCache(max_bytes=1000, ttl_seconds=5)
+    key = cache.key(row(1))
+    cache.put(key, *ranked(1))
+
+    clock.now += 4.9
+    assert cache.get(key) is not None
+    clock.now += 0.2
+    assert cache.get(key) is None
+    assert cache.expirations == 1
+    assert cache.stats()['entries'] == 0
+    assert cache.stats()['bytes'] == 0
+
+
+def test_least_recently_used_is_evicted_first(clock):
+    cache = PredictionCache(max_bytes=120, ttl_seconds=60)  # three 40-byte rows
+    keys = [cache.key(row(i)) for i in range(4)]
+    for key in keys[:3]:
+        cache.put(key, *ranked(1))
+    cache.get(keys[0])  # keys[1] is now the least recently used
+
+    cache.put(keys[3], *ranked(1))
+    assert cache.evictions == 1
+    assert cache.get(keys[1]) is None
+    assert all(cache.get(key) is not None for key in (keys[0], keys[2], keys[3]))
+    assert cache.stats()['bytes'] == 120
+
+
+def test_replacing_a_key_keeps_the_byte_count(clock):
+    cache = PredictionCache(max_bytes=1000, ttl_seconds=60)
+    key = cache.key(row(1))
+    cache.put(key, *ranked(1))
+    cache.put(key, *ranked(2))
+    assert cache.stats()['bytes'] == 40
+    np.testing.assert_array_equal(cache.get(key)[1], ranked(2)[1])
+
+
+def test_rows_larger_than_the_cache_are_not_stored(clock):
+    cache = PredictionCache(max_bytes=30, ttl_seconds=60)
+    cache.put(cache.key(row(1)), *ranked(1))
+    assert cache.stats()['entries'] == 0
+
+
+def test_invalidate_drops_entries_and_rekeys(clock):
+    cache = PredictionCache(max_bytes=1000, ttl_seconds=60)
+    old_key = cache.key(row(1))
+    cache.put(old_key, *ranked(1))
+
+    cache.invalidate('v2')
+    assert cache.stats()['entries'] == 0
+    assert cache.key(row(1)) != old_key
+    assert cache.get(old_key) is None
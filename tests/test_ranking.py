@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from evaluation import evaluate_ranking, evaluate_ranks, rank_histogram
+from ranking import top_k, true_label_ranks
+
+
+def test_top_k_matches_full_sort():
+    rng = np.random.default_rng(0)
+    proba = rng.random((50, 40))
+    indices, scores = top_k(proba, 7)
+    expected = np.argsort(-proba, axis=1, kind='stable')[:, :7]
+    np.testing.assert_array_equal(indices, expected)
+    np.testing.assert_array_equal(scores, np.take_along_axis(proba, expected, axis=1))
+
+
+def test_top_k_clips_k_and_accepts_one_row():
+    indices, scores = top_k(np.array([0.1, 0.7, 0.2]), 10)
+    np.testing.assert_array_equal(indices, [[1, 2, 0]])
+    np.testing.assert_allclose(scores, [[0.7, 0.2, 0.1]])
+
+
+def test_ranks_match_argsort_without_ties():
+    rng = np.random.default_rng(1)
+    proba = rng.random((200, 30))
+    labels = rng.integers(0, 30, 200)
+    expected = 1 + np.argmax(np.argsort(-proba, axis=1) == labels[:, None], axis=1)
+    np.testing.assert_array_equal(true_label_ranks(proba, labels, chunk_size=17), expected)
+
+
+def test_ties_count_against_the_true_label():
+    proba = np.array([
+        [0.5, 0.5, 0.0, 0.0],   # tied for first with one other class
+        [0.6, 0.4, 0.0, 0.0],   # zero-scored, tied with every other zero
+        [0.0, 0.0, 0.0, 0.0],   # all tied
+        [0.2, 0.3, 0.5, 0.0],
+    ])
+    np.testing.assert_array_equal(true_label_ranks(proba, [1, 2, 0, 2]), [2, 4, 4, 1])
+
+
+def test_label_outside_a_shortlist_ranks_past_it():
+    # Two-stage output: 50 shortlisted guards scored, the other 950 exactly 0
+    n_guards, shortlist = 1000, 50
+    proba = np.zeros((1, n_guards), dtype=np.float32)
+    proba[0, :shortlist] = np.linspace(1.0, 0.1, shortlist)
+    rank = true_label_ranks(proba, [700])[0]
+    assert rank == n_guards
+
+    report = evaluate_ranking([700], proba, k_values=[1, 50, 100])
+    assert report['topk_accuracy']['Top-100'] == 0.0
+    assert report['mrr_at_k']['MRR@100'] == 0.0
+    assert report['rank_histogram']['>100'] == 1
+
+
+def test_report_from_ranks():
+    ranks = np.array([1, 1, 2, 4, 11, 60, 150])
+    report = evaluate_ranks(ranks, k_values=[1, 3, 10])
+    assert report['topk_accuracy'] == pytest.approx({'Top-1': 2 / 7, 'Top-3': 3 / 7, 'Top-10': 4 / 7})
+    assert report['mrr_at_k']['MRR@3'] == pytest.approx((1 + 1 + 0.5) / 7)
+    assert report['mrr'] == pytest.approx(np.mean(1 / ranks))
+    assert report['mean_rank'] == pytest.approx(ranks.mean())
+
+
+def test_rank_histogram_buckets():
+    histogram = rank_histogram([1, 2, 3, 4, 5, 6, 10, 11, 20, 21, 50, 51, 100, 101])
+    assert histogram == {'1': 1, '2': 1, '3': 1, '4-5': 2, '6-10': 2, '11-20': 2,
+                         '21-50': 2, '51-100': 2, '>100': 1}
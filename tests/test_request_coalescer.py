@@ -0,0 +1,79 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from main import MAX_TOP_K, RequestCoalescer
+
+
+class FakeEngine:
+    """Ranks row i as indices [sum(row), batch size] with scores k and records every batch"""
+
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+
+    async def rank(self, X, k):
+        self.batches.append(len(X))
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError("inference failed")
+        return np.column_stack([X.sum(axis=1), np.full(len(X), len(X))]), np.full((len(X), 2), k)
+
+
+async def submit_all(coalescer, rows):
+    coalescer.start()
+    try:
+        return await asyncio.gather(*(coalescer.submit(row) for row in rows), return_exceptions=True)
+    finally:
+        await coalescer.stop()
+
+
+def test_concurrent_rows_share_a_batch_and_get_their_own_results():
+    engine = FakeEngine()
+    coalescer = RequestCoalescer(engine, window_ms=50, max_batch=64)
+    rows = [np.full(3, i, dtype=np.float32) for i in range(10)]
+    results = asyncio.run(submit_all(coalescer, rows))
+
+    assert engine.batches == [10]
+    for i, (indices, scores) in enumerate(results):
+        assert indices[0] == 3 * i
+        assert scores[0] == MAX_TOP_K
+    stats = coalescer.stats()
+    assert stats['requests_total'] == 10
+    assert stats['batches_total'] == 1
+    assert stats['mean_batch_size'] == 10
+
+
+def test_batches_are_capped_at_max_batch():
+    engine = FakeEngine()
+    coalescer = RequestCoalescer(engine, window_ms=50, max_batch=4)
+    results = asyncio.run(submit_all(coalescer, [np.full(2, i, dtype=np.float32) for i in range(10)]))
+
+    assert engine.batches == [4, 4, 2]
+    assert [indices[0] for indices, _ in results] == [2 * i for i in range(10)]
+
+
+def test_zero_window_flushes_what_is_already_queued():
+    engine = FakeEngine()
+    coalescer = RequestCoalescer(engine, window_ms=0, max_batch=64)
+    results = asyncio.run(submit_all(coalescer, [np.ones(2, dtype=np.float32)] * 5))
+    assert sum(engine.batches) == 5
+    assert all(indices[0] == 2 for indices, _ in results)
+
+
+def test_engine_errors_reach_every_waiting_request():
+    engine = FakeEngine(fail=True)
+    coalescer = RequestCoalescer(engine, window_ms=20, max_batch=64)
+    results = asyncio.run(submit_all(coalescer, [np.ones(2, dtype=np.float32)] * 3))
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert coalescer.stats()['errors_total'] == 3
+    assert coalescer.stats()['requests_total'] == 0
+
+
+@pytest.mark.parametrize('window_ms, max_batch', [(-5, 0), (1, -1)])
+def test_settings_are_clamped(window_ms, max_batch):
+    coalescer = RequestCoalescer(FakeEngine(), window_ms=window_ms, max_batch=max_batch)
+    assert coalescer.window >= 0
+    assert coalescer.max_batch == 1
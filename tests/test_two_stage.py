@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+
+import two_stage
+from feature_pipeline import FEATURE_COLUMNS
+from feature_statistics import FeatureStatistics
+from ranking import true_label_ranks
+from train_xgboost import GUARD_FRAME_COLS
+from two_stage import TwoStageRanker, shortlist_recall, train_two_stage
+
+SHORTLIST = 8
+
+
+@pytest.fixture(scope='module')
+def trained(tmp_path_factory):
+    from conftest import make_circuits
+
+    df = make_circuits(1200, n_guards=30, seed=4)
+    stats = FeatureStatistics.from_frame(df)
+    encoders = stats.fit_encoders()
+    df = stats.transform(df, encoders)
+    X = df[FEATURE_COLUMNS].to_numpy(dtype=np.float32)
+    y = df['guard_label'].to_numpy()
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(two_stage, 'NUM_BOOST_ROUND', 5)
+        ranker = train_two_stage(X[:900], y[:900], X[900:1000], y[900:1000], df[GUARD_FRAME_COLS].iloc[:900],
+                                 encoders, FEATURE_COLUMNS, shortlist_size=SHORTLIST)
+    ranker.set_param({'nthread': 1})
+    return ranker, X[1000:], y[1000:]
+
+
+def test_predict_proba_is_zero_outside_the_shortlist(trained):
+    ranker, X, _ = trained
+    candidates, scores = ranker.score_shortlist(X)
+    proba = ranker.predict_proba(X)
+
+    assert proba.shape == (len(X), ranker.n_guards)
+    assert candidates.shape == scores.shape == (len(X), SHORTLIST)
+    np.testing.assert_allclose(scores.sum(axis=1), 1.0, rtol=1e-5)
+    assert np.all(np.diff(scores, axis=1) <= 0)
+    np.testing.assert_array_equal(np.take_along_axis(proba, candidates, axis=1), scores)
+    assert np.count_nonzero(proba, axis=1).max() <= SHORTLIST
+
+
+@pytest.mark.parametrize('k', [3, SHORTLIST, 100])
+def test_rank_caps_k_at_the_shortlist(trained, k):
+    ranker, X, _ = trained
+    candidates, scores = ranker.score_shortlist(X)
+    indices, top_scores = ranker.rank(X, k)
+
+    assert indices.shape == top_scores.shape == (len(X), min(k, SHORTLIST))
+    np.testing.assert_array_equal(indices, candidates[:, :k])
+    np.testing.assert_array_equal(top_scores, scores[:, :k])
+    # No zero-confidence padding from guards that were never scored
+    assert np.all(top_scores > 0)
+
+
+def test_engine_serves_from_the_shortlist(trained):
+    from prediction_engine import TwoStageEngine
+
+    ranker, X, _ = trained
+    engine = TwoStageEngine(ranker.copy(), workers=2)
+    try:
+        indices, scores = engine.rank_sync(X, 100)
+    finally:
+        engine.shutdown()
+    expected_indices, expected_scores = ranker.rank(X, 100)
+    assert indices.shape == (len(X), SHORTLIST)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)
+
+
+def test_missed_labels_rank_behind_every_guard(trained):
+    ranker, X, y = trained
+    # Guard bandwidth gives the true guard away here, so score against other guards too
+    y = np.where(np.arange(len(y)) % 2, y, (y + ranker.n_guards // 2) % ranker.n_guards)
+    shortlist, _ = ranker.shortlist(X)
+    missed = ~(shortlist == y[:, None]).any(axis=1)
+    ranks = true_label_ranks(ranker.predict_proba(X), y)
+
+    assert shortlist_recall(ranker, X, y) == pytest.approx(1 - missed.mean())
+    assert np.all(ranks[~missed] <= SHORTLIST)
+    assert missed.any()
+    assert np.all(ranks[missed] >= ranker.n_guards - SHORTLIST)
+
+
+def test_shortlist_follows_the_prior(trained):
+    ranker, X, _ = trained
+    candidates, cluster_proba = ranker.shortlist(X)
+    prior = cluster_proba[:, ranker.clusters] * ranker.cluster_share
+    chosen = np.take_along_axis(prior, candidates, axis=1)
+    assert np.all(np.diff(chosen, axis=1) <= 0)
+    # Nothing outside the shortlist has a higher prior than its last member
+    assert np.all(np.sort(prior, axis=1)[:, -SHORTLIST] <= chosen[:, -1] + 1e-7)
+
+
+def test_save_load_and_copy_round_trip(trained, tmp_path):
+    ranker, X, _ = trained
+    ranker.save(tmp_path)
+    loaded = TwoStageRanker.load(tmp_path)
+    assert loaded.shortlist_size == SHORTLIST
+    assert loaded.feature_columns == ranker.feature_columns
+    np.testing.assert_allclose(loaded.predict_proba(X), ranker.predict_proba(X), rtol=1e-6)
+    np.testing.assert_allclose(ranker.copy().predict_proba(X), ranker.predict_proba(X), rtol=1e-6)